@@ -145,6 +145,8 @@ setup(
     name="Ubuntu Make",
     version=get_version(),
     packages=find_packages(exclude=["tests*"]),
+    # asyncio coroutines, contextvars and http.server.ThreadingHTTPServer
+    python_requires=">=3.7",
     package_data={},
     entry_points={
         'console_scripts': [
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Performance benchmarks. They are not part of the test suite and are run directly as modules, or all together
+with: python3 -m tests.benchmarks (./runtests benchmark)"""
+
+import multiprocessing
+import os
+import socket
+import sys
+from threading import Event
+import time
+from ..tools.local_server import LocalHttp
+
+
+def serve(path, port):
+    """Serve path from the current process until it's terminated"""
+    # clients hanging up on purpose, like segmented downloads do, aren't worth a traceback
+    sys.stderr = open(os.devnull, 'w')
+    LocalHttp(path, port=port)
+    Event().wait()
+
+
+def start_server(path, port):
+    """Serve path on port from another process, so that its CPU time isn't counted. Return that process once the
+    server accepts connections"""
+    server = multiprocessing.Process(target=serve, args=(path, port), daemon=True)
+    server.start()
+    timeout = time.monotonic() + 5
+    while True:
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return server
+        except ConnectionRefusedError:
+            if time.monotonic() > timeout:
+                server.terminate()
+                raise BaseException("Benchmark server didn't start within 5 seconds")
+            time.sleep(0.05)
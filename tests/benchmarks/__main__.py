@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Run benchmarks, writing their results as JSON so that they can be compared with the ones of another commit.
+
+Run it with: python3 -m tests.benchmarks [--output results.json] [--compare previous.json] [benchmark]..."""
+
+import argparse
+from datetime import datetime, timezone
+import importlib
+import json
+import platform
+import subprocess
+import sys
+from ..tools import get_root_dir
+
+# modules of this package exposing run(sizes)
+BENCHMARKS = ("download_center", "decompressor")
+# metrics are lower is better, except those
+HIGHER_IS_BETTER = ("throughput_mib_s",)
+
+
+def get_commit():
+    """Return the commit of the tree being benchmarked, None if it's not a git checkout"""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=get_root_dir(),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current, threshold):
+    """Print how current metrics evolved since previous ones. Return the regressions worse than threshold percent"""
+    regressions = []
+    for benchmark, cases in current["benchmarks"].items():
+        for case, metrics in cases.items():
+            previous_metrics = previous.get("benchmarks", {}).get(benchmark, {}).get(case, {})
+            for metric, value in metrics.items():
+                previous_value = previous_metrics.get(metric)
+                if not previous_value or value is None:
+                    continue
+                change = (value - previous_value) * 100 / previous_value
+                line = "{} {} {}: {:.4g} -> {:.4g} ({:+.1f}%)".format(benchmark, case, metric, previous_value, value,
+                                                                      change)
+                print(line, file=sys.stderr)
+                if (-change if metric in HIGHER_IS_BETTER else change) > threshold:
+                    regressions.append(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run performance benchmarks")
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help="Benchmarks to run among {}, all of them by default".format(", ".join(BENCHMARKS)))
+    parser.add_argument("--sizes", type=int, nargs="+", help="Payload sizes in MiB, defaults depend on benchmarks")
+    parser.add_argument("-o", "--output", help="Write results to that file instead of stdout")
+    parser.add_argument("--compare", metavar="PREVIOUS", help="Compare results with PREVIOUS ones")
+    parser.add_argument("--threshold", type=float, default=10,
+                        help="Exit with an error if a metric is that many percent worse than in PREVIOUS "
+                             "(default: %(default)s)")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: {}".format(name))
+
+    results = {"commit": get_commit(), "date": datetime.now(timezone.utc).isoformat(),
+               "python": platform.python_version(), "machine": platform.machine(), "benchmarks": {}}
+    for name in args.benchmarks or BENCHMARKS:
+        module = importlib.import_module("{}.{}".format(__package__, name))
+        print("Running {} benchmark".format(name), file=sys.stderr)
+        results["benchmarks"][name] = module.run(args.sizes) if args.sizes else module.run()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        if regressions:
+            print("Regressions over {}%:\n{}".format(args.threshold, "\n".join(regressions)), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
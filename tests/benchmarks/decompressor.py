@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Measure Decompressor wall clock time, CPU time and peak memory extracting synthetic archives: tar.gz, tar.xz,
+tar.bz2, zip and self-extracting ones, with many small files in nested directories or a few large files, for each
+extraction backend available.
+
+Each extraction runs in a fresh python process, so that its CPU time and peak RSS include the tools and processes
+it runs and nothing else.
+
+Run it with: python3 -m tests.benchmarks.decompressor [size in MiB]..."""
+
+from contextlib import suppress
+import ctypes
+import io
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+from threading import Event
+import time
+import zipfile
+from ..tools import get_root_dir
+
+# uncompressed payload, in MiB
+DEFAULT_SIZES = (16, 128)
+# each measure is the best of that many extractions
+REPEAT = 3
+# archive content lives in that directory, extracted by its glob like frameworks do
+ROOT_DIR = "bench-1.0"
+ROOT_GLOB = "bench-*"
+SMALL_FILE_SIZE = 4 * 1024
+LARGE_FILE_SIZE = 32 * 1024 * 1024
+# small files directories depth and number of subdirectories per directory
+DEPTH = 4
+FANOUT = 8
+# prctl() option making orphaned descendants of a process its children
+PR_SET_CHILD_SUBREAPER = 36
+TAR_FORMATS = {"tar.gz": "gz", "tar.xz": "xz", "tar.bz2": "bz2"}
+# self-extracting archives are executed with -o<destination>, like 7-Zip ones
+SFX_HEADER = """#!/bin/sh
+dest="${{1#-o}}"
+mkdir -p "$dest"
+tail -c +{offset:010d} "$0" | tar -xz -C "$dest"
+exit $?
+"""
+
+
+def random_content(size):
+    """Return size bytes of hexadecimal text, which compresses about as well as binaries and resources of real SDKs"""
+    return os.urandom(size // 2).hex().encode()
+
+
+def payload_files(shape, size):
+    """Yield (path, content) of size MiB of files, shaped as small_files or large_files"""
+    total = size * 1024 * 1024
+    if shape == "large_files":
+        file_size = min(LARGE_FILE_SIZE, total)
+        for index in range(total // file_size):
+            yield "{}/lib/large{}".format(ROOT_DIR, index), random_content(file_size)
+        return
+    for index in range(total // SMALL_FILE_SIZE):
+        directories = []
+        number = index
+        for level in range(DEPTH):
+            directories.append("d{}".format(number % FANOUT))
+            number //= FANOUT
+        yield "{}/{}/small{}".format(ROOT_DIR, "/".join(directories), index), random_content(SMALL_FILE_SIZE)
+
+
+def make_archive(path, archive_format, files):
+    """Write files to an archive_format archive at path"""
+    if archive_format == "zip":
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+            for name, content in files:
+                archive.writestr(name, content)
+        return
+    if archive_format == "sfx":
+        tgz_path = path + ".tgz"
+        make_archive(tgz_path, "tar.gz", files)
+        # the offset has a fixed width, and tail counts from 1
+        offset = len(SFX_HEADER.format(offset=0).encode()) + 1
+        with open(path, "wb") as f, open(tgz_path, "rb") as tgz:
+            f.write(SFX_HEADER.format(offset=offset).encode())
+            shutil.copyfileobj(tgz, f)
+        os.remove(tgz_path)
+        os.chmod(path, 0o755)
+        return
+    # the fastest xz preset: decompression speed barely depends on it
+    options = {"preset": 1} if archive_format == "tar.xz" else {}
+    with tarfile.open(path, "w:" + TAR_FORMATS[archive_format], **options) as archive:
+        for name, content in files:
+            member = tarfile.TarInfo(name)
+            member.size = len(content)
+            member.mode = 0o644
+            member.mtime = time.time()
+            archive.addfile(member, io.BytesIO(content))
+
+
+def get_backends(archive_format):
+    """Return the names of the backends extracting archive_format here"""
+    from umake.extraction_backends import BACKENDS, PREFERENCES
+
+    if archive_format == "zip":
+        return ["zipfile", "zipfile-parallel"] if len(os.sched_getaffinity(0)) > 1 else ["zipfile"]
+    if archive_format == "sfx":
+        return ["sfx"]
+    return [name for name in PREFERENCES[TAR_FORMATS[archive_format]] if BACKENDS[name].is_available()]
+
+
+def extract(backend, archive, dest):
+    """Extract archive to dest with Decompressor using backend, from a fresh process. Return its metrics"""
+    from umake import extraction_backends
+    from umake.decompressor import Decompressor
+
+    if backend in extraction_backends.BACKENDS:
+        extraction_backends.PREFERENCES = {compression: (backend,) for compression in extraction_backends.PREFERENCES}
+    Decompressor.ZipFileWithPerm.PARALLEL_MIN_SIZE = 0 if backend == "zipfile-parallel" else sys.maxsize
+
+    done = Event()
+    results = []
+
+    def on_done(result):
+        results.extend(result.values())
+        done.set()
+
+    startup_usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    Decompressor({open(archive, 'rb'): Decompressor.DecompressOrder(dir=ROOT_GLOB, dest=dest)}, on_done)
+    done.wait()
+    wall_time = time.perf_counter() - start
+    if results[0].error:
+        raise BaseException(results[0].error)
+    return {"wall": wall_time, "startup_cpu": startup_usage.ru_utime + startup_usage.ru_stime}
+
+
+def extract_tree(backend, archive, dest):
+    """Run extract() in a child process and add the CPU time and peak RSS of every process it started to its metrics.
+
+    Zip pool workers are forked by a forkserver which outlives the extracting process, so their usage never shows
+    in its RUSAGE_CHILDREN. Becoming their subreaper accounts it to this process once they are reaped"""
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0):
+        raise OSError(ctypes.get_errno(), "Couldn't become a subreaper")
+    output = subprocess.check_output([sys.executable, "-m", __spec__.name, "--extract", backend, archive, dest])
+    # wait for the orphaned descendants, like the forkserver, to exit
+    with suppress(ChildProcessError):
+        while True:
+            os.waitpid(-1, 0)
+    metrics = json.loads(output.decode())
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # the start-up of the extracting process isn't part of the extraction
+    metrics["cpu"] = usage.ru_utime + usage.ru_stime - metrics.pop("startup_cpu")
+    # in KiB on Linux, of the biggest process
+    metrics["peak_rss"] = usage.ru_maxrss / 1024
+    return metrics
+
+
+def measure(backend, archive, size, repeat=REPEAT):
+    """Return the metrics of the fastest of repeat extractions of archive, size MiB uncompressed, with backend"""
+    timings = []
+    for i in range(repeat):
+        dest = tempfile.mkdtemp(dir=os.path.dirname(archive))
+        try:
+            output = subprocess.check_output([sys.executable, "-m", __spec__.name, "--extract-tree", backend,
+                                              archive, dest], cwd=get_root_dir())
+            timings.append(json.loads(output.decode()))
+        finally:
+            shutil.rmtree(dest)
+    best = min(timings, key=lambda timing: timing["wall"])
+    return {
+        "throughput_mib_s": size / best["wall"],
+        "wall_s": best["wall"],
+        "cpu_s": best["cpu"],
+        "peak_rss_mib": best["peak_rss"],
+    }
+
+
+def run(sizes=DEFAULT_SIZES, repeat=REPEAT):
+    """Return metrics for each archive, keyed by <format>-<shape>-<size>MiB-<backend>"""
+    work_dir = tempfile.mkdtemp()
+    results = {}
+    try:
+        for size in sizes:
+            for shape in ("small_files", "large_files"):
+                for archive_format in ("tar.gz", "tar.xz", "tar.bz2", "zip", "sfx"):
+                    print("Extracting {} MiB of {} from {}".format(size, shape, archive_format), file=sys.stderr)
+                    archive = os.path.join(work_dir, "archive.{}".format(archive_format))
+                    make_archive(archive, archive_format, payload_files(shape, size))
+                    for backend in get_backends(archive_format):
+                        case = "{}-{}-{}MiB-{}".format(archive_format, shape, size, backend)
+                        results[case] = measure(backend, archive, size, repeat)
+                    os.remove(archive)
+    finally:
+        shutil.rmtree(work_dir)
+    return results
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--extract"]:
+        print(json.dumps(extract(*sys.argv[2:5])))
+    elif sys.argv[1:2] == ["--extract-tree"]:
+        print(json.dumps(extract_tree(*sys.argv[2:5])))
+    else:
+        print(json.dumps(run([int(size) for size in sys.argv[1:]] or DEFAULT_SIZES), indent=2))
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Compare CPU time spent per GiB downloaded with fixed and adaptive block sizes.
+
+Run it with: python3 -m tests.benchmarks.download_block_size [size in MiB]"""
+
+import os
+import shutil
+import sys
+import tempfile
+from threading import Event
+import time
+from . import start_server
+from ..tools import change_xdg_path, patchelem
+
+PORT = 9878
+
+
+def download(url):
+    """Download url and return the CPU time spent by this process"""
+    from umake.network.download_center import DownloadCenter, DownloadItem
+
+    done = Event()
+    results = []
+
+    def on_done(result):
+        results.append(result[url])
+        done.set()
+
+    start = time.process_time()
+    DownloadCenter([DownloadItem(url)], on_done)
+    done.wait()
+    cpu_time = time.process_time() - start
+    if results[0].error:
+        raise BaseException(results[0].error)
+    results[0].fd.close()
+    return cpu_time
+
+
+def main(size):
+    from umake.network.download_center import DownloadCenter
+
+    server_dir = tempfile.mkdtemp()
+    cache_dir = tempfile.mkdtemp()
+    change_xdg_path('XDG_CACHE_HOME', cache_dir)
+    with open(os.path.join(server_dir, "bigfile"), "wb") as f:
+        f.write(os.urandom(1024 * 1024) * size)
+    server = start_server(server_dir, PORT)
+    url = "http://localhost:{}/bigfile".format(PORT)
+    gib_ratio = 1024 / size
+
+    try:
+        # we only measure streamed reads
+        with patchelem(DownloadCenter, 'SEGMENT_MIN_SIZE', sys.maxsize):
+            with patchelem(DownloadCenter, 'MAX_BLOCK_SIZE', DownloadCenter.BLOCK_SIZE):
+                fixed = download(url)
+            adaptive = download(url)
+    finally:
+        server.terminate()
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(server_dir)
+        shutil.rmtree(cache_dir)
+
+    print("Fixed {} KiB blocks: {:.2f}s CPU/GiB".format(DownloadCenter.BLOCK_SIZE // 1024, fixed * gib_ratio))
+    max_block_size = DownloadCenter.MAX_BLOCK_SIZE // (1024 * 1024)
+    print("Adaptive blocks up to {} MiB: {:.2f}s CPU/GiB".format(max_block_size, adaptive * gib_ratio))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 256)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Measure DownloadCenter throughput, CPU time per GiB, time to first byte, and what checksums and progress
+reports cost on top of a plain download, for synthetic payloads served by the local test server.
+
+Run it with: python3 -m tests.benchmarks.download_center [size in MiB]..."""
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+from threading import Event
+import time
+from . import start_server
+from ..tools import change_xdg_path, patchelem
+
+PORT = 9879
+# in MiB
+DEFAULT_SIZES = (1, 16, 256)
+# each measure is the best of that many downloads
+REPEAT = 3
+
+
+def download(url, checksum=None, report=None):
+    """Download url with a fresh cache. Return the wall clock and CPU times it took, and how long it was before
+    the first content was reported if report is set"""
+    from umake.network.download_center import DownloadCenter, DownloadItem
+
+    done = Event()
+    results = []
+    first_byte = []
+
+    def on_done(result):
+        results.append(result[url])
+        done.set()
+
+    def on_report(progress):
+        if not first_byte and progress[url]['current']:
+            first_byte.append(time.perf_counter())
+        report(progress)
+
+    # don't get it back from the artifact cache
+    cache_dir = tempfile.mkdtemp()
+    change_xdg_path('XDG_CACHE_HOME', cache_dir)
+    try:
+        start_cpu = time.process_time()
+        start = time.perf_counter()
+        DownloadCenter([DownloadItem(url, checksum)], on_done, report=on_report if report else lambda x: None)
+        done.wait()
+        wall_time = time.perf_counter() - start
+        cpu_time = time.process_time() - start_cpu
+        if results[0].error:
+            raise BaseException(results[0].error)
+        results[0].fd.close()
+    finally:
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(cache_dir)
+    return {"wall": wall_time, "cpu": cpu_time, "first_byte": first_byte[0] - start if first_byte else None}
+
+
+def best_of(repeat, *args, **kwargs):
+    """Return the fastest of repeat downloads, the others being disturbed by something else"""
+    return min((download(*args, **kwargs) for i in range(repeat)), key=lambda timing: timing["cpu"])
+
+
+def measure(url, size, checksum, repeat=REPEAT):
+    """Return the metrics of downloading url, size MiB long"""
+    from umake.network.download_progress import DownloadProgress
+
+    gib_ratio = 1024 / size
+    plain = best_of(repeat, url)
+    with_checksum = best_of(repeat, url, checksum)
+    reports = []
+    # every block is reported
+    with patchelem(DownloadProgress, 'MIN_INTERVAL', 0):
+        with_progress = best_of(repeat, url, report=lambda progress: reports.append(progress))
+    return {
+        "throughput_mib_s": size / plain["wall"],
+        "cpu_s_per_gib": plain["cpu"] * gib_ratio,
+        "time_to_first_byte_s": with_progress["first_byte"],
+        "checksum_cpu_s_per_gib": max(with_checksum["cpu"] - plain["cpu"], 0) * gib_ratio,
+        "progress_cpu_s_per_gib": max(with_progress["cpu"] - plain["cpu"], 0) * gib_ratio,
+        # reports of one download
+        "progress_reports": len(reports) // repeat,
+    }
+
+
+def run(sizes=DEFAULT_SIZES, repeat=REPEAT):
+    """Return metrics for each payload size in MiB, keyed by <size>MiB"""
+    from umake.tools import Checksum, ChecksumType
+
+    server_dir = tempfile.mkdtemp()
+    results = {}
+    try:
+        payloads = {}
+        block = os.urandom(1024 * 1024)
+        for size in sizes:
+            hasher = hashlib.sha256()
+            with open(os.path.join(server_dir, "{}MiB".format(size)), "wb") as f:
+                for i in range(size):
+                    f.write(block)
+                    hasher.update(block)
+            payloads[size] = Checksum(ChecksumType.sha256, hasher.hexdigest())
+
+        server = start_server(server_dir, PORT)
+        try:
+            for size in sizes:
+                print("Downloading {} MiB".format(size), file=sys.stderr)
+                url = "http://localhost:{}/{}MiB".format(PORT, size)
+                results["{}MiB".format(size)] = measure(url, size, payloads[size], repeat)
+        finally:
+            server.terminate()
+    finally:
+        shutil.rmtree(server_dir)
+    return results
+
+
+if __name__ == "__main__":
+    print(json.dumps(run([int(size) for size in sys.argv[1:]] or DEFAULT_SIZES), indent=2))
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the artifact cache"""
+
+import os
+import shutil
+import tempfile
+from ..tools import LoggedTestCase, change_xdg_path
+from umake.network.artifact_cache import ArtifactCache
+from umake.tools import Checksum, ChecksumType, get_cache_path
+
+
+class TestArtifactCache(LoggedTestCase):
+    """This will test the artifact cache storage and eviction"""
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
+        self.cache = ArtifactCache()
+        self.cache.max_size = 1024 * 1024
+        self.source_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.source_dir)
+        super().tearDown()
+
+    def create_file(self, name, size):
+        """Create a file of size bytes to store in the cache"""
+        path = os.path.join(self.source_dir, name)
+        with open(path, 'wb') as f:
+            f.write(name.encode()[:1] * size)
+        return path
+
+    def test_default_path(self):
+        """The artifact cache is in the user cache directory"""
+        self.assertEqual(self.cache.path, get_cache_path("artifacts"))
+        self.assertTrue(self.cache.path.startswith(self.cache_dir))
+
+    def test_key_for_checksum(self):
+        """Artifacts with a checksum are keyed by it"""
+        self.assertEqual(ArtifactCache.key_for("http://foo", Checksum(ChecksumType.sha256, "ABCD")), "sha256-abcd")
+
+    def test_key_for_url_and_etag(self):
+        """Artifacts without a checksum are keyed by their url and etag"""
+        key = ArtifactCache.key_for("http://foo", Checksum(ChecksumType.sha256, None), etag='"1234"')
+        self.assertTrue(key.startswith("url-"))
+        self.assertNotEqual(key, ArtifactCache.key_for("http://foo", etag='"5678"'))
+        self.assertNotEqual(key, ArtifactCache.key_for("http://bar", etag='"1234"'))
+
+    def test_no_key(self):
+        """Artifacts without any checksum nor strong etag can't be cached"""
+        self.assertIsNone(ArtifactCache.key_for("http://foo"))
+        self.assertIsNone(ArtifactCache.key_for("http://foo", etag='W/"1234"'))
+
+    def test_add_and_open(self):
+        """We get back artifacts we added"""
+        path = self.create_file("foo", 10)
+        self.cache.add("md5-foo", path)
+        os.remove(path)
+
+        with self.cache.open("md5-foo", suffix=".tgz") as f:
+            self.assertTrue(f.name.endswith(".tgz"))
+            self.assertEqual(f.read(), b"f" * 10)
+            link_path = f.name
+        self.assertFalse(os.path.exists(link_path))
+        self.assertEqual(self.cache.stats(), (1, 10))
+
+    def test_open_missing(self):
+        """We get None for artifacts which aren't cached"""
+        self.assertIsNone(self.cache.open("md5-foo"))
+        self.assertIsNone(self.cache.open(None))
+
+    def test_evict_least_recently_used(self):
+        """We evict least recently used artifacts once over quota"""
+        self.cache.max_size = 25
+        self.cache.add("md5-foo", self.create_file("foo", 10))
+        self.cache.add("md5-bar", self.create_file("bar", 10))
+        os.utime(os.path.join(self.cache.path, "md5-foo"), (1, 1))
+        os.utime(os.path.join(self.cache.path, "md5-bar"), (2, 2))
+        # foo is used again, bar becomes the least recently used one
+        self.cache.open("md5-foo").close()
+        self.cache.add("md5-baz", self.create_file("baz", 10))
+
+        self.assertIsNone(self.cache.open("md5-bar"))
+        self.assertEqual(self.cache.stats(), (2, 20))
+
+    def test_too_big_artifact_not_stored(self):
+        """We don't store artifacts bigger than the cache quota"""
+        self.cache.max_size = 5
+        self.cache.add("md5-foo", self.create_file("foo", 10))
+        self.assertEqual(self.cache.stats(), (0, 0))
+
+    def test_disabled_by_default(self):
+        """The cache doesn't store anything until it's given a quota"""
+        self.assertFalse(ArtifactCache().enabled)
+
+    def test_disabled_cache(self):
+        """A cache with no quota doesn't store anything"""
+        self.cache.max_size = 0
+        self.cache.add("md5-foo", self.create_file("foo", 10))
+        self.assertFalse(self.cache.enabled)
+        self.assertIsNone(self.cache.open("md5-foo"))
+
+    def test_prune(self):
+        """We can remove every cached artifact"""
+        self.cache.add("md5-foo", self.create_file("foo", 10))
+        self.cache.add("md5-bar", self.create_file("bar", 10))
+        self.cache.prune()
+        self.assertEqual(self.cache.stats(), (0, 0))
+
+    def test_stats_empty(self):
+        """An empty or non existing cache has no artifact"""
+        self.assertEqual(self.cache.stats(), (0, 0))
+
+    def test_find_seed(self):
+        """We find back the most recently used artifact downloaded from another release of an url"""
+        self.cache.add("md5-foo", self.create_file("foo", 10), url="http://foo/tool-1.0.tar.gz")
+        self.cache.add("md5-bar", self.create_file("bar", 10), url="http://foo/tool-1.1.tar.gz")
+        self.cache.add("md5-baz", self.create_file("baz", 10), url="http://foo/other-1.1.tar.gz")
+        os.utime(os.path.join(self.cache.path, "md5-foo"), (2, 2))
+        os.utime(os.path.join(self.cache.path, "md5-bar"), (1, 1))
+
+        with self.cache.find_seed("http://foo/tool-2.0.tar.gz", suffix=".tar.gz") as f:
+            self.assertTrue(f.name.endswith(".tar.gz"))
+            self.assertEqual(f.read(), b"f" * 10)
+
+    def test_find_seed_missing(self):
+        """We don't find seeds for artifacts we never downloaded any release of"""
+        self.cache.add("md5-foo", self.create_file("foo", 10), url="http://foo/tool-1.0.tar.gz")
+        self.cache.add("md5-bar", self.create_file("bar", 10))
+        self.assertIsNone(self.cache.find_seed("http://foo/other-1.0.tar.gz"))
+
+    def test_evict_removes_seed(self):
+        """Evicted artifacts aren't seeds anymore"""
+        self.cache.add("md5-foo", self.create_file("foo", 10), url="http://foo/tool-1.0.tar.gz")
+        self.cache.prune()
+        self.assertIsNone(self.cache.find_seed("http://foo/tool-2.0.tar.gz"))
+        self.assertEqual(os.listdir(os.path.join(self.cache.path, ArtifactCache.INDEX_DIR)), [])
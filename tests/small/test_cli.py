@@ -21,7 +21,7 @@
 
 import importlib
 from ..tools import LoggedTestCase
-from umake.ui.cli import mangle_args_for_default_framework, get_frameworks_list_output
+from umake.ui.cli import mangle_args_for_default_framework, get_frameworks_list_output, get_cache_stats_output
 import os
 import sys
 from ..tools import get_data_dir, change_xdg_path, patchelem
@@ -209,3 +209,38 @@ class TestCLIFromFrameworks(LoggedTestCase):
         """We mangle the -r remove option if global (before the category name) to append it to the framework option"""
         self.assertEqual(mangle_args_for_default_framework(["-r", "category-a", "framework-a"]),
                          ["category-a", "framework-a", "-r"])
+
+
+class TestCLICacheStats(LoggedTestCase):
+    """This will test the CLI artifact cache stats output"""
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
+        max_size_patcher = patch("umake.settings.DEFAULT_ARTIFACT_CACHE_MAX_SIZE", 4 * 1024 * 1024 * 1024)
+        max_size_patcher.start()
+        self.addCleanup(max_size_patcher.stop)
+
+    def tearDown(self):
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
+        super().tearDown()
+
+    def test_cache_stats_disabled(self):
+        """We tell how to enable a disabled cache"""
+        with patch("umake.settings.DEFAULT_ARTIFACT_CACHE_MAX_SIZE", 0):
+            self.assertIn("Artifact cache is disabled", get_cache_stats_output())
+
+    def test_cache_stats_empty(self):
+        """We print stats for an empty cache"""
+        self.assertIn(": 0 artifacts, 0.0 MiB used out of 4096.0 MiB", get_cache_stats_output())
+
+    def test_cache_stats(self):
+        """We print the number of artifacts and cache usage"""
+        from umake.network.artifact_cache import ArtifactCache
+        artifact_path = os.path.join(self.cache_dir, "artifact")
+        with open(artifact_path, 'wb') as f:
+            f.write(b'a' * 1024 * 1024)
+        ArtifactCache().add("md5-foo", artifact_path)
+        self.assertIn(": 1 artifacts, 1.0 MiB used", get_cache_stats_output())
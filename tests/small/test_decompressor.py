@@ -19,14 +19,19 @@
 
 """Tests for the decompressor module"""
 
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+import io
 import os
 from time import time
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 import shutil
 import stat
+import tarfile
 import tempfile
-from ..tools import get_data_dir, LoggedTestCase
-from umake.decompressor import Decompressor
+import zipfile
+from ..tools import get_data_dir, LoggedTestCase, change_xdg_path
+from umake.decompressor import Decompressor, StreamDecompressor
 
 
 class TestDecompressor(LoggedTestCase):
@@ -152,6 +157,156 @@ class TestDecompressor(LoggedTestCase):
         self.assertEqual(oct(stat.S_IMODE(os.lstat(simplefile).st_mode)), '0o664')
         self.assertEqual(oct(stat.S_IMODE(os.lstat(execfile).st_mode)), '0o775')
 
+    def test_decompress_zip_in_parallel(self):
+        """We decompress big zip files in multiple processes, retaining the right permissions"""
+        filepath = os.path.join(self.tempdir, "big.zip")
+        with zipfile.ZipFile(filepath, 'w') as archive:
+            for i in range(10):
+                member = zipfile.ZipInfo("root/dir{}/file{}".format(i % 3, i))
+                member.external_attr = (0o755 if i % 2 else 0o644) << 16
+                archive.writestr(member, str(i) * 1000 * i)
+            member = zipfile.ZipInfo("root/readonly/")
+            member.external_attr = 0o555 << 16
+            archive.writestr(member, "")
+            archive.writestr(zipfile.ZipInfo("root/readonly/file"), "content")
+            # later members override previous ones
+            archive.writestr(zipfile.ZipInfo("root/dir0/file0"), "overridden")
+        with patch.object(Decompressor.ZipFileWithPerm, "PARALLEL_MIN_SIZE", 0), \
+                patch("umake.decompressor.os.sched_getaffinity", return_value={0, 1, 2}):
+            Decompressor({open(filepath, 'rb'): Decompressor.DecompressOrder(dest=self.tempdir, dir='root')},
+                         self.on_done)
+            self.wait_for_callback(self.on_done, timeout=30)
+
+        for result in self.on_done.call_args[0][0].values():
+            self.assertIsNone(result.error)
+        for i in range(1, 10):
+            path = os.path.join(self.tempdir, "dir{}".format(i % 3), "file{}".format(i))
+            with open(path) as f:
+                self.assertEqual(f.read(), str(i) * 1000 * i)
+            self.assertEqual(stat.S_IMODE(os.lstat(path).st_mode), 0o755 if i % 2 else 0o644)
+        with open(os.path.join(self.tempdir, "dir0", "file0")) as f:
+            self.assertEqual(f.read(), "overridden")
+        with open(os.path.join(self.tempdir, "readonly", "file")) as f:
+            self.assertEqual(f.read(), "content")
+        self.assertEqual(stat.S_IMODE(os.lstat(os.path.join(self.tempdir, "readonly")).st_mode), 0o555)
+        os.chmod(os.path.join(self.tempdir, "readonly"), 0o755)
+
+    def test_decompress_zip_in_parallel_fallback(self):
+        """We decompress big zip files serially if the process pool can't run"""
+        filepath = os.path.join(self.tempdir, "big.zip")
+        with zipfile.ZipFile(filepath, 'w') as archive:
+            for i in range(10):
+                archive.writestr("root/dir{}/file{}".format(i % 3, i), str(i) * 1000 * i)
+        with patch.object(Decompressor.ZipFileWithPerm, "PARALLEL_MIN_SIZE", 0), \
+                patch("umake.decompressor.os.sched_getaffinity", return_value={0, 1, 2}), \
+                patch.object(futures.ProcessPoolExecutor, "submit", side_effect=BrokenProcessPool("broken")):
+            Decompressor({open(filepath, 'rb'): Decompressor.DecompressOrder(dest=self.tempdir, dir='root')},
+                         self.on_done)
+            self.wait_for_callback(self.on_done, timeout=30)
+
+        for result in self.on_done.call_args[0][0].values():
+            self.assertIsNone(result.error)
+        for i in range(10):
+            with open(os.path.join(self.tempdir, "dir{}".format(i % 3), "file{}".format(i))) as f:
+                self.assertEqual(f.read(), str(i) * 1000 * i)
+
+    def test_decompress_zip_content_glob(self):
+        """We only extract the content of the matching subdir of zip files, in place"""
+        filepath = os.path.join(self.tempdir, "app.zip")
+        with zipfile.ZipFile(filepath, 'w') as archive:
+            archive.writestr("app-1/bin/app", "app")
+            archive.writestr("other/file", "other")
+        dest = os.path.join(self.tempdir, "dest")
+        os.makedirs(dest)
+        Decompressor({open(filepath, 'rb'): Decompressor.DecompressOrder(dest=dest, dir='app-*')}, self.on_done)
+        self.wait_for_callback(self.on_done)
+
+        for result in self.on_done.call_args[0][0].values():
+            self.assertIsNone(result.error)
+        self.assertEqual(os.listdir(dest), ["bin"])
+        with open(os.path.join(dest, "bin", "app")) as f:
+            self.assertEqual(f.read(), "app")
+
+    def test_decompress_zip_first_content_glob(self):
+        """We only extract the first visible subdir of zip files matching the glob"""
+        filepath = os.path.join(self.tempdir, "app.zip")
+        with zipfile.ZipFile(filepath, 'w') as archive:
+            archive.writestr(".app-0/hidden", "hidden")
+            archive.writestr("app-1/bin/app", "app")
+            archive.writestr("app-2/lib/data", "data")
+        dest = os.path.join(self.tempdir, "dest")
+        os.makedirs(dest)
+        Decompressor({open(filepath, 'rb'): Decompressor.DecompressOrder(dest=dest, dir='*')}, self.on_done)
+        self.wait_for_callback(self.on_done)
+
+        for result in self.on_done.call_args[0][0].values():
+            self.assertIsNone(result.error)
+        self.assertEqual(os.listdir(dest), ["bin"])
+
+    def test_decompress_truncated_content_glob(self):
+        """We extract again with tar(1) what can be read of truncated archives, without keeping the failed attempt"""
+        filepath = os.path.join(self.tempdir, "app.tgz")
+        with tarfile.open(filepath, 'w:gz') as archive:
+            for name in ("app-1/bin/app", "app-1/lib/data"):
+                content = os.urandom(1024 * 512)
+                member = tarfile.TarInfo(name)
+                member.size = len(content)
+                archive.addfile(member, io.BytesIO(content))
+        with open(filepath, 'rb') as f:
+            content = f.read()
+        with open(filepath, 'wb') as f:
+            f.write(content[:len(content) * 3 // 4])
+        dest = os.path.join(self.tempdir, "dest")
+        os.makedirs(dest)
+        open(os.path.join(dest, "foo"), 'w').close()
+        Decompressor({open(filepath, 'rb'): Decompressor.DecompressOrder(dest=dest, dir='app-*')}, self.on_done)
+        self.wait_for_callback(self.on_done)
+
+        self.assertEqual(sorted(os.listdir(dest)), ["bin", "foo", "lib"])
+        self.assertEqual(os.listdir(os.path.join(dest, "bin")), ["app"])
+        self.assertFalse(os.path.exists(os.path.join(dest, "lib", "lib")))
+
+    def test_move_content_merge_directories(self):
+        """Extracted directories are merged into existing ones, not moved inside them"""
+        tempdest = os.path.join(self.tempdir, "tempdest")
+        os.makedirs(os.path.join(tempdest, "root", "bin"))
+        open(os.path.join(tempdest, "root", "bin", "app"), 'w').close()
+        dest = os.path.join(self.tempdir, "dest")
+        os.makedirs(os.path.join(dest, "bin"))
+        open(os.path.join(dest, "bin", "other"), 'w').close()
+        Decompressor._move_content(tempdest, "root", dest)
+
+        self.assertEqual(sorted(os.listdir(os.path.join(dest, "bin"))), ["app", "other"])
+        self.assertFalse(os.path.exists(tempdest))
+
+    def test_decompress_filtered(self):
+        """We only extract members selected by include and exclude filters"""
+        filepath = os.path.join(self.compressfiles_dir, "valid.tgz")
+        Decompressor({open(filepath, 'rb'): Decompressor.DecompressOrder(dest=self.tempdir, dir='server-content',
+                                                                         include=['simple*', 'subdir'],
+                                                                         exclude=['*-with-no-content-length'])},
+                     self.on_done)
+        self.wait_for_callback(self.on_done)
+
+        for result in self.on_done.call_args[0][0].values():
+            self.assertIsNone(result.error)
+        self.assertTrue(os.path.isfile(os.path.join(self.tempdir, 'simplefile')))
+        self.assertTrue(os.path.isfile(os.path.join(self.tempdir, 'subdir', 'otherfile')))
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, 'simplefile-with-no-content-length')))
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, 'biggerfile')))
+
+    def test_decompress_zip_filtered(self):
+        """We only extract zip members selected by include and exclude filters"""
+        filepath = os.path.join(self.compressfiles_dir, "valid.zip")
+        Decompressor({open(filepath, 'rb'): Decompressor.DecompressOrder(dest=self.tempdir, dir='server-content',
+                                                                         include=['*file'], exclude=['simple*'])},
+                     self.on_done)
+        self.wait_for_callback(self.on_done)
+
+        for result in self.on_done.call_args[0][0].values():
+            self.assertIsNone(result.error)
+        self.assertEqual(sorted(os.listdir(self.tempdir)), ['biggerfile', 'executablefile', 'source-files'])
+
     def test_decompress_exec(self):
         """We decompress a valid executable file successfully"""
         filepath = os.path.join(self.compressfiles_dir, "simple.bin")
@@ -280,3 +435,139 @@ class TestDecompressor(LoggedTestCase):
         self.assertTrue(os.path.isdir(os.path.join(self.tempdir, 'subdir2')))
         self.assertTrue(os.path.isfile(os.path.join(self.tempdir, 'subdir2', 'otherfile')))
         self.assertEqual(self.on_done.call_count, 1, "Global done callback is only called once")
+
+
+class TestStreamDecompressor(LoggedTestCase):
+    """This will test extracting archives while they are written"""
+
+    def setUp(self):
+        super().setUp()
+        self.on_done = Mock()
+        self.tempdir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', os.path.join(self.tempdir, "cache"))
+        self.compressfiles_dir = os.path.join(get_data_dir(), "compress-files")
+
+    def tearDown(self):
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.tempdir)
+        super().tearDown()
+
+    def write_archive(self, fd, filename, block_size=100):
+        """Write filename archive content to fd, in blocks of block_size"""
+        with open(os.path.join(self.compressfiles_dir, filename), 'rb') as f:
+            for data in iter(lambda: f.read(block_size), b''):
+                fd.write(data)
+
+    def test_extract_while_written(self):
+        """We extract archives as they are written, and Decompressor moves them in place"""
+        fd = StreamDecompressor()
+        self.write_archive(fd, "valid.tgz")
+        fd.finish()
+        self.assertTrue(os.path.isfile(os.path.join(fd.name, 'server-content', 'simplefile')))
+
+        dest = os.path.join(self.tempdir, "dest")
+        os.makedirs(dest)
+        Decompressor({fd: Decompressor.DecompressOrder(dest=dest, dir='server-content')}, self.on_done)
+        timeout_time = time() + 5
+        while not self.on_done.called:
+            if time() > timeout_time:
+                raise(BaseException("Function not called within 5 seconds"))
+
+        self.assertIsNone(self.on_done.call_args[0][0][fd].error)
+        self.assertTrue(os.path.isfile(os.path.join(dest, 'simplefile')))
+        self.assertTrue(os.path.isfile(os.path.join(dest, 'subdir', 'otherfile')))
+        fd.close()
+        self.assertFalse(os.path.exists(fd.name))
+
+    def test_staging_dir(self):
+        """We stage extracted content in the given directory, next to its destination"""
+        fd = StreamDecompressor(self.tempdir)
+        self.write_archive(fd, "valid.tgz")
+        fd.finish()
+        self.assertEqual(os.path.dirname(fd.name), self.tempdir)
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, "cache")))
+        fd.close()
+        self.assertFalse(os.path.exists(fd.name))
+
+    def test_filter_extracted_content(self):
+        """Decompressor only moves in place members selected by filters"""
+        fd = StreamDecompressor()
+        self.write_archive(fd, "valid.tgz")
+        fd.finish()
+
+        dest = os.path.join(self.tempdir, "dest")
+        os.makedirs(dest)
+        Decompressor({fd: Decompressor.DecompressOrder(dest=dest, dir='server-content', include=['subdir/*'])},
+                     self.on_done)
+        timeout_time = time() + 5
+        while not self.on_done.called:
+            if time() > timeout_time:
+                raise(BaseException("Function not called within 5 seconds"))
+
+        self.assertIsNone(self.on_done.call_args[0][0][fd].error)
+        self.assertEqual(os.listdir(dest), ['subdir'])
+        self.assertEqual(os.listdir(os.path.join(dest, 'subdir')), ['otherfile'])
+        fd.close()
+
+    def test_restart(self):
+        """We discard what was extracted so far when the archive is written again from its start"""
+        fd = StreamDecompressor()
+        self.write_archive(fd, "valid.tgz", block_size=1000000)
+        fd.restart()
+        self.assertEqual(fd.tell(), 0)
+        self.assertEqual(os.listdir(fd.name), [])
+
+        self.write_archive(fd, "valid.tgz")
+        fd.finish()
+        self.assertTrue(os.path.isfile(os.path.join(fd.name, 'server-content', 'simplefile')))
+        fd.close()
+        self.assertFalse(os.path.exists(fd.name))
+
+    def test_remove_leftovers(self):
+        """We remove content staged by interrupted runs, but not the one still used"""
+        leftover = os.path.join(self.tempdir, StreamDecompressor.PREFIX + "leftover")
+        os.makedirs(os.path.join(leftover, "content"))
+        used = StreamDecompressor(self.tempdir)
+        os.utime(leftover, (0, 0))
+        os.utime(used.name, (0, 0))
+        other = os.path.join(self.tempdir, "other")
+        os.makedirs(other)
+        os.utime(other, (0, 0))
+
+        fd = StreamDecompressor(self.tempdir)
+        self.assertFalse(os.path.exists(leftover))
+        self.assertTrue(os.path.isdir(used.name))
+        self.assertTrue(os.path.isdir(other))
+        fd.close()
+        used.close()
+
+    def test_tell(self):
+        """We know how much was written"""
+        fd = StreamDecompressor()
+        self.write_archive(fd, "valid.tgz")
+        self.assertEqual(fd.tell(), os.path.getsize(os.path.join(self.compressfiles_dir, "valid.tgz")))
+        fd.close()
+
+    def test_invalid_archive(self):
+        """We raise an error if the written archive is invalid"""
+        fd = StreamDecompressor()
+        with self.assertRaises(BaseException):
+            self.write_archive(fd, "invalid.tgz")
+            fd.finish()
+        fd.close()
+        self.assertFalse(os.path.exists(fd.name))
+
+    def test_close_discard_extracted_content(self):
+        """Closing before the end discards the extracted content"""
+        fd = StreamDecompressor()
+        self.write_archive(fd, "valid.tgz")
+        fd.close()
+        self.assertFalse(os.path.exists(fd.name))
+
+    def test_can_extract(self):
+        """We only extract tar archives while they are written"""
+        self.assertTrue(StreamDecompressor.can_extract("http://foo/bar.tar.gz"))
+        self.assertTrue(StreamDecompressor.can_extract("http://foo/bar.TAR.XZ"))
+        self.assertTrue(StreamDecompressor.can_extract("http://foo/bar.tbz2"))
+        self.assertFalse(StreamDecompressor.can_extract("http://foo/bar.zip"))
+        self.assertFalse(StreamDecompressor.can_extract("http://foo/bar.sh"))
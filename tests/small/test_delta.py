@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for delta downloads"""
+
+import gzip
+import hashlib
+from os.path import join
+import random
+import shutil
+import tempfile
+from time import time
+from unittest.mock import Mock, patch
+import requests
+from ..tools import LoggedTestCase, change_xdg_path
+from ..tools.local_server import LocalHttp
+from umake.network.artifact_cache import ArtifactCache
+from umake.network.delta import BlockManifest, DeltaDownload, DeltaError, main
+from umake.network.download_center import DownloadCenter, DownloadItem
+from umake.tools import Checksum, ChecksumType
+
+BLOCK_SIZE = BlockManifest.BLOCK_SIZE
+
+
+class TestDelta(LoggedTestCase):
+    """This will test downloading new releases as a delta from previous ones"""
+
+    server = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server_dir = tempfile.mkdtemp()
+        # the previous release, and a new one with its 4th block changed and some content appended
+        content = random.Random(0).getrandbits(8 * 16 * BLOCK_SIZE).to_bytes(16 * BLOCK_SIZE, "little")
+        cls.old_content = content
+        cls.new_content = content[:3 * BLOCK_SIZE] + b"a" * BLOCK_SIZE + content[4 * BLOCK_SIZE:] + b"b" * 1000
+        # a release with a tar member of 512 bytes added at its start, shifting the others
+        cls.shifted_content = b"c" * 512 + content
+        for filename, content in (("tool-1.0.bin", cls.old_content), ("tool-2.0.bin", cls.new_content),
+                                  ("tool-3.0.bin", cls.shifted_content), ("tool-1.0.bin.gz", gzip.compress(content))):
+            with open(join(cls.server_dir, filename), 'wb') as f:
+                f.write(content)
+        main([join(cls.server_dir, "tool-2.0.bin"), join(cls.server_dir, "tool-3.0.bin")])
+        cls.server = LocalHttp(cls.server_dir, port=9880)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.server.stop()
+        shutil.rmtree(cls.server_dir)
+
+    def setUp(self):
+        super().setUp()
+        self.session = requests.Session()
+        self.session_get = Mock(wraps=self.session.get)
+        self.session.get = self.session_get
+        self.seed = open(join(self.server_dir, "tool-1.0.bin"), 'rb')
+        self.dest = tempfile.TemporaryFile()
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
+
+    def tearDown(self):
+        self.seed.close()
+        self.dest.close()
+        self.session.close()
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
+        super().tearDown()
+
+    def build_server_address(self, path):
+        return "{}/{}".format(self.server.get_address(), path)
+
+    def ranges_requested(self):
+        return [kwargs["headers"]["Range"] for args, kwargs in self.session_get.call_args_list
+                if "Range" in kwargs["headers"]]
+
+    def test_manifest(self):
+        """Manifests have the checksum of each block of a file"""
+        manifest = BlockManifest.from_file(join(self.server_dir, "tool-2.0.bin"))
+        self.assertEqual(manifest.size, len(self.new_content))
+        self.assertEqual(len(manifest.blocks), 17)
+        self.assertEqual(manifest.file_hash, hashlib.sha256(self.new_content).hexdigest())
+        loaded = BlockManifest.loads(manifest.dumps())
+        self.assertEqual((loaded.size, loaded.blocks, loaded.file_hash),
+                         (manifest.size, manifest.blocks, manifest.file_hash))
+
+    def test_invalid_manifest(self):
+        """Invalid manifests are refused"""
+        manifest = BlockManifest.from_file(join(self.server_dir, "tool-2.0.bin"))
+        manifest.blocks.pop()
+        for content in (b"garbage", b'{"version": 2}', manifest.dumps()):
+            with self.assertRaises(DeltaError):
+                BlockManifest.loads(content)
+
+    def test_delta(self):
+        """We only fetch blocks which aren't in the previous release"""
+        report = Mock()
+        delta = DeltaDownload(self.session, self.build_server_address("tool-2.0.bin"), self.seed, self.dest,
+                              report=report)
+        self.assertTrue(delta.fetch())
+
+        self.dest.seek(0)
+        self.assertEqual(self.dest.read(), self.new_content)
+        self.assertEqual(self.ranges_requested(), ["bytes={}-{}".format(3 * BLOCK_SIZE, 4 * BLOCK_SIZE - 1),
+                                                   "bytes={}-{}".format(16 * BLOCK_SIZE, len(self.new_content) - 1)])
+        report.assert_called_with(len(self.new_content), len(self.new_content))
+
+    def test_delta_shifted(self):
+        """We find blocks of the previous release shifted by multiples of 512 bytes"""
+        delta = DeltaDownload(self.session, self.build_server_address("tool-3.0.bin"), self.seed, self.dest)
+        self.assertTrue(delta.fetch())
+
+        self.dest.seek(0)
+        self.assertEqual(self.dest.read(), self.shifted_content)
+        # only the first block, with the new member, is fetched
+        self.assertEqual(self.ranges_requested(), ["bytes=0-{}".format(BLOCK_SIZE - 1)])
+
+    def test_compressed_seed(self):
+        """We don't look for blocks of compressed releases, which never match"""
+        with open(join(self.server_dir, "tool-1.0.bin.gz"), 'rb') as seed:
+            delta = DeltaDownload(self.session, self.build_server_address("tool-2.0.bin"), seed, self.dest)
+            self.assertFalse(delta.fetch())
+        self.session_get.assert_not_called()
+
+    def test_close_ranges_merged(self):
+        """Missing blocks close to each other are fetched at once"""
+        with patch.object(DeltaDownload, "MERGE_GAP", 20):
+            delta = DeltaDownload(self.session, self.build_server_address("tool-2.0.bin"), self.seed, self.dest)
+            self.assertTrue(delta.fetch())
+
+        self.dest.seek(0)
+        self.assertEqual(self.dest.read(), self.new_content)
+        self.assertEqual(self.ranges_requested(), ["bytes={}-{}".format(3 * BLOCK_SIZE, len(self.new_content) - 1)])
+
+    def test_no_manifest(self):
+        """We can't fetch as a delta files without a manifest"""
+        delta = DeltaDownload(self.session, self.build_server_address("tool-1.0.bin"), self.seed, self.dest)
+        self.assertFalse(delta.fetch())
+        self.assertEqual(self.ranges_requested(), [])
+
+    @patch("umake.settings.DEFAULT_ARTIFACT_CACHE_MAX_SIZE", 1024 * 1024 * 1024)
+    def test_download_center_delta(self):
+        """The download center fetches upgrades as a delta from artifacts in cache"""
+        ArtifactCache().add("md5-old", join(self.server_dir, "tool-1.0.bin"),
+                            url=self.build_server_address("tool-1.0.bin"))
+        url = self.build_server_address("tool-2.0.bin")
+        callback = Mock()
+        checksum = Checksum(ChecksumType.sha256, hashlib.sha256(self.new_content).hexdigest())
+        with patch("umake.network.delta.ConfigHandler") as config_handler, \
+                patch.object(DeltaDownload, "fetch", side_effect=DeltaDownload.fetch, autospec=True) as fetch:
+            config_handler.return_value.config = {"download": {"delta": True}}
+            DownloadCenter([DownloadItem(url, checksum)], callback)
+            timeout = time() + 5
+            while not callback.called:
+                if time() > timeout:
+                    raise BaseException("Function not called within 5 seconds")
+
+        result = callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        with result.fd:
+            self.assertEqual(result.fd.read(), self.new_content)
+        fetch.assert_called_once()
+        self.assertEqual(ArtifactCache().stats()[0], 2)
@@ -19,15 +19,29 @@
 
 """Tests for the download center module using a local server"""
 
+import asyncio
+from email.utils import formatdate
 from enum import Enum
+import json
 import os
-from os.path import join, getsize
+from os.path import join, getsize, getmtime
+import shutil
+import tempfile
+from threading import Event
 from time import time
-from unittest.mock import Mock, call
-from ..tools import get_data_dir, CopyingMock, LoggedTestCase
+from unittest.mock import Mock, patch
+from ..tools import get_data_dir, CopyingMock, LoggedTestCase, patchelem, change_xdg_path
 from ..tools.local_server import LocalHttp
-from umake.network.download_center import DownloadCenter, DownloadItem
-from umake.tools import ChecksumType, Checksum
+from umake.decompressor import StreamDecompressor
+from umake.network.artifact_cache import ArtifactCache
+from umake.network.async_engine import AsyncDownloadEngine
+from umake.network.download_center import DownloadCenter, DownloadItem, DownloadScheduler, PartialDownload, \
+    SessionPool
+from umake.network.download_progress import DownloadProgress
+from umake.network.page_cache import PageCache
+from umake.network.request_trace import RequestTrace, TraceWriter
+from umake.network.retry_policy import CircuitBreaker, RetryPolicy
+from umake.tools import ChecksumType, Checksum, Singleton
 
 
 class TestDownloadCenter(LoggedTestCase):
@@ -50,11 +64,20 @@ class TestDownloadCenter(LoggedTestCase):
         super().setUp()
         self.callback = Mock()
         self.fd_to_close = []
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
+        # don't wait between retries, nor remember failures of previous tests
+        backoff_patcher = patch.object(RetryPolicy, "MAX_BACKOFF", 0)
+        backoff_patcher.start()
+        self.addCleanup(backoff_patcher.stop)
+        Singleton._instances.pop(CircuitBreaker, None)
 
     def tearDown(self):
         super().tearDown()
         for fd in self.fd_to_close:
             fd.close()
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
 
     def build_server_address(self, path, localhost=False):
         """build server address to path to get requested"""
@@ -76,6 +99,11 @@ class TestDownloadCenter(LoggedTestCase):
                 if calls[request].buffer:
                     self.fd_to_close.append(calls[request].buffer)
 
+    def progress_reports(self, report):
+        """Return reported progresses, without speed and eta which depend on timing"""
+        return [{url: {'size': progress['size'], 'current': progress['current']} for url, progress in args[0].items()}
+                for args, kwargs in report.call_args_list]
+
     def test_download(self):
         """we deliver one successful download"""
         filename = "simplefile"
@@ -147,6 +175,85 @@ class TestDownloadCenter(LoggedTestCase):
         self.assertEqual(self.callback.call_count, 1)
         self.assertEqual('6', result.cookies['int'])
 
+    def test_parse_lines(self):
+        """we feed lines to the parser as they arrive, a block of them at a time"""
+        filename = "maven.apache.org/download.cgi"
+        url = self.build_server_address(filename)
+        blocks = []
+        DownloadCenter([DownloadItem(url)], self.callback, download=False,
+                       parse_lines=lambda line_url, lines: blocks.append((line_url, lines)))
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        lines = [(line_url, line) for line_url, block in blocks for line in block]
+        self.assertLess(len(blocks), len(lines))
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            content = file_on_disk.read()
+            self.assertEqual(lines, [(url, line) for line in content.splitlines(keepends=True)])
+            self.assertEqual(content, result.buffer.getvalue())
+
+    def test_parse_lines_stop_early(self):
+        """we stop the transfer once the parser found what it needs"""
+        filename = "maven.apache.org/download.cgi"
+        url = self.build_server_address(filename)
+        parse_lines = Mock(return_value=True)
+        DownloadCenter([DownloadItem(url)], self.callback, download=False, parse_lines=parse_lines)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertEqual(parse_lines.call_count, 1)
+        self.assertLess(len(result.buffer.getvalue()), getsize(join(self.server_dir, filename)))
+        # partial content isn't cached
+        self.assertIsNone(PageCache().get(url))
+
+    def test_parse_lines_with_checksum(self):
+        """we don't stop the transfer if we need to verify its checksum"""
+        filename = "maven.apache.org/download.cgi"
+        url = self.build_server_address(filename)
+        parse_lines = Mock(return_value=True)
+        DownloadCenter([DownloadItem(url, Checksum(ChecksumType.md5, 'e99597c552455736cd6c86d3a1af4db1'))],
+                       self.callback, download=False, parse_lines=parse_lines)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertEqual(parse_lines.call_count, 1)
+        self.assertEqual(len(result.buffer.getvalue()), getsize(join(self.server_dir, filename)))
+
+    def test_parse_lines_from_page_cache(self):
+        """we feed lines of revalidated cached pages too"""
+        url = self.build_server_address("simplefile")
+        DownloadCenter([DownloadItem(url)], self.callback, download=False)
+        self.wait_for_callback(self.callback)
+        self.callback.reset_mock()
+
+        lines = []
+        DownloadCenter([DownloadItem(url)], self.callback, download=False,
+                       parse_lines=lambda line_url, block: lines.extend(block))
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertEqual(lines, result.buffer.getvalue().splitlines(keepends=True))
+
+    def test_parse_lines_restarted(self):
+        """we tell the parser to forget the lines it got when the transfer restarts from the beginning"""
+        url = self.build_server_address("maven.apache.org/download.cgi-interrupted")
+        # this mirror doesn't support resuming
+        mirror_url = self.build_server_address("simplefile-with-no-content-length", localhost=True)
+        lines = []
+        # don't let the ranking skip the failing mirror
+        with patch.object(DownloadCenter, '_rank_mirrors', side_effect=lambda session, urls, *args: urls):
+            DownloadCenter([DownloadItem(url, mirrors=[mirror_url])], self.callback, download=False,
+                           parse_lines=lambda line_url, block: lines.extend(block or [None]))
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertEqual(lines.count(None), 1)
+        self.assertEqual(lines[lines.index(None) + 1:], result.buffer.getvalue().splitlines(keepends=True))
+        self.expect_warn_error = True
+
     def test_content_encoding(self):
         """Ensure we perform (or don't) content decoding properly."""
 
@@ -264,6 +371,27 @@ class TestDownloadCenter(LoggedTestCase):
         self.assertIsNone(result.buffer)
         self.assertIsNone(result.error)
 
+    def test_download_checksum_computed_while_downloading(self):
+        """we don't read again the downloaded file to check its checksum"""
+        filename = "biggerfile"
+        request = self.build_server_address(filename)
+        with patch.object(DownloadCenter, "_update_checksum_from_fd", side_effect=AssertionError("file read again")):
+            DownloadCenter([DownloadItem(request,
+                                         Checksum(ChecksumType.sha256,
+                                                  '0598aa54768194ade580b9806ac98ace43a0310aeceae95762f62491625eee52'))],
+                           self.callback)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIsNone(result.error)
+
+    def test_checksum_for_fd(self):
+        """we can compute checksums of any file object"""
+        with open(join(self.server_dir, "simplefile"), 'rb') as f:
+            self.assertEqual(DownloadCenter.md5_for_fd(f), '268a5059001855fef30b4f95f82044ed')
+            f.seek(0)
+            self.assertEqual(DownloadCenter.sha1_for_fd(f, block_size=5), '0562f08aef399135936d6fb4eb0cc7bc1890d5b4')
+
     def test_download_with_no_checksum_value(self):
         """we deliver one successful download with a checksum type having no value"""
         filename = "simplefile"
@@ -291,10 +419,9 @@ class TestDownloadCenter(LoggedTestCase):
         DownloadCenter([request], self.callback, report=report)
         self.wait_for_callback(self.callback)
 
-        self.assertEqual(report.call_count, 2)
-        self.assertEqual(report.call_args_list,
-                         [call({self.build_server_address(filename): {'size': filesize, 'current': 0}}),
-                          call({self.build_server_address(filename): {'size': filesize, 'current': filesize}})])
+        self.assertEqual(self.progress_reports(report),
+                         [{self.build_server_address(filename): {'size': filesize, 'current': 0}},
+                          {self.build_server_address(filename): {'size': filesize, 'current': filesize}}])
 
     def test_download_with_multiple_progress(self):
         """we deliver multiple progress hooks on bigger files"""
@@ -302,15 +429,593 @@ class TestDownloadCenter(LoggedTestCase):
         filesize = getsize(join(self.server_dir, filename))
         report = CopyingMock()
         request = DownloadItem(self.build_server_address(filename), None)
-        dl_center = DownloadCenter([request], self.callback, report=report)
+        with patchelem(DownloadProgress, 'MIN_INTERVAL', 0):
+            dl_center = DownloadCenter([request], self.callback, report=report)
+            self.wait_for_callback(self.callback)
+
+        self.assertEqual(self.progress_reports(report),
+                         [{self.build_server_address(filename): {'size': filesize, 'current': 0}},
+                          {self.build_server_address(filename): {'size': filesize,
+                                                                 'current': dl_center.BLOCK_SIZE}},
+                          {self.build_server_address(filename): {'size': filesize, 'current': filesize}}])
+        last_progress = report.call_args[0][0][self.build_server_address(filename)]
+        self.assertEqual(last_progress['eta'], 0)
+        self.assertGreater(last_progress['speed'], 0)
+
+    def test_workers_stopped_when_done(self):
+        """we stop download workers once every download is done"""
+        url = self.build_server_address("simplefile")
+        DownloadCenter([DownloadItem(url)], self.callback)
         self.wait_for_callback(self.callback)
 
-        self.assertEqual(report.call_count, 3)
-        self.assertEqual(report.call_args_list,
-                         [call({self.build_server_address(filename): {'size': filesize, 'current': 0}}),
-                          call({self.build_server_address(filename): {'size': filesize,
-                                                                      'current': dl_center.BLOCK_SIZE}}),
-                          call({self.build_server_address(filename): {'size': filesize, 'current': filesize}})])
+        self.assertIsNone(self.callback.call_args[0][0][url].error)
+        self.assertEqual(DownloadScheduler()._workers, [])
+
+    def test_cancel_pending(self):
+        """we report downloads cancelled before they started as errors, and stop workers once running ones are done"""
+        # bulk downloads from the same host beyond max_per_host wait for a running one to be done
+        urls = [self.build_server_address("simplefile?{}".format(i))
+                for i in range(DownloadScheduler().max_per_host + 1)]
+        started = []
+        release = Event()
+
+        def blocked_fetch(download_item, dest):
+            started.append(download_item.url)
+            release.wait(5)
+            return dest, download_item.url, {}
+        # only download threads run blocked fetches
+        with patch.object(AsyncDownloadEngine, 'is_enabled', return_value=False), \
+                patch.object(DownloadCenter, '_fetch', side_effect=blocked_fetch):
+            center = DownloadCenter([DownloadItem(url) for url in urls], self.callback)
+            center.cancel()
+            release.set()
+            self.wait_for_callback(self.callback)
+
+        results = self.callback.call_args[0][0]
+        self.assertLess(len(started), len(urls))
+        for url in urls:
+            self.assertEqual(results[url].error, None if url in started else "Download cancelled")
+        self.assertEqual(DownloadScheduler()._workers, [])
+        self.expect_warn_error = True
+
+    def test_download_with_throttled_progress(self):
+        """we only deliver new and finished downloads progress hooks if they are too frequent"""
+        filename = "biggerfile"
+        filesize = getsize(join(self.server_dir, filename))
+        report = CopyingMock()
+        request = DownloadItem(self.build_server_address(filename), None)
+        with patchelem(DownloadProgress, 'MIN_INTERVAL', 3600):
+            DownloadCenter([request], self.callback, report=report)
+            self.wait_for_callback(self.callback)
+
+        self.assertEqual(self.progress_reports(report),
+                         [{self.build_server_address(filename): {'size': filesize, 'current': 0}},
+                          {self.build_server_address(filename): {'size': filesize, 'current': filesize}}])
+
+    def test_segmented_download(self):
+        """we deliver one successful download fetched in multiple ranges"""
+        filename = "biggerfile"
+        filesize = getsize(join(self.server_dir, filename))
+        url = self.build_server_address(filename)
+        report = CopyingMock()
+        request = DownloadItem(url, Checksum(ChecksumType.md5, '42d69d1a6d333a7ebdf64792a555e392'))
+        with patchelem(DownloadCenter, 'SEGMENT_MIN_SIZE', 1024):
+            DownloadCenter([request], self.callback, report=report)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertEqual(self.callback.call_count, 1)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        self.assertIsNone(result.buffer)
+        self.assertIsNone(result.error)
+        self.assertEqual(self.progress_reports(report)[-1], {url: {'size': filesize, 'current': filesize}})
+
+    def test_segmented_download_fallback_on_encoded_content(self):
+        """we fallback to a single stream if the content is encoded, and so, can't be split"""
+        filename = "www.eclipse.org/technology/epp/downloads/release/version/"\
+                   "point_release/eclipse-java-linux-gtk.tar.gz"
+        url = self.build_server_address(filename + '-setheaders?content-encoding=gzip')
+        request = DownloadItem(url)
+        with patchelem(DownloadCenter, 'SEGMENT_MIN_SIZE', 10):
+            DownloadCenter([request], self.callback)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertEqual(10240, len(result.fd.read()))
+
+    def test_segmented_download_cookies_and_timeout(self):
+        """we send the download cookies and a timeout with every range request"""
+        filename = "biggerfile"
+        url = self.build_server_address(filename)
+        request = DownloadItem(url, Checksum(ChecksumType.md5, '42d69d1a6d333a7ebdf64792a555e392'),
+                               cookies={"foo": "bar"})
+        # only download threads fetch segments
+        with patchelem(DownloadCenter, 'SEGMENT_MIN_SIZE', 1024), \
+                patch.object(AsyncDownloadEngine, 'is_enabled', return_value=False), \
+                patch.object(DownloadCenter, '_get', wraps=DownloadCenter._get) as get:
+            DownloadCenter([request], self.callback)
+            self.wait_for_callback(self.callback)
+
+        self.assertIsNone(self.callback.call_args[0][0][url].error)
+        range_calls = [call for call in get.call_args_list if 'Range' in call[1]['headers']]
+        self.assertEqual(len(range_calls), DownloadCenter.SEGMENTS - 1)
+        for call in range_calls:
+            self.assertEqual(call[1]['cookies'], {"foo": "bar"})
+            self.assertIsNotNone(call[1]['timeout'])
+
+    def test_segmented_download_failover(self):
+        """we carry on from the next mirror, after the content received in order, if a segment fails"""
+        filename = "biggerfile"
+        url = self.build_server_address(filename)
+        mirror_url = self.build_server_address(filename, localhost=True)
+        request = DownloadItem(url, Checksum(ChecksumType.md5, '42d69d1a6d333a7ebdf64792a555e392'),
+                               mirrors=[mirror_url])
+        get = DownloadCenter._get
+
+        def ignore_segment_ranges(session, fetch_url, **kwargs):
+            """The first url answers range requests with an end as if it didn't support them"""
+            r = get(session, fetch_url, **kwargs)
+            if fetch_url == url and kwargs['headers'].get('Range', '').split('-')[-1]:
+                r.status_code = 200
+            return r
+        with patchelem(DownloadCenter, 'SEGMENT_MIN_SIZE', 1024), \
+                patch.object(DownloadCenter, '_rank_mirrors', side_effect=lambda session, urls, *args: urls), \
+                patch.object(DownloadCenter, '_get', side_effect=ignore_segment_ranges) as patched_get:
+            DownloadCenter([request], self.callback)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.fd.read())
+        self.assertEqual(patched_get.call_args[0][1], mirror_url)
+        self.expect_warn_error = True
+
+    def stage_partial_download(self, url, filename, size, validator):
+        """Stage the first size bytes of filename as an interrupted download of url"""
+        partial = PartialDownload(url)
+        with open(join(self.server_dir, filename), 'rb') as f:
+            partial.write(f.read(size))
+        with open(partial.meta_path, 'w') as f:
+            json.dump({"url": url, "validator": validator}, f)
+        partial.resumable = True
+        partial.close()
+
+    def test_resume_download(self):
+        """we resume a previously interrupted download"""
+        filename = "biggerfile"
+        filesize = getsize(join(self.server_dir, filename))
+        url = self.build_server_address(filename)
+        self.stage_partial_download(url, filename, 5000,
+                                    formatdate(int(getmtime(join(self.server_dir, filename))), usegmt=True))
+        report = CopyingMock()
+        DownloadCenter([DownloadItem(url, Checksum(ChecksumType.md5, '42d69d1a6d333a7ebdf64792a555e392'))],
+                       self.callback, report=report)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        self.assertEqual(self.progress_reports(report)[0], {url: {'size': filesize, 'current': 5000}})
+        self.assertEqual(self.progress_reports(report)[-1], {url: {'size': filesize, 'current': filesize}})
+
+        # the staging area is cleaned once the download is consumed
+        result.fd.close()
+        self.assertEqual(os.listdir(PartialDownload.get_staging_dir()), [])
+
+    def test_resume_download_changed_content(self):
+        """we restart from scratch an interrupted download if the remote content changed since then"""
+        filename = "biggerfile"
+        url = self.build_server_address(filename)
+        self.stage_partial_download(url, "simplefile", 12, "Thu, 01 Jan 1970 00:00:00 GMT")
+        DownloadCenter([DownloadItem(url, Checksum(ChecksumType.md5, '42d69d1a6d333a7ebdf64792a555e392'))],
+                       self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+
+    def test_download_kept_resumable_until_done(self):
+        """we stage downloads with their validator while in progress"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        DownloadCenter([DownloadItem(url, None)], self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertEqual(os.path.dirname(result.fd.name), PartialDownload.get_staging_dir())
+        with open(result.fd.meta_path) as f:
+            self.assertEqual(json.load(f)["validator"],
+                             formatdate(int(getmtime(join(self.server_dir, filename))), usegmt=True))
+
+    def test_corrupted_download_not_kept(self):
+        """we discard staged downloads not matching their checksum"""
+        filename = "simplefile"
+        request = self.build_server_address(filename)
+        DownloadCenter([DownloadItem(request, Checksum(ChecksumType.md5, 'AAAAA'))], self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][request]
+        self.assertIn("Corrupted download", result.error)
+        self.assertEqual(os.listdir(PartialDownload.get_staging_dir()), [])
+        self.expect_warn_error = True
+
+    @patch("umake.settings.DEFAULT_ARTIFACT_CACHE_MAX_SIZE", 1024 * 1024 * 1024)
+    def test_download_with_checksum_cached(self):
+        """we store downloads with a checksum in the artifact cache"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        DownloadCenter([DownloadItem(url, Checksum(ChecksumType.md5, '268a5059001855fef30b4f95f82044ed'))],
+                       self.callback)
+        self.wait_for_callback(self.callback)
+
+        self.assertIsNone(self.callback.call_args[0][0][url].error)
+        self.assertEqual(ArtifactCache().stats(), (1, getsize(join(self.server_dir, filename))))
+
+    def test_download_and_extract(self):
+        """we extract tar archives while downloading them, checking their checksum"""
+        filename = join("www.eclipse.org/technology/epp/downloads/release/version/point_release",
+                        "eclipse-java-linux-gtk.tar.gz")
+        url = self.build_server_address(filename)
+        with open(join(self.server_dir, filename + ".sha512")) as f:
+            checksum = Checksum(ChecksumType.sha512, f.read().split()[0])
+        DownloadCenter([DownloadItem(url, checksum)], self.callback, extract=True)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertIsInstance(result.fd, StreamDecompressor)
+        self.assertTrue(os.path.isfile(join(result.fd.name, "eclipse", "java-fake")))
+        self.assertTrue(os.path.isfile(join(result.fd.name, "eclipse", "icon.xpm")))
+
+    def test_download_and_extract_wrong_checksum(self):
+        """we discard extracted content if the archive checksum doesn't match"""
+        filename = join("www.eclipse.org/technology/epp/downloads/release/version/point_release",
+                        "eclipse-java-linux-gtk.tar.gz")
+        url = self.build_server_address(filename)
+        DownloadCenter([DownloadItem(url, Checksum(ChecksumType.md5, 'AAAAA'))], self.callback, extract=True)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIn("Corrupted download", result.error)
+        self.assertIsNone(result.fd)
+        self.assertEqual(os.listdir(join(self.cache_dir, "umake", "extracting")), [])
+        self.expect_warn_error = True
+
+    def test_download_and_extract_restarted(self):
+        """we extract again from the start archives whose download restarts on a mirror which can't resume it"""
+        filename = join("www.eclipse.org/technology/epp/downloads/release/version/point_release",
+                        "eclipse-java-linux-gtk.tar.gz")
+        url = self.build_server_address(filename + "?-interrupted")
+        mirror_url = self.build_server_address(filename + "?-with-no-content-length", localhost=True)
+        with open(join(self.server_dir, filename + ".sha512")) as f:
+            checksum = Checksum(ChecksumType.sha512, f.read().split()[0])
+        with patch.object(DownloadCenter, '_rank_mirrors', side_effect=lambda session, urls, *args: urls), \
+                patch.object(StreamDecompressor, 'can_extract', return_value=True), \
+                patch.object(StreamDecompressor, 'restart', side_effect=StreamDecompressor.restart,
+                             autospec=True) as restart:
+            DownloadCenter([DownloadItem(url, checksum, mirrors=[mirror_url])], self.callback, extract=True)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        restart.assert_called_once_with(result.fd)
+        self.assertTrue(os.path.isfile(join(result.fd.name, "eclipse", "java-fake")))
+        self.expect_warn_error = True
+
+    @patch("umake.settings.DEFAULT_ARTIFACT_CACHE_MAX_SIZE", 1024 * 1024 * 1024)
+    def test_download_and_extract_from_cache(self):
+        """we extract tar archives from the artifact cache"""
+        filename = join("www.eclipse.org/technology/epp/downloads/release/version/point_release",
+                        "eclipse-java-linux-gtk.tar.gz")
+        url = self.build_server_address(filename)
+        with open(join(self.server_dir, filename + ".sha512")) as f:
+            checksum = Checksum(ChecksumType.sha512, f.read().split()[0])
+        DownloadCenter([DownloadItem(url, checksum)], self.callback)
+        self.wait_for_callback(self.callback)
+        self.callback.reset_mock()
+
+        with patch("umake.network.download_center.SessionPool.new_session") as new_session:
+            DownloadCenter([DownloadItem(url, checksum)], self.callback, extract=True)
+            self.wait_for_callback(self.callback)
+            self.assertFalse(new_session.called)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertTrue(os.path.isfile(join(result.fd.name, "eclipse", "java-fake")))
+
+    def test_download_not_extracted(self):
+        """we only extract tar archives while downloading them"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        DownloadCenter([DownloadItem(url)], self.callback, extract=True)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertNotIsInstance(result.fd, StreamDecompressor)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.fd.read())
+
+    def test_download_from_fastest_mirror(self):
+        """we download from available mirrors, results being still keyed by the main url"""
+        filename = "biggerfile"
+        url = self.build_server_address("does_not_exist")
+        mirror_url = self.build_server_address(filename)
+        request = DownloadItem(url, Checksum(ChecksumType.md5, '42d69d1a6d333a7ebdf64792a555e392'),
+                               mirrors=[mirror_url])
+        DownloadCenter([request], self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.final_url, mirror_url)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+
+    def test_download_mirror_failover(self):
+        """we resume the download from the next mirror if the current one fails"""
+        filename = "biggerfile"
+        url = self.build_server_address(filename + "-interrupted")
+        mirror_url = self.build_server_address(filename, localhost=True)
+        request = DownloadItem(url, Checksum(ChecksumType.md5, '42d69d1a6d333a7ebdf64792a555e392'),
+                               mirrors=[mirror_url])
+        # don't let the ranking skip the failing mirror
+        with patch.object(DownloadCenter, '_rank_mirrors', side_effect=lambda session, urls, *args: urls):
+            DownloadCenter([request], self.callback)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.final_url, mirror_url)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        self.expect_warn_error = True
+
+    def test_download_retried_on_server_error(self):
+        """we retry downloads failing with a server error"""
+        filename = "simplefile"
+        url = self.build_server_address(filename + "-unavailable-once")
+        DownloadCenter([DownloadItem(url)], self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        self.expect_warn_error = True
+
+    def test_download_retried_from_last_byte(self):
+        """we resume interrupted downloads from the same url"""
+        filename = "biggerfile"
+        url = self.build_server_address(filename + "-interrupted-once")
+        report = CopyingMock()
+        DownloadCenter([DownloadItem(url, Checksum(ChecksumType.md5, '42d69d1a6d333a7ebdf64792a555e392'))],
+                       self.callback, report=report)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        # progress never went back to start over
+        progresses = [progress[url]['current'] for progress in self.progress_reports(report)]
+        self.assertEqual(progresses, sorted(progresses))
+        self.expect_warn_error = True
+
+    def test_download_retries_exhausted(self):
+        """we give up on downloads still failing after a few retries"""
+        url = self.build_server_address("simplefile-unavailable")
+        DownloadCenter([DownloadItem(url)], self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIn("503", result.error)
+        self.assertIsNone(result.fd)
+        self.expect_warn_error = True
+
+    def test_download_from_host_down(self):
+        """we fail right away on hosts which failed too many times in a row"""
+        url = self.build_server_address("simplefile")
+        for i in range(CircuitBreaker.FAILURES):
+            CircuitBreaker().record_failure(url)
+        DownloadCenter([DownloadItem(url)], self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIn("failed too many times", result.error)
+        self.expect_warn_error = True
+
+    def test_download_from_host_down_fails_over(self):
+        """we download from mirrors when the main host is down"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        # same server, other host
+        mirror_url = "http://127.0.0.1:{}/{}".format(self.server.port, filename)
+        for i in range(CircuitBreaker.FAILURES):
+            CircuitBreaker().record_failure(url)
+        DownloadCenter([DownloadItem(url, mirrors=[mirror_url])], self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.final_url, mirror_url)
+        self.expect_warn_error = True
+
+    def rewrite_config(self, rules, fallback=True):
+        """Return a patcher for download urls to be rewritten following rules"""
+        config_handler = patch("umake.network.url_rewriter.ConfigHandler")
+        config_handler.start().return_value.config = {"download": {"rewrite": rules, "rewrite_fallback": fallback}}
+        self.addCleanup(config_handler.stop)
+
+    def test_download_rewritten_url(self):
+        """we download from urls rewritten to a local mirror"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        self.rewrite_config([{"prefix": self.build_server_address(""), "to": "file://{}/".format(self.server_dir)}])
+        DownloadCenter([DownloadItem(url)], self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.final_url, "file://{}".format(join(self.server_dir, filename)))
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.fd.read())
+
+    def test_download_rewritten_url_regex(self):
+        """we download from urls rewritten with regexes"""
+        url = self.build_server_address("simplefile")
+        self.rewrite_config([{"regex": "/simple(file)$", "to": r"/bigger\1"}])
+        DownloadCenter([DownloadItem(url)], self.callback, download=False)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertEqual(result.final_url, self.build_server_address("biggerfile"))
+        with open(join(self.server_dir, "biggerfile"), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.buffer.getvalue())
+
+    def test_download_rewritten_url_fallback(self):
+        """we fall back to the upstream url if the rewritten one fails"""
+        url = self.build_server_address("simplefile")
+        self.rewrite_config([{"prefix": self.build_server_address(""), "to": "file:///doesnt/exist/"}])
+        DownloadCenter([DownloadItem(url)], self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.final_url, url)
+        self.expect_warn_error = True
+
+    def test_download_rewritten_url_no_fallback(self):
+        """we don't fall back to the upstream url if disabled"""
+        url = self.build_server_address("simplefile")
+        self.rewrite_config([{"prefix": self.build_server_address(""), "to": "file:///doesnt/exist/"}],
+                            fallback=False)
+        DownloadCenter([DownloadItem(url)], self.callback)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIn("404", result.error)
+        self.expect_warn_error = True
+
+    def test_download_all_mirrors_fail(self):
+        """we return an error if every mirror fails"""
+        url = self.build_server_address("biggerfile-interrupted")
+        request = DownloadItem(url, mirrors=[self.build_server_address("biggerfile-interrupted", localhost=True)])
+        with patch.object(DownloadCenter, '_rank_mirrors', side_effect=lambda session, urls, *args: urls):
+            DownloadCenter([request], self.callback)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNotNone(result.error)
+        self.assertIsNone(result.fd)
+        self.expect_warn_error = True
+
+    def test_page_revalidated(self):
+        """we reuse cached pages if the server tells us they didn't change"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        DownloadCenter([DownloadItem(url)], self.callback, download=False)
+        self.wait_for_callback(self.callback)
+        # the server will answer 304, so we get the cached content back, whatever it is
+        cached_path = join(PageCache().path, PageCache.key_for(url))
+        with open(cached_path, 'wb') as f:
+            f.write(b"cached content")
+        self.callback.reset_mock()
+
+        DownloadCenter([DownloadItem(url)], self.callback, download=False)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertEqual(result.buffer.getvalue(), b"cached content")
+        self.assertEqual(result.final_url, url)
+
+    @patch("umake.settings.DEFAULT_MAX_BUFFER_SIZE", 10)
+    def test_page_on_disk_revalidated(self):
+        """we cache and reuse pages bigger than the in memory buffer"""
+        filename = "maven.apache.org/download.cgi"
+        url = self.build_server_address(filename)
+        DownloadCenter([DownloadItem(url)], self.callback, download=False)
+        self.wait_for_callback(self.callback)
+        self.assertTrue(self.callback.call_args[0][0][url].buffer._rolled)
+        self.callback.reset_mock()
+
+        DownloadCenter([DownloadItem(url)], self.callback, download=False)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.buffer.getvalue())
+
+    def test_page_changed_since_cached(self):
+        """we fetch again cached pages which changed on the server"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        DownloadCenter([DownloadItem(url)], self.callback, download=False)
+        self.wait_for_callback(self.callback)
+        cached_path = join(PageCache().path, PageCache.key_for(url))
+        with open(cached_path, 'wb') as f:
+            f.write(b"cached content")
+        with open(cached_path + ".json") as f:
+            meta = json.load(f)
+        meta["last_modified"] = formatdate(0, usegmt=True)
+        with open(cached_path + ".json", 'w') as f:
+            json.dump(meta, f)
+        self.callback.reset_mock()
+
+        DownloadCenter([DownloadItem(url)], self.callback, download=False)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(), result.buffer.getvalue())
+            # the cache is updated
+            file_on_disk.seek(0)
+            with open(cached_path, 'rb') as f:
+                self.assertEqual(file_on_disk.read(), f.read())
+
+    def test_download_not_in_page_cache(self):
+        """we don't store downloaded files in the page cache"""
+        url = self.build_server_address("simplefile")
+        DownloadCenter([DownloadItem(url)], self.callback)
+        self.wait_for_callback(self.callback)
+
+        self.assertIsNone(PageCache().get(url))
+
+    @patch("umake.settings.DEFAULT_ARTIFACT_CACHE_MAX_SIZE", 1024 * 1024 * 1024)
+    def test_download_from_cache(self):
+        """we deliver cached artifacts matching the checksum without any network access"""
+        filename = "simplefile"
+        # this url doesn't exist, the content can only come from the cache
+        url = self.build_server_address("does_not_exist.tgz")
+        ArtifactCache().add("md5-268a5059001855fef30b4f95f82044ed", join(self.server_dir, filename))
+        report = CopyingMock()
+        DownloadCenter([DownloadItem(url, Checksum(ChecksumType.md5, '268a5059001855fef30b4f95f82044ed'))],
+                       self.callback, report=report)
+        self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            self.assertEqual(file_on_disk.read(),
+                             result.fd.read())
+        self.assertTrue(result.fd.name.endswith('.tgz'), result.fd.name)
+        self.assertEqual(self.progress_reports(report), [{url: {'size': 12, 'current': 12}}])
 
     def test_multiple_downloads(self):
         """we deliver more than on download in parallel"""
@@ -336,8 +1041,9 @@ class TestDownloadCenter(LoggedTestCase):
         requests = [DownloadItem(self.build_server_address("biggerfile"), None),
                     DownloadItem(self.build_server_address("simplefile"), None)]
         report = CopyingMock()
-        DownloadCenter(requests, self.callback, report=report)
-        self.wait_for_callback(self.callback)
+        with patchelem(DownloadProgress, 'MIN_INTERVAL', 0):
+            DownloadCenter(requests, self.callback, report=report)
+            self.wait_for_callback(self.callback)
 
         self.assertEqual(report.call_count, 5)
         # ensure that first call only contains one file
@@ -350,7 +1056,7 @@ class TestDownloadCenter(LoggedTestCase):
             file_size = getsize(join(self.server_dir, filename))
             result_dict[self.build_server_address(filename)] = {'size': file_size,
                                                                 'current': file_size}
-        self.assertEqual(report.call_args, call(result_dict))
+        self.assertEqual(self.progress_reports(report)[-1], result_dict)
         self.assertEqual(self.callback.call_count, 1, "Global done callback is only called once")
 
     def test_404_url(self):
@@ -402,6 +1108,47 @@ class TestDownloadCenter(LoggedTestCase):
         self.assertIsNone(result.fd)
         self.assertIsNone(result.error)
 
+    def test_trace(self):
+        """we record the timings of each download phase, along with redirections and bytes received"""
+        filename = "simplefile"
+        url = self.build_server_address(filename + "-redirect")
+        trace_path = join(self.cache_dir, "trace.jsonl")
+        TraceWriter().path = trace_path
+        self.addCleanup(Singleton._instances.pop, TraceWriter, None)
+        DownloadCenter([DownloadItem(url, Checksum(ChecksumType.md5, "268a5059001855fef30b4f95f82044ed"))],
+                       self.callback)
+        self.wait_for_callback(self.callback)
+
+        trace = self.callback.call_args[0][0][url].trace
+        self.assertEqual(trace.url, url)
+        self.assertEqual(trace.final_url, self.build_server_address(filename))
+        self.assertEqual(trace.redirects, [url])
+        self.assertEqual(trace.status, 200)
+        self.assertEqual(trace.bytes, getsize(join(self.server_dir, filename)))
+        self.assertEqual(set(trace.timings), set(RequestTrace.PHASES))
+        self.assertAlmostEqual(sum(trace.timings.values()), trace.total)
+        self.assertGreater(trace.timings["ttfb"], 0)
+        with open(trace_path) as f:
+            self.assertEqual([json.loads(line) for line in f], [trace.to_dict()])
+
+    def test_big_in_memory_download_spooled(self):
+        """we move in memory downloads bigger than the configured limit to disk"""
+        filename = "simplefile"
+        url = self.build_server_address(filename)
+        with patch("umake.network.download_center.ConfigHandler") as config_handler:
+            config_handler.return_value.config = {"download": {"max_buffer_size": 10}}
+            DownloadCenter([DownloadItem(url, None)], self.callback, download=False)
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertIsNone(result.error)
+        self.assertTrue(result.buffer._rolled)
+        with open(join(self.server_dir, filename), 'rb') as file_on_disk:
+            content = file_on_disk.read()
+        self.assertEqual(content, result.buffer.read())
+        self.assertEqual(content, result.buffer.getvalue())
+        self.assertEqual(result.buffer.readlines(), [])
+
     def test_unsupported_protocol(self):
         """Raises an exception when trying to download for an unsupported protocol"""
         filename = "simplefile"
@@ -472,10 +1219,9 @@ class TestDownloadCenter(LoggedTestCase):
                              result.fd.read())
         self.assertIsNone(result.buffer)
         self.assertIsNone(result.error)
-        self.assertEqual(report.call_count, 2)
-        self.assertEqual(report.call_args_list,
-                         [call({self.build_server_address(filename): {'size': -1, 'current': 0}}),
-                          call({self.build_server_address(filename): {'size': -1, 'current': 8192}})])
+        self.assertEqual(self.progress_reports(report),
+                         [{self.build_server_address(filename): {'size': -1, 'current': 0}},
+                          {self.build_server_address(filename): {'size': -1, 'current': 12}}])
 
     def test_download_with_wrong_checksumtype(self):
         """we raise an error if we don't have a support checksum type"""
@@ -494,6 +1240,152 @@ class TestDownloadCenter(LoggedTestCase):
         self.expect_warn_error = True
 
 
+class TestSessionPool(LoggedTestCase):
+    """This will test sessions sharing connection pools"""
+
+    def test_sessions_share_connections(self):
+        """Every session uses the same http(s) connection pools"""
+        session1 = SessionPool().new_session()
+        session2 = SessionPool().new_session()
+        self.assertIsNot(session1, session2)
+        self.assertIs(session1.get_adapter("http://foo"), session2.get_adapter("http://bar"))
+        self.assertIs(session1.get_adapter("https://foo"), session2.get_adapter("http://foo"))
+
+    def test_pools_never_block(self):
+        """We open a new connection rather than waiting for a free one, and keep as many as downloads can use"""
+        adapter = SessionPool().new_session().get_adapter("http://foo")
+        self.assertFalse(adapter._pool_block)
+        self.assertEqual(adapter._pool_maxsize, DownloadScheduler().max_workers * (DownloadCenter.SEGMENTS + 1))
+
+    def test_sessions_dont_share_cookies(self):
+        """Cookies set in one session aren't seen by others"""
+        session1 = SessionPool().new_session()
+        session1.cookies.set("foo", "bar")
+        self.assertIsNone(SessionPool().new_session().cookies.get("foo"))
+
+    def test_ftp_adapter(self):
+        """Sessions can download over ftp"""
+        from umake.network.ftp_adapter import FTPAdapter
+        self.assertIsInstance(SessionPool().new_session().get_adapter("ftp://foo"), FTPAdapter)
+
+    def test_file_adapter(self):
+        """Sessions can read local files"""
+        from umake.network.file_adapter import FileAdapter
+        self.assertIsInstance(SessionPool().new_session().get_adapter("file:///foo"), FileAdapter)
+
+
+class TestFileAdapter(LoggedTestCase):
+    """This will test serving local files"""
+
+    def setUp(self):
+        super().setUp()
+        self.session = SessionPool().new_session()
+        self.path = join(get_data_dir(), "server-content", "simplefile")
+        self.url = "file://{}".format(self.path)
+        with open(self.path, 'rb') as f:
+            self.content = f.read()
+
+    def test_get(self):
+        """We get local file content and its size"""
+        r = self.session.get(self.url)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, self.content)
+        self.assertEqual(int(r.headers["content-length"]), len(self.content))
+
+    def test_stream(self):
+        """We stream local file content"""
+        r = self.session.get(self.url, stream=True)
+        self.assertEqual(b"".join(DownloadCenter._iter_blocks(r.raw, decode_content=True)), self.content)
+        r.close()
+
+    def test_missing_file(self):
+        """We get a 404 for missing files"""
+        self.assertEqual(self.session.get("file:///doesnt/exist").status_code, 404)
+
+    def test_range(self):
+        """We get partial content for range requests"""
+        r = self.session.get(self.url, headers={"Range": "bytes=2-4"})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.content, self.content[2:5])
+        self.assertEqual(r.headers["content-range"], "bytes 2-4/{}".format(len(self.content)))
+
+        r = self.session.get(self.url, headers={"Range": "bytes=2-"})
+        self.assertEqual(r.content, self.content[2:])
+
+        r = self.session.get(self.url, headers={"Range": "bytes={}-".format(len(self.content))})
+        self.assertEqual(r.status_code, 416)
+
+    def test_range_changed_content(self):
+        """We get the whole content if it changed since the If-Range date"""
+        r = self.session.get(self.url, headers={"Range": "bytes=2-", "If-Range": "Thu, 01 Jan 1970 00:00:00 GMT"})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, self.content)
+
+    def test_not_modified(self):
+        """We get a 304 for content which didn't change"""
+        last_modified = self.session.get(self.url).headers["last-modified"]
+        r = self.session.get(self.url, headers={"If-Modified-Since": last_modified})
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.content, b"")
+
+
+class TestIterBlocks(LoggedTestCase):
+    """This will test the adaptive chunking of streamed content"""
+
+    class FakeRaw:
+        """Raw response content of size bytes, recording requested chunk sizes"""
+
+        def __init__(self, size):
+            self.remaining = size
+            self.closed = False
+            self.requested = []
+
+        def read(self, amt, decode_content):
+            self.requested.append(amt)
+            data = b'a' * min(amt, self.remaining)
+            self.remaining -= len(data)
+            if not data:
+                self.closed = True
+            return data
+
+    def test_block_size_grows(self):
+        """We read bigger chunks on fast connections, up to MAX_BLOCK_SIZE"""
+        raw = self.FakeRaw(DownloadCenter.MAX_BLOCK_SIZE * 4)
+        content = b''.join(DownloadCenter._iter_blocks(raw, decode_content=True))
+
+        self.assertEqual(len(content), DownloadCenter.MAX_BLOCK_SIZE * 4)
+        self.assertEqual(raw.requested[:3], [DownloadCenter.BLOCK_SIZE, DownloadCenter.BLOCK_SIZE * 2,
+                                             DownloadCenter.BLOCK_SIZE * 4])
+        self.assertEqual(max(raw.requested), DownloadCenter.MAX_BLOCK_SIZE)
+
+    def test_block_size_shrinks(self):
+        """We read smaller chunks again once the connection slows down"""
+        raw = self.FakeRaw(DownloadCenter.BLOCK_SIZE * 10)
+        # first 3 reads are fast, next ones are slow
+        times = iter([0, 0, 0, 0, 0, 0] + [i * 10 for i in range(20)])
+        with patch("umake.network.download_center.time.monotonic", side_effect=lambda: next(times)):
+            b''.join(DownloadCenter._iter_blocks(raw, decode_content=True))
+
+        self.assertEqual(raw.requested[:5], [DownloadCenter.BLOCK_SIZE, DownloadCenter.BLOCK_SIZE * 2,
+                                             DownloadCenter.BLOCK_SIZE * 4, DownloadCenter.BLOCK_SIZE * 8,
+                                             DownloadCenter.BLOCK_SIZE * 4])
+
+    def test_limit(self):
+        """We never read past the limit"""
+        raw = self.FakeRaw(DownloadCenter.BLOCK_SIZE * 10)
+        content = b''.join(DownloadCenter._iter_blocks(raw, decode_content=True, limit=DownloadCenter.BLOCK_SIZE * 3))
+
+        self.assertEqual(len(content), DownloadCenter.BLOCK_SIZE * 3)
+        self.assertEqual(raw.requested, [DownloadCenter.BLOCK_SIZE, DownloadCenter.BLOCK_SIZE * 2])
+
+    def test_stream_only_raw(self):
+        """We stream fixed chunks from raw content not supporting reads"""
+        raw = Mock(spec=['stream'])
+        raw.stream.return_value = iter([b'foo', b'bar'])
+        self.assertEqual(list(DownloadCenter._iter_blocks(raw, decode_content=False)), [b'foo', b'bar'])
+        raw.stream.assert_called_once_with(amt=DownloadCenter.BLOCK_SIZE, decode_content=False)
+
+
 class TestDownloadCenterSecure(LoggedTestCase):
     """This will test the download center in secure mode by sending one or more download requests"""
 
@@ -514,11 +1406,15 @@ class TestDownloadCenterSecure(LoggedTestCase):
         super().setUp()
         self.callback = Mock()
         self.fd_to_close = []
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
 
     def tearDown(self):
         super().tearDown()
         for fd in self.fd_to_close:
             fd.close()
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
 
     def test_download(self):
         """we deliver one successful download under ssl with known cert"""
@@ -578,3 +1474,74 @@ class TestDownloadCenterSecure(LoggedTestCase):
         self.assertIsNone(result.buffer)
         self.assertIsNone(result.fd)
         self.expect_warn_error = True
+
+
+class TestAsyncDownloadCenter(TestDownloadCenter):
+    """This will run the download center tests again, fetching through the asyncio engine"""
+
+    def setUp(self):
+        super().setUp()
+        config_handler = patch("umake.network.async_engine.ConfigHandler")
+        config_handler.start().return_value.config = {"download": {"engine": "asyncio"}}
+        self.addCleanup(config_handler.stop)
+
+    def test_download_through_engine(self):
+        """we fetch plain http downloads on the event loop, not in download threads"""
+        url = self.build_server_address("simplefile")
+        with patch.object(DownloadScheduler, "submit", wraps=DownloadScheduler().submit) as submit:
+            DownloadCenter([DownloadItem(url)], self.callback)
+            self.wait_for_callback(self.callback)
+
+        self.assertIsNone(self.callback.call_args[0][0][url].error)
+        submit.assert_not_called()
+
+    def test_mirrors_downloaded_in_threads(self):
+        """we leave downloads with mirrors to download threads"""
+        url = self.build_server_address("simplefile")
+        with patch.object(DownloadScheduler, "submit", wraps=DownloadScheduler().submit) as submit:
+            DownloadCenter([DownloadItem(url, mirrors=[url])], self.callback)
+            self.wait_for_callback(self.callback)
+
+        self.assertIsNone(self.callback.call_args[0][0][url].error)
+        self.assertEqual(submit.call_count, 1)
+
+    def test_cancel(self):
+        """we report cancelled downloads as errors"""
+        url = self.build_server_address("simplefile")
+
+        async def never_answer(*args, **kwargs):
+            await asyncio.sleep(60)
+        with patch.object(AsyncDownloadEngine, "get", side_effect=never_answer):
+            DownloadCenter([DownloadItem(url)], self.callback)
+            AsyncDownloadEngine().cancel()
+            self.wait_for_callback(self.callback)
+
+        result = self.callback.call_args[0][0][url]
+        self.assertEqual(result.error, "Download cancelled")
+        self.assertIsNone(result.fd)
+        self.expect_warn_error = True
+
+    def test_cancel_keeps_partial_download(self):
+        """we keep what cancelled downloads received in the staging area, to resume them later on"""
+        url = self.build_server_address("biggerfile")
+        written = Event()
+        cancelled = Event()
+
+        def write_block(dest, hasher, data):
+            dest.write(data)
+            written.set()
+            cancelled.wait(5)
+        with patch.object(DownloadCenter, "_write_block", side_effect=write_block):
+            DownloadCenter([DownloadItem(url)], self.callback)
+            self.assertTrue(written.wait(5))
+            AsyncDownloadEngine().cancel()
+            # only let the write finish once the transfer is cancelled
+            AsyncDownloadEngine()._loop.call_soon_threadsafe(cancelled.set)
+            self.wait_for_callback(self.callback)
+
+        self.assertEqual(self.callback.call_args[0][0][url].error, "Download cancelled")
+        partial = PartialDownload(url)
+        self.addCleanup(partial.close)
+        self.assertGreater(os.path.getsize(partial.name), 0)
+        self.assertIsNotNone(partial.validator)
+        self.expect_warn_error = True
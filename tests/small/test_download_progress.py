@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the download progress aggregation"""
+
+from unittest.mock import patch
+from ..tools import CopyingMock, LoggedTestCase
+from umake.network.download_progress import DownloadProgress
+
+
+class TestDownloadProgress(LoggedTestCase):
+    """This will test throttling and throughput computation of download progress"""
+
+    def setUp(self):
+        super().setUp()
+        self.now = 100
+        monotonic_patcher = patch("umake.network.download_progress.time.monotonic", side_effect=lambda: self.now)
+        monotonic_patcher.start()
+        self.addCleanup(monotonic_patcher.stop)
+        self.report = CopyingMock()
+        self.progress = DownloadProgress(self.report)
+
+    def test_new_download_reported(self):
+        """We always report new downloads"""
+        self.progress.update("http://foo", 0, 100)
+        self.progress.update("http://bar", 0, 100)
+        self.assertEqual(self.report.call_count, 2)
+        self.assertEqual(self.report.call_args[0][0]["http://bar"],
+                         {"current": 0, "size": 100, "speed": 0, "eta": None})
+
+    def test_throttle(self):
+        """We don't report more often than MIN_INTERVAL, but always report finished downloads"""
+        self.progress.update("http://foo", 0, 100)
+        self.now += DownloadProgress.MIN_INTERVAL / 2
+        self.progress.update("http://foo", 10, 100)
+        self.assertEqual(self.report.call_count, 1)
+        self.now += DownloadProgress.MIN_INTERVAL
+        self.progress.update("http://foo", 20, 100)
+        self.assertEqual(self.report.call_count, 2)
+        self.progress.update("http://foo", 100, 100)
+        self.assertEqual(self.report.call_count, 3)
+        self.assertEqual(self.report.call_args[0][0]["http://foo"]["current"], 100)
+
+    def test_flush(self):
+        """We report throttled progress on flush, and only once"""
+        self.progress.update("http://foo", 0, -1)
+        self.progress.update("http://foo", 10, -1)
+        self.progress.flush()
+        self.progress.flush()
+        self.assertEqual(self.report.call_count, 2)
+        self.assertEqual(self.report.call_args[0][0]["http://foo"]["current"], 10)
+
+    def test_current_clipped_to_size(self):
+        """Current size never goes past the total size"""
+        self.progress.update("http://foo", 150, 100)
+        self.assertEqual(self.report.call_args[0][0]["http://foo"]["current"], 100)
+
+    def test_speed_and_eta(self):
+        """We compute speed and eta of each download and of all of them"""
+        self.progress.update("http://foo", 0, 1000)
+        self.progress.update("http://bar", 0, 2000)
+        self.now += 2
+        self.progress.update("http://foo", 200, 1000)
+        self.progress.update("http://bar", 600, 2000)
+        self.progress.flush()
+
+        report = self.report.call_args[0][0]
+        self.assertEqual(report["http://foo"]["speed"], 100)
+        self.assertEqual(report["http://foo"]["eta"], 8)
+        self.assertEqual(report["http://bar"]["speed"], 300)
+        self.assertEqual(report["http://bar"]["eta"], 1400 / 300)
+        self.assertEqual(report.speed, 400)
+        self.assertEqual(report.eta, 2200 / 400)
+
+    def test_speed_ignore_resumed_content(self):
+        """Content already downloaded before resuming doesn't count in the speed"""
+        self.progress.update("http://foo", 500, 1000)
+        self.now += 1
+        self.progress.update("http://foo", 600, 1000)
+        self.assertEqual(self.report.call_args[0][0]["http://foo"]["speed"], 100)
+
+    def test_no_eta_without_size(self):
+        """We can't compute any eta for downloads without size"""
+        self.progress.update("http://foo", 0, -1)
+        self.progress.update("http://bar", 0, 100)
+        self.now += 1
+        self.progress.update("http://foo", 50, -1)
+        self.progress.update("http://bar", 50, 100)
+        self.progress.flush()
+
+        report = self.report.call_args[0][0]
+        self.assertIsNone(report["http://foo"]["eta"])
+        self.assertEqual(report["http://bar"]["eta"], 1)
+        self.assertEqual(report.speed, 100)
+        self.assertIsNone(report.eta)
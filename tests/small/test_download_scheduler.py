@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the download scheduler"""
+
+from concurrent import futures
+from contextlib import suppress
+from threading import Event, Lock
+from time import sleep, time
+from ..tools import LoggedTestCase
+from umake.network.download_scheduler import DownloadScheduler
+from umake.tools import Singleton
+
+
+class TestDownloadScheduler(LoggedTestCase):
+    """This will test the scheduling order and limits of downloads"""
+
+    def setUp(self):
+        super().setUp()
+        with suppress(KeyError):
+            Singleton._instances.pop(DownloadScheduler)
+        self.scheduler = DownloadScheduler()
+        self.release = Event()
+        self.lock = Lock()
+        self.running = 0
+        self.max_running = 0
+        self.order = []
+
+    def tearDown(self):
+        self.release.set()
+        self.scheduler.shutdown()
+        Singleton._instances.pop(DownloadScheduler)
+        super().tearDown()
+
+    def job(self, name):
+        """A job recording its execution order and how many jobs ran at once, blocked until release is set"""
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        self.release.wait()
+        with self.lock:
+            self.running -= 1
+            self.order.append(name)
+        return name
+
+    def wait_running(self, num_jobs, timeout=5):
+        """Wait for num_jobs to be running"""
+        deadline = time() + timeout
+        while self.running < num_jobs and time() < deadline:
+            sleep(0.01)
+
+    def test_result(self):
+        """We get job results through futures"""
+        self.release.set()
+        future = self.scheduler.submit(DownloadScheduler.BULK, "http://foo/bar", self.job, "foo")
+        self.assertEqual(future.result(timeout=5), "foo")
+
+    def test_exception(self):
+        """We get job exceptions through futures"""
+        def failing_job():
+            raise BaseException("failed")
+        future = self.scheduler.submit(DownloadScheduler.METADATA, "http://foo/bar", failing_job)
+        with self.assertRaisesRegex(BaseException, "failed"):
+            future.result(timeout=5)
+
+    def test_singleton(self):
+        """The scheduler is shared by the whole process"""
+        self.assertIs(DownloadScheduler(), self.scheduler)
+
+    def test_metadata_first(self):
+        """Metadata jobs run before pending bulk jobs"""
+        self.scheduler.max_workers = 1
+        blocking = self.scheduler.submit(DownloadScheduler.BULK, "http://foo/blocking", self.job, "blocking")
+        self.wait_running(1)
+        bulk = self.scheduler.submit(DownloadScheduler.BULK, "http://foo/bulk", self.job, "bulk")
+        metadata = self.scheduler.submit(DownloadScheduler.METADATA, "http://foo/page", self.job, "metadata")
+        self.release.set()
+        futures.wait([blocking, bulk, metadata], timeout=5)
+
+        self.assertEqual(self.order, ["blocking", "metadata", "bulk"])
+
+    def test_max_workers(self):
+        """We never run more jobs than the maximum number of workers"""
+        self.scheduler.max_workers = 3
+        jobs = [self.scheduler.submit(DownloadScheduler.METADATA, "http://foo{}/".format(i), self.job, i)
+                for i in range(6)]
+        futures.wait(jobs, timeout=0.5)
+        self.assertEqual(self.max_running, 3)
+        self.release.set()
+        futures.wait(jobs, timeout=5)
+        self.assertEqual(sorted(self.order), list(range(6)))
+        self.assertEqual(len(self.scheduler._workers), 3)
+
+    def test_metadata_not_waiting_behind_bulk(self):
+        """Metadata jobs have workers reserved, even if bulk jobs are all running"""
+        self.scheduler.max_workers = 4
+        self.scheduler.max_bulk_workers = 2
+        bulk = [self.scheduler.submit(DownloadScheduler.BULK, "http://foo{}/".format(i), self.job, i)
+                for i in range(4)]
+        metadata = self.scheduler.submit(DownloadScheduler.METADATA, "http://foo/page", lambda: "metadata")
+
+        self.assertEqual(metadata.result(timeout=5), "metadata")
+        self.assertEqual(self.max_running, 2)
+        self.release.set()
+        futures.wait(bulk, timeout=5)
+
+    def test_max_per_host(self):
+        """We don't run more bulk jobs on the same host than the limit"""
+        self.scheduler.max_per_host = 1
+        same_host = [self.scheduler.submit(DownloadScheduler.BULK, "http://foo/{}".format(i), self.job, i)
+                     for i in range(2)]
+        other_host = self.scheduler.submit(DownloadScheduler.BULK, "http://bar/", self.job, "other")
+        futures.wait(same_host + [other_host], timeout=0.5)
+        self.assertEqual(self.max_running, 2)
+        self.release.set()
+        futures.wait(same_host + [other_host], timeout=5)
+        self.assertEqual(len(self.order), 3)
+
+    def test_shutdown_cancel_pending(self):
+        """Shutting down cancels pending jobs and stops workers"""
+        self.scheduler.max_workers = 1
+        running = self.scheduler.submit(DownloadScheduler.BULK, "http://foo/", self.job, "running")
+        self.wait_running(1)
+        pending = self.scheduler.submit(DownloadScheduler.BULK, "http://foo/", self.job, "pending")
+        workers = list(self.scheduler._workers)
+        self.assertTrue(self.scheduler.shutdown(wait=False))
+        self.release.set()
+
+        self.assertTrue(pending.cancelled())
+        self.assertEqual(running.result(timeout=5), "running")
+        for worker in workers:
+            worker.join(timeout=5)
+            self.assertFalse(worker.is_alive())
+        self.assertEqual(self.scheduler._workers, [])
+
+    def test_restart_after_shutdown(self):
+        """Jobs submitted after a shutdown start new workers"""
+        self.release.set()
+        self.scheduler.submit(DownloadScheduler.BULK, "http://foo/", self.job, "first").result(timeout=5)
+        self.scheduler.shutdown()
+
+        future = self.scheduler.submit(DownloadScheduler.BULK, "http://foo/", self.job, "second")
+        self.assertEqual(future.result(timeout=5), "second")
+        self.assertEqual(len(self.scheduler._workers), 1)
+
+    def test_shutdown_only_if_idle(self):
+        """We don't stop workers with running or pending jobs if only asked to stop idle ones"""
+        self.scheduler.max_workers = 1
+        running = self.scheduler.submit(DownloadScheduler.BULK, "http://foo/", self.job, "running")
+        self.wait_running(1)
+        pending = self.scheduler.submit(DownloadScheduler.BULK, "http://foo/", self.job, "pending")
+
+        self.assertFalse(self.scheduler.shutdown(wait=False, only_if_idle=True))
+        self.release.set()
+        futures.wait([running, pending], timeout=5)
+        self.assertEqual(pending.result(), "pending")
+        workers = list(self.scheduler._workers)
+        self.assertTrue(self.scheduler.shutdown(only_if_idle=True))
+        for worker in workers:
+            self.assertFalse(worker.is_alive())
+
+    def test_shutdown_from_job_callback(self):
+        """Jobs are over by the time their future is done, so that its callbacks can stop idle workers"""
+        self.release.set()
+        stopped = []
+        future = self.scheduler.submit(DownloadScheduler.BULK, "http://foo/", self.job, "job")
+        future.add_done_callback(lambda future: stopped.append(self.scheduler.shutdown(only_if_idle=True)))
+        future.result(timeout=5)
+        deadline = time() + 5
+        while not stopped and time() < deadline:
+            sleep(0.01)
+
+        self.assertEqual(stopped, [True])
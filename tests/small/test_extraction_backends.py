@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the extraction backends"""
+
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+from unittest.mock import patch
+from ..tools import get_data_dir, LoggedTestCase
+from umake.extraction_backends import BsdtarBackend, ExtractionError, extract_tar, first_root, get_backends, \
+    get_compression, GnuTarBackend, is_selected, relative_to_root, TarfileBackend
+
+
+class TestExtractionBackends(LoggedTestCase):
+    """This will test that tar archives are extracted with the preferred backend available"""
+
+    def setUp(self):
+        super().setUp()
+        self.archive = os.path.join(get_data_dir(), "compress-files", "valid.tgz")
+        self.tempdir = tempfile.mkdtemp()
+        config_patcher = patch("umake.extraction_backends.ConfigHandler")
+        self.config = config_patcher.start().return_value
+        self.config.config = {}
+        self.addCleanup(config_patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        super().tearDown()
+
+    def assert_extracted(self, dest=None):
+        dest = dest or self.tempdir
+        self.assertTrue(os.path.isfile(os.path.join(dest, "server-content", "subdir", "otherfile")))
+
+    def test_get_compression(self):
+        """Compression is detected from the archive magic number, without moving in it"""
+        with open(self.archive, 'rb') as fd:
+            self.assertEqual(get_compression(fd), "gz")
+            self.assertEqual(fd.tell(), 0)
+
+    def test_backends_fallback_to_tarfile(self):
+        """Python tarfile is always the last resort"""
+        self.assertIsInstance(get_backends("xz")[-1], TarfileBackend)
+
+    def test_configured_backend(self):
+        """A configured backend comes first"""
+        self.config.config = {"extraction": {"backend": {"gz": "tarfile"}}}
+        self.assertIsInstance(get_backends("gz")[0], TarfileBackend)
+        self.assertNotIsInstance(get_backends("xz")[0], TarfileBackend)
+
+    def test_unknown_configured_backend(self):
+        """An unusable configured backend is ignored"""
+        self.config.config = {"extraction": {"backend": "doesnt_exist"}}
+        self.assertIsInstance(get_backends("gz")[-1], TarfileBackend)
+        self.expect_warn_error = True
+
+    def test_extract(self):
+        """Each backend available extracts the archive"""
+        for backend in (TarfileBackend, GnuTarBackend, BsdtarBackend):
+            if not backend.is_available():
+                continue
+            with self.subTest(backend=backend.name):
+                dest = os.path.join(self.tempdir, backend.name)
+                with open(self.archive, 'rb') as fd:
+                    backend().extract(fd, "gz", dest)
+                self.assert_extracted(dest)
+
+    def test_extract_from_offset(self):
+        """Archives are extracted from the current position of the file"""
+        path = os.path.join(self.tempdir, "script")
+        with open(path, 'wb') as f, open(self.archive, 'rb') as archive:
+            f.write(b"#!/bin/sh\nexit 0\n")
+            f.write(archive.read())
+        dest = os.path.join(self.tempdir, "dest")
+        with open(path, 'rb') as fd:
+            fd.readline()
+            fd.readline()
+            extract_tar(fd, dest)
+        self.assert_extracted(dest)
+
+    def make_archive(self, prefix=""):
+        """Create a .tgz archive with app-1/bin/app, app-1/lib/data, app-1/lib/docs/index and other/file members,
+        prefixed with prefix"""
+        path = os.path.join(self.tempdir, "app.tgz")
+        with tarfile.open(path, 'w:gz') as archive:
+            for name in ("app-1/bin/app", "app-1/lib/data", "app-1/lib/docs/index", "other/file"):
+                member = tarfile.TarInfo(prefix + name)
+                member.size = len(name)
+                archive.addfile(member, io.BytesIO(name.encode()))
+        return path
+
+    def test_relative_to_root(self):
+        """Member paths are made relative to root glob components"""
+        self.assertEqual(relative_to_root("./app-1/bin/app", ["app-*", "bin"]), "app")
+        self.assertEqual(relative_to_root("app-1/", ["app-*"]), "")
+        self.assertEqual(relative_to_root("app-1/bin", []), "app-1/bin")
+        self.assertIsNone(relative_to_root("other/app-1/bin", ["app-*"]))
+        self.assertIsNone(relative_to_root("app-1", ["app-*", "bin"]))
+
+    def test_first_root(self):
+        """Root globs are replaced by the first visible directory matching them"""
+        members = [("./", True), (".app-0/bin", True), ("app-1", False), ("app-[2]/bin/app", False),
+                   ("app-3/", True)]
+        self.assertEqual(first_root(members, ["app-*"]), ["app-[[]2]"])
+        self.assertEqual(first_root(members, [".app-*"]), [".app-0"])
+        self.assertEqual(first_root(members, ["app-*", "bin"]), ["app-[[]2]", "bin"])
+        self.assertEqual(first_root(members, ["other"]), ["other"])
+
+    def test_extract_first_root(self):
+        """Each backend available only extracts the first directory matching root"""
+        path = os.path.join(self.tempdir, "app.tgz")
+        with tarfile.open(path, 'w:gz') as archive:
+            for name in (".app-0/hidden", "app-1/bin/app", "app-2/lib/data"):
+                member = tarfile.TarInfo(name)
+                member.size = len(name)
+                archive.addfile(member, io.BytesIO(name.encode()))
+        for backend in (TarfileBackend, GnuTarBackend, BsdtarBackend):
+            if not backend.is_available():
+                continue
+            with self.subTest(backend=backend.name), \
+                    patch("umake.extraction_backends.get_backends", return_value=[backend()]):
+                dest = os.path.join(self.tempdir, backend.name)
+                with open(path, 'rb') as fd:
+                    extract_tar(fd, dest, "app-*")
+                self.assertEqual(os.listdir(dest), ["bin"])
+
+    def test_extract_root(self):
+        """Each backend available only extracts root content, stripping it from members path"""
+        for prefix in ("", "./"):
+            archive = self.make_archive(prefix)
+            for backend in (TarfileBackend, GnuTarBackend, BsdtarBackend):
+                if not backend.is_available():
+                    continue
+                with self.subTest(backend=backend.name, prefix=prefix):
+                    dest = os.path.join(self.tempdir, backend.name + prefix.replace("/", ""))
+                    with open(archive, 'rb') as fd:
+                        backend().extract(fd, "gz", dest, ["app-*"])
+                    self.assertEqual(sorted(os.listdir(dest)), ["bin", "lib"])
+                    self.assertTrue(os.path.isfile(os.path.join(dest, "lib", "docs", "index")))
+                    with open(os.path.join(dest, "bin", "app")) as f:
+                        self.assertEqual(f.read(), "app-1/bin/app")
+
+    def test_is_selected(self):
+        """Globs match members or their parent directories, component by component"""
+        self.assertTrue(is_selected("lib/docs/index"))
+        self.assertTrue(is_selected("lib/docs/index", include=["bin", "l*"]))
+        self.assertFalse(is_selected("lib/docs/index", include=["bin", "*/data"]))
+        self.assertFalse(is_selected("lib/docs/index", exclude=["*/docs"]))
+        self.assertTrue(is_selected("lib/docs/index", exclude=["*/data", "docs"]))
+        self.assertFalse(is_selected("lib/docs/index", include=["lib"], exclude=["lib/d*"]))
+
+    def test_no_filters_backend(self):
+        """Backends which can't filter members aren't used to"""
+        self.assertNotIn(BsdtarBackend, [type(backend) for backend in get_backends("gz", filters=True)])
+
+    def test_extract_filtered(self):
+        """Each backend supporting filters only extracts selected members"""
+        for prefix in ("", "./"):
+            archive = self.make_archive(prefix)
+            for backend in (TarfileBackend, GnuTarBackend):
+                if not backend.is_available():
+                    continue
+                with self.subTest(backend=backend.name, prefix=prefix):
+                    dest = os.path.join(self.tempdir, backend.name + prefix.replace("/", ""))
+                    with open(archive, 'rb') as fd:
+                        backend().extract(fd, "gz", dest, ["app-*"], include=["lib"], exclude=["*/doc*"])
+                    self.assertEqual(os.listdir(dest), ["lib"])
+                    self.assertEqual(os.listdir(os.path.join(dest, "lib")), ["data"])
+
+    def test_extract_missing_root(self):
+        """We raise an error if nothing is in root"""
+        with open(self.make_archive(), 'rb') as fd:
+            with self.assertRaises(ExtractionError):
+                extract_tar(fd, self.tempdir, "doesnt-exist")
+
+    def test_fallback(self):
+        """Failing backends are skipped, extracting again from the start of the archive"""
+        with patch.object(GnuTarBackend, "extract", side_effect=ExtractionError("failed")), \
+                patch.object(BsdtarBackend, "extract", side_effect=OSError("failed")), \
+                open(self.archive, 'rb') as fd:
+            extract_tar(fd, self.tempdir)
+        self.assert_extracted()
+
+    def test_fallback_removes_partial_content(self):
+        """What a failing backend extracted is removed, not what was there before"""
+        open(os.path.join(self.tempdir, "previous"), 'w').close()
+
+        def extract(fd, compression, dest, *args):
+            # move the file offset as commands do
+            fd.read(100)
+            os.makedirs(os.path.join(dest, "partial"))
+            raise ExtractionError("failed")
+
+        with patch.object(GnuTarBackend, "extract", side_effect=extract), \
+                patch.object(BsdtarBackend, "extract", side_effect=extract), \
+                open(self.archive, 'rb') as fd:
+            extract_tar(fd, self.tempdir)
+        self.assert_extracted()
+        self.assertTrue(os.path.isfile(os.path.join(self.tempdir, "previous")))
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, "partial")))
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the ftp adapter"""
+
+from ftplib import error_perm
+import socket
+from threading import Thread
+from unittest.mock import patch
+import requests
+from requests.packages.urllib3.exceptions import ProtocolError
+from ..tools import LoggedTestCase
+from umake.network.ftp_adapter import FTPAdapter
+
+
+class FakeFTP:
+    """A logged in FTP connection serving content for every path but missing"""
+
+    def __init__(self, content, support_rest=True):
+        self.content = content
+        self.support_rest = support_rest
+        self.commands = []
+        self.closed = False
+
+    def voidcmd(self, cmd):
+        self.commands.append(cmd)
+
+    def sendcmd(self, cmd):
+        self.commands.append(cmd)
+        return "213 20170101120000"
+
+    def size(self, path):
+        if path == "missing":
+            raise error_perm("550 No such file")
+        return len(self.content)
+
+    def transfercmd(self, cmd, rest=None):
+        self.commands.append(cmd)
+        if rest and not self.support_rest:
+            raise error_perm("502 REST not implemented")
+        data_socket, server_socket = socket.socketpair()
+
+        def send():
+            with server_socket:
+                # the client may hang up first
+                try:
+                    server_socket.sendall(self.content[rest or 0:])
+                except OSError:
+                    pass
+        Thread(target=send, daemon=True).start()
+        return data_socket
+
+    def voidresp(self):
+        return "226 Transfer complete"
+
+    def close(self):
+        self.closed = True
+
+
+class TestFTPAdapter(LoggedTestCase):
+    """This will test streaming ftp transfers"""
+
+    def setUp(self):
+        super().setUp()
+        self.content = bytes(range(256)) * 1024
+        self.connections = []
+        get_connection_patcher = patch.object(FTPAdapter, "get_connection", side_effect=self.new_connection)
+        self.get_connection = get_connection_patcher.start()
+        self.addCleanup(get_connection_patcher.stop)
+        self.session = requests.Session()
+        self.session.mount("ftp://", FTPAdapter())
+
+    def new_connection(self, hostname, timeout=None, port=0):
+        conn = FakeFTP(self.content)
+        self.connections.append(conn)
+        return conn
+
+    def get(self, path="foo/bar", **kwargs):
+        return self.session.get("ftp://localhost/" + path, stream=True, **kwargs)
+
+    def test_stream(self):
+        """We stream the whole content"""
+        r = self.get()
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(int(r.headers["content-length"]), len(self.content))
+        self.assertEqual(r.headers["last-modified"], "Sun, 01 Jan 2017 12:00:00 GMT")
+        self.assertEqual(b"".join(r.raw.stream(1000)), self.content)
+        self.assertEqual(r.raw.tell(), len(self.content))
+        self.assertIn("RETR foo/bar", self.connections[0].commands)
+
+    def test_read(self):
+        """We read content in chunks of the requested size"""
+        r = self.get()
+        self.assertEqual(len(r.raw.read(1000)), 1000)
+        self.assertEqual(r.raw.read(), self.content[1000:])
+        self.assertTrue(r.raw.closed)
+
+    def test_missing_file(self):
+        """We get a 404 for missing files"""
+        self.assertEqual(self.get("missing").status_code, 404)
+
+    def test_connection_reused(self):
+        """Connections are reused once a transfer is complete"""
+        for i in range(3):
+            r = self.get()
+            r.raw.read()
+            r.close()
+        self.assertEqual(self.get_connection.call_count, 1)
+        self.assertIn("NOOP", self.connections[0].commands)
+
+    def test_cancelled_connection_not_reused(self):
+        """Connections of cancelled transfers are closed and not reused"""
+        r = self.get()
+        r.raw.read(1000)
+        r.close()
+        self.assertTrue(self.connections[0].closed)
+        self.get().close()
+        self.assertEqual(self.get_connection.call_count, 2)
+
+    def test_resume(self):
+        """We resume transfers with range requests"""
+        r = self.get(headers={"Range": "bytes=1000-"})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(int(r.headers["content-length"]), len(self.content) - 1000)
+        self.assertEqual(r.headers["content-range"], "bytes 1000-{}/{}".format(len(self.content) - 1,
+                                                                               len(self.content)))
+        self.assertEqual(r.raw.read(), self.content[1000:])
+
+    def test_partial_range(self):
+        """We only read the requested range"""
+        r = self.get(headers={"Range": "bytes=0-999"})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.raw.read(), self.content[:1000])
+        r.close()
+
+    def test_resume_not_supported(self):
+        """We get the whole content if the server can't resume transfers"""
+        self.get_connection.side_effect = lambda *args: FakeFTP(self.content, support_rest=False)
+        r = self.get(headers={"Range": "bytes=1000-"})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.raw.read(), self.content)
+
+    def test_resume_changed_content(self):
+        """We get the whole content if it changed since the If-Range date"""
+        r = self.get(headers={"Range": "bytes=1000-", "If-Range": "Thu, 01 Jan 1970 00:00:00 GMT"})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.raw.read(), self.content)
+
+    def test_range_not_satisfiable(self):
+        """We get a 416 for ranges past the end"""
+        self.assertEqual(self.get(headers={"Range": "bytes={}-".format(len(self.content))}).status_code, 416)
+
+    def test_interrupted_transfer(self):
+        """We raise a protocol error if the transfer is interrupted"""
+        self.content = self.content[:1000]
+        r = self.get()
+        # pretend the server announced more content
+        r.raw._remaining += 1000
+        with self.assertRaises(ProtocolError):
+            r.raw.read()
+        self.assertTrue(r.raw.closed)
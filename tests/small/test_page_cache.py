@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the page cache"""
+
+from io import BytesIO
+import os
+import shutil
+import tempfile
+from unittest.mock import Mock
+from ..tools import LoggedTestCase, change_xdg_path
+from umake.network.page_cache import PageCache
+from umake.tools import get_cache_path
+
+
+class TestPageCache(LoggedTestCase):
+    """This will test the page cache storage and revalidation headers"""
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        change_xdg_path('XDG_CACHE_HOME', self.cache_dir)
+        self.cache = PageCache()
+
+    def tearDown(self):
+        change_xdg_path('XDG_CACHE_HOME', remove=True)
+        shutil.rmtree(self.cache_dir)
+        super().tearDown()
+
+    def response(self, headers):
+        """Return a fake response from http://foo/final with those headers"""
+        return Mock(url="http://foo/final", headers=headers)
+
+    def test_default_path(self):
+        """The page cache is in the user cache directory"""
+        self.assertEqual(self.cache.path, get_cache_path("pages"))
+
+    def test_key_for(self):
+        """Pages are keyed by url, request headers and decoding"""
+        key = PageCache.key_for("http://foo")
+        self.assertEqual(key, PageCache.key_for("http://foo", {}))
+        self.assertNotEqual(key, PageCache.key_for("http://bar"))
+        self.assertNotEqual(key, PageCache.key_for("http://foo", {"Accept": "application/json"}))
+        self.assertNotEqual(key, PageCache.key_for("http://foo", ignore_encoding=True))
+
+    def test_add_and_get(self):
+        """We get back cached pages with the headers revalidating them"""
+        self.cache.add("http://foo", None, False, self.response({"etag": '"1234"', "last-modified": "yesterday"}),
+                       BytesIO(b"content"))
+
+        page = self.cache.get("http://foo")
+        with page.file:
+            self.assertEqual(page.file.read(), b"content")
+        self.assertEqual(page.final_url, "http://foo/final")
+        self.assertEqual(page.validators, {"If-None-Match": '"1234"', "If-Modified-Since": "yesterday"})
+
+    def test_add_whole_file(self):
+        """The whole file is stored, whatever its current position"""
+        content = BytesIO(b"content")
+        content.seek(3)
+        self.cache.add("http://foo", None, False, self.response({"etag": '"1234"'}), content)
+
+        with self.cache.get("http://foo").file as f:
+            self.assertEqual(f.read(), b"content")
+
+    def test_get_missing(self):
+        """We get None for pages which aren't cached"""
+        self.assertIsNone(self.cache.get("http://foo"))
+
+    def test_no_validator_not_stored(self):
+        """We don't store pages we can't revalidate"""
+        self.cache.add("http://foo", None, False, self.response({}), BytesIO(b"content"))
+        self.assertIsNone(self.cache.get("http://foo"))
+
+    def test_no_store_not_stored(self):
+        """We don't store pages the server asks us not to"""
+        self.cache.add("http://foo", None, False, self.response({"etag": '"1234"', "cache-control": "no-store"}),
+                       BytesIO(b"content"))
+        self.assertIsNone(self.cache.get("http://foo"))
+
+    def test_disabled_cache(self):
+        """A disabled cache doesn't store anything"""
+        self.cache.enabled = False
+        self.cache.add("http://foo", None, False, self.response({"etag": '"1234"'}), BytesIO(b"content"))
+        self.assertIsNone(self.cache.get("http://foo"))
+
+    def test_prune(self):
+        """We can remove every cached page"""
+        self.cache.add("http://foo", None, False, self.response({"etag": '"1234"'}), BytesIO(b"content"))
+        self.cache.prune()
+        self.assertIsNone(self.cache.get("http://foo"))
+        self.assertFalse(os.path.exists(self.cache.path))
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for download traces"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from unittest.mock import Mock, patch
+from ..tools import LoggedTestCase
+from umake.network.request_trace import RequestTrace, TimedHasher, TraceWriter, record, record_bytes, timed_request
+from umake.tools import Singleton
+
+
+class TestRequestTrace(LoggedTestCase):
+    """This will test that download phases are timed in the trace of the current download"""
+
+    def setUp(self):
+        super().setUp()
+        monotonic_patcher = patch("umake.network.request_trace.time.monotonic", return_value=0)
+        self.monotonic = monotonic_patcher.start()
+        self.addCleanup(monotonic_patcher.stop)
+        self.trace = RequestTrace("http://foo/bar")
+
+    def test_current(self):
+        """Traces are current while active"""
+        self.assertIsNone(RequestTrace.current())
+        with self.trace.activate():
+            self.assertEqual(RequestTrace.current(), self.trace)
+            record_bytes(10)
+        self.assertIsNone(RequestTrace.current())
+        record_bytes(10)
+        self.assertEqual(self.trace.bytes, 10)
+
+    def test_phases(self):
+        """Transfer is what isn't accounted to any other phase"""
+        with self.trace.activate():
+            record("dns", 1)
+            record("checksum", 2)
+            self.monotonic.return_value = 10
+        self.assertEqual(self.trace.total, 10)
+        self.assertEqual(self.trace.timings, {"dns": 1, "connect": 0, "tls": 0, "ttfb": 0, "transfer": 7,
+                                              "checksum": 2})
+
+    def test_error(self):
+        """Failing downloads keep their error"""
+        with self.assertRaises(BaseException):
+            with self.trace.activate():
+                raise BaseException("Not found")
+        self.assertEqual(self.trace.error, "Not found")
+        self.assertEqual(self.trace.total, 0)
+
+    def test_timed_request(self):
+        """Time to first byte doesn't include setting up connections, responses are recorded"""
+        response = Mock(status_code=200, url="http://foo/baz", history=[Mock(url="http://foo/bar")])
+        with self.trace.activate():
+            with timed_request() as responses:
+                record("connect", 2)
+                self.monotonic.return_value = 5
+                responses.append(response)
+        self.assertEqual(self.trace.timings["ttfb"], 3)
+        self.assertEqual((self.trace.status, self.trace.final_url, self.trace.redirects),
+                         (200, "http://foo/baz", ["http://foo/bar"]))
+
+    def test_timed_hasher(self):
+        """Hashing is accounted to the checksum phase"""
+        with self.trace.activate():
+            hasher = TimedHasher(hashlib.md5())
+            self.monotonic.side_effect = [1, 3]
+            hasher.update(b"foo")
+            self.monotonic.side_effect = None
+        self.assertEqual(hasher.hexdigest(), hashlib.md5(b"foo").hexdigest())
+        self.assertEqual(self.trace.timings["checksum"], 2)
+
+
+class TestTraceWriter(LoggedTestCase):
+    """This will test that traces are written as JSON lines"""
+
+    def setUp(self):
+        super().setUp()
+        self.trace_dir = tempfile.mkdtemp()
+        Singleton._instances.pop(TraceWriter, None)
+        self.addCleanup(Singleton._instances.pop, TraceWriter, None)
+
+    def tearDown(self):
+        shutil.rmtree(self.trace_dir)
+        super().tearDown()
+
+    def test_write(self):
+        """Traces are appended to the file, one per line"""
+        path = os.path.join(self.trace_dir, "trace.jsonl")
+        TraceWriter().path = path
+        for url in ("http://foo/bar", "http://foo/baz"):
+            TraceWriter().write(RequestTrace(url))
+        with open(path) as f:
+            self.assertEqual([json.loads(line)["url"] for line in f], ["http://foo/bar", "http://foo/baz"])
+
+    def test_no_path(self):
+        """Nothing is written by default"""
+        TraceWriter().write(RequestTrace("http://foo/bar"))
+        self.assertEqual(os.listdir(self.trace_dir), [])
+
+    def test_write_error(self):
+        """Failing to write traces doesn't fail downloads"""
+        TraceWriter().path = os.path.join(self.trace_dir, "doesnt_exist", "trace.jsonl")
+        TraceWriter().write(RequestTrace("http://foo/bar"))
+        self.expect_warn_error = True
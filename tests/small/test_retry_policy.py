@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the retry policy and circuit breaker"""
+
+from unittest.mock import Mock, patch
+import requests.exceptions
+from requests.packages.urllib3.exceptions import ProtocolError
+from ..tools import LoggedTestCase
+from umake.network.retry_policy import CircuitBreaker, CircuitOpenError, RetryPolicy
+from umake.tools import Singleton
+
+
+def http_error(status_code, headers=None):
+    return requests.exceptions.HTTPError(response=Mock(status_code=status_code, headers=headers or {}))
+
+
+class TestRetryPolicy(LoggedTestCase):
+    """This will test which failures are retried, and when"""
+
+    def setUp(self):
+        super().setUp()
+        config_handler_patcher = patch("umake.network.retry_policy.ConfigHandler")
+        self.config_handler = config_handler_patcher.start()
+        self.addCleanup(config_handler_patcher.stop)
+        self.config_handler.return_value.config = {}
+        sleep_patcher = patch("umake.network.retry_policy.time.sleep")
+        self.sleep = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+        Singleton._instances.pop(CircuitBreaker, None)
+
+    def test_classify(self):
+        """Errors are classified by what retrying them could help with"""
+        self.assertEqual(RetryPolicy.classify(http_error(503)), "server_error")
+        self.assertEqual(RetryPolicy.classify(http_error(429)), "server_error")
+        self.assertEqual(RetryPolicy.classify(requests.exceptions.ConnectTimeout()), "timeout")
+        self.assertEqual(RetryPolicy.classify(requests.exceptions.ConnectionError()), "connection")
+        self.assertEqual(RetryPolicy.classify(ProtocolError()), "connection")
+        self.assertIsNone(RetryPolicy.classify(http_error(404)))
+        self.assertIsNone(RetryPolicy.classify(requests.exceptions.SSLError()))
+        self.assertIsNone(RetryPolicy.classify(CircuitOpenError()))
+        self.assertIsNone(RetryPolicy.classify(BaseException()))
+
+    def test_retries_exhausted(self):
+        """We retry until we made as many attempts as configured, per error class"""
+        retry = RetryPolicy()
+        self.assertEqual([retry.retry("http://foo/bar", http_error(503)) for i in range(3)], [True, True, False])
+        self.assertTrue(retry.retry("http://foo/bar", requests.exceptions.ConnectionError()))
+        self.assertEqual(self.sleep.call_count, 3)
+        self.expect_warn_error = True
+
+    def test_not_retried(self):
+        """We don't retry errors that wouldn't go away"""
+        self.assertFalse(RetryPolicy().retry("http://foo/bar", http_error(404)))
+        self.sleep.assert_not_called()
+
+    def test_backoff(self):
+        """We wait for a random delay, growing exponentially up to the maximum backoff"""
+        retry = RetryPolicy()
+        for attempt, limit in ((1, 1), (2, 2), (3, 4), (6, 30)):
+            delays = [retry.delay("connection", attempt) for i in range(50)]
+            self.assertTrue(all(0 <= delay <= limit for delay in delays), delays)
+            self.assertGreater(max(delays), limit / 2)
+
+    def test_retry_after(self):
+        """We wait for at least what the server asked for"""
+        retry = RetryPolicy()
+        self.assertTrue(retry.retry("http://foo/bar", http_error(503, {"retry-after": "20"})))
+        self.sleep.assert_called_once_with(20)
+        self.expect_warn_error = True
+
+    def test_config(self):
+        """Attempts and backoffs are configurable per error class"""
+        self.config_handler.return_value.config = {"download": {"retry": {
+            "timeout": {"attempts": 5, "backoff": 0}, "max_backoff": 10}}}
+        retry = RetryPolicy()
+        self.assertTrue(all(retry.retry("http://foo/bar", requests.exceptions.ReadTimeout()) for i in range(4)))
+        self.assertFalse(retry.retry("http://foo/bar", requests.exceptions.ReadTimeout()))
+        self.assertTrue(all(args[0] == 0 for args, kwargs in self.sleep.call_args_list))
+        self.assertLessEqual(retry.delay("server_error", 10), 10)
+        self.expect_warn_error = True
+
+    def test_host_down_not_retried(self):
+        """We don't retry hosts considered down"""
+        for i in range(CircuitBreaker.FAILURES):
+            CircuitBreaker().record_failure("http://foo/bar")
+        self.assertFalse(RetryPolicy().retry("http://foo/baz", requests.exceptions.ConnectionError()))
+        self.expect_warn_error = True
+
+
+class TestCircuitBreaker(LoggedTestCase):
+    """This will test that hosts failing too much are considered down for a while"""
+
+    def setUp(self):
+        super().setUp()
+        config_handler_patcher = patch("umake.network.retry_policy.ConfigHandler")
+        config_handler_patcher.start().return_value.config = {}
+        self.addCleanup(config_handler_patcher.stop)
+        Singleton._instances.pop(CircuitBreaker, None)
+        self.addCleanup(Singleton._instances.pop, CircuitBreaker, None)
+        self.breaker = CircuitBreaker()
+
+    def record_failures(self, url, times=CircuitBreaker.FAILURES):
+        for i in range(times):
+            self.breaker.record_failure(url)
+
+    def test_opens_after_failures(self):
+        """Hosts are down after enough failures in a row, other hosts aren't affected"""
+        self.record_failures("http://foo/bar", CircuitBreaker.FAILURES - 1)
+        self.breaker.check("http://foo/bar")
+        self.record_failures("http://foo/bar", 1)
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.check("http://foo/baz")
+        self.breaker.check("http://other/bar")
+        self.expect_warn_error = True
+
+    def test_success_resets(self):
+        """A success forgets previous failures"""
+        self.record_failures("http://foo/bar", CircuitBreaker.FAILURES - 1)
+        self.breaker.record_success("http://foo/bar")
+        self.record_failures("http://foo/bar", CircuitBreaker.FAILURES - 1)
+        self.assertFalse(self.breaker.is_open("http://foo/bar"))
+
+    def test_half_open(self):
+        """Hosts are tried again after a while, one more failure making them down again"""
+        with patch("umake.network.retry_policy.time.monotonic", return_value=1000):
+            self.record_failures("http://foo/bar")
+        with patch("umake.network.retry_policy.time.monotonic", return_value=1000 + CircuitBreaker.RESET_AFTER):
+            self.assertFalse(self.breaker.is_open("http://foo/bar"))
+            self.record_failures("http://foo/bar", 1)
+            self.assertTrue(self.breaker.is_open("http://foo/bar"))
+        self.expect_warn_error = True
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the url rewriter"""
+
+from unittest.mock import patch
+from ..tools import LoggedTestCase
+from umake.network.url_rewriter import UrlRewriter
+
+
+class TestUrlRewriter(LoggedTestCase):
+    """This will test rewriting urls following configured rules"""
+
+    def setUp(self):
+        super().setUp()
+        config_handler_patcher = patch("umake.network.url_rewriter.ConfigHandler")
+        self.config_handler = config_handler_patcher.start()
+        self.addCleanup(config_handler_patcher.stop)
+        self.config_handler.return_value.config = {}
+
+    def set_download_config(self, **download_config):
+        self.config_handler.return_value.config = {"download": download_config}
+
+    def test_no_rule(self):
+        """Urls are kept as is without any rule, and upstream is used as a fallback"""
+        rewriter = UrlRewriter()
+        self.assertEqual(rewriter.rewrite("https://golang.org/dl/"), "https://golang.org/dl/")
+        self.assertTrue(rewriter.fallback)
+
+    def test_prefix(self):
+        """We replace matching url prefixes"""
+        self.set_download_config(rewrite=[{"prefix": "https://golang.org/", "to": "http://mirror.lan/golang/"}])
+        rewriter = UrlRewriter()
+        self.assertEqual(rewriter.rewrite("https://golang.org/dl/"), "http://mirror.lan/golang/dl/")
+        self.assertEqual(rewriter.rewrite("https://www.golang.org/dl/"), "https://www.golang.org/dl/")
+
+    def test_regex(self):
+        """We substitute matching regexes"""
+        self.set_download_config(rewrite=[{"regex": r"^https://(\w+)\.jetbrains\.com/",
+                                           "to": r"file:///srv/mirror/\1/"}])
+        self.assertEqual(UrlRewriter().rewrite("https://download.jetbrains.com/idea/idea.tar.gz"),
+                         "file:///srv/mirror/download/idea/idea.tar.gz")
+
+    def test_first_rule_wins(self):
+        """Only the first matching rule applies"""
+        self.set_download_config(rewrite=[{"prefix": "https://golang.org/", "to": "http://mirror1/"},
+                                          {"regex": "golang", "to": "mirror2"}])
+        self.assertEqual(UrlRewriter().rewrite("https://golang.org/dl/"), "http://mirror1/dl/")
+
+    def test_invalid_rules_ignored(self):
+        """We ignore invalid rules"""
+        self.set_download_config(rewrite=[{"prefix": "https://golang.org/"}, {"regex": "(", "to": "foo"},
+                                          {"prefix": "https://golang.org/", "to": "http://mirror/"}])
+        self.assertEqual(UrlRewriter().rewrite("https://golang.org/dl/"), "http://mirror/dl/")
+        self.expect_warn_error = True
+
+    def test_no_fallback(self):
+        """Upstream fallback can be disabled"""
+        self.set_download_config(rewrite_fallback=False)
+        self.assertFalse(UrlRewriter().fallback)
@@ -108,6 +108,7 @@ def change_xdg_path(key, value=None, remove=False):
         umake.tools.Singleton._instances.pop(umake.tools.ConfigHandler)
     umake.tools.xdg_config_home = xdg.BaseDirectory.xdg_config_home
     umake.tools.xdg_data_home = xdg.BaseDirectory.xdg_data_home
+    umake.tools.xdg_cache_home = xdg.BaseDirectory.xdg_cache_home
 
 
 @contextmanager
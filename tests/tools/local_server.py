@@ -20,7 +20,7 @@
 """Class enabling having a local http(s) server"""
 
 from concurrent import futures
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
 import http.cookies
 import logging
 import os
@@ -55,8 +55,11 @@ class LocalHttp:
         handler.root_path = path
         handler.multi_hosts = multi_hosts
         handler.ftp_redir = ftp_redir
+        handler.failed_once = set()
         # can be TCPServer, but we don't have a self.httpd.server_name then
-        self.httpd = HTTPServer(("", self.port), RequestHandler)
+        # threaded, as segmented downloads request multiple ranges at once
+        self.httpd = ThreadingHTTPServer(("", self.port), RequestHandler)
+        self.httpd.daemon_threads = True
         handler.hostname = self.httpd.server_name
 
         # create ssl certificate handling for SNI case (switching between different host name)
@@ -102,6 +105,30 @@ class LocalHttp:
         self.httpd.socket.close()
 
 
+class _RangeFile:
+    """Read only the next length bytes of f, so that ranges are streamed from the file"""
+
+    def __init__(self, f, length):
+        self._f = f
+        self._left = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self._left:
+            size = self._left
+        data = self._f.read(size)
+        self._left -= len(data)
+        return data
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 class RequestHandler(SimpleHTTPRequestHandler):
 
     root_path = os.getcwd()
@@ -162,18 +189,74 @@ class RequestHandler(SimpleHTTPRequestHandler):
             path += '/'
         return path
 
+    def send_head(self):
+        """Advertise and serve byte ranges, which SimpleHTTPRequestHandler doesn't support"""
+        path = self.translate_path(self.path)
+        range_header = self.headers["Range"]
+        if not os.path.isfile(path) or self.path.endswith("-with-no-content-length"):
+            return super().send_head()
+        self.headers_to_send.append(("Accept-Ranges", "bytes"))
+        if not range_header or not range_header.startswith("bytes="):
+            return super().send_head()
+
+        # If-Range only lets the range through if the file didn't change since last time
+        stat = os.stat(path)
+        last_modified = self.date_time_string(int(stat.st_mtime))
+        if_range = self.headers["If-Range"]
+        if if_range and if_range != last_modified:
+            return super().send_head()
+
+        start, end = range_header[len("bytes="):].split("-")
+        start = int(start)
+        end = int(end) if end else stat.st_size - 1
+        if start >= stat.st_size:
+            self.send_error(416)
+            return None
+        end = min(end, stat.st_size - 1)
+        f = open(path, 'rb')
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, stat.st_size))
+        self.send_header("Last-Modified", last_modified)
+        self.end_headers()
+        return _RangeFile(f, end - start + 1)
+
     def do_GET(self):
-        """Override this to enable redirecting paths that end in -redirect or rewrite in presence of ?file="""
+        """Override this to enable redirecting paths that end in -redirect or rewrite in presence of ?file=
+
+        Paths ending in -interrupted are only half sent, the ones ending in -unavailable get a 503 error. With an
+        additional -once suffix, they only fail the first time."""
         cookies = http.cookies.SimpleCookie(self.headers['Cookie'])
         if 'int' in cookies:
             cookies['int'] = int(cookies['int'].value) + 1
         for cookie in cookies.values():
             self.headers_to_send.append(('Set-Cookie', cookie.OutputString(None)))
 
-        if self.path.endswith('-redirect'):
+        if self.path.endswith('-once'):
+            self.path = self.path[:-len('-once')]
+            if self.path in RequestHandler.failed_once:
+                # strip the failure suffix
+                self.path = self.path.rsplit('-', 1)[0]
+            else:
+                RequestHandler.failed_once.add(self.path)
+
+        if self.path.endswith('-unavailable'):
+            self.send_error(503)
+        elif self.path.endswith('-redirect'):
             self.send_response(302)
             self.send_header('Location', self.path[:-len('-redirect')])
             self.end_headers()
+        elif self.path.endswith('-interrupted'):
+            # only send the first half of the content, like a server dying in the middle of a download
+            self.path = self.path[:-len('-interrupted')]
+            f = self.send_head()
+            if f:
+                with f:
+                    content = f.read()
+                self.wfile.write(content[:len(content) // 2])
+                self.close_connection = True
         elif 'setheaders' in self.path:
             # For paths that end with '-setheaders', we fish out the headers from the query
             # params and set them.
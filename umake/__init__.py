@@ -131,6 +131,14 @@ def main():
     list_group.add_argument('--list-installed', action="store_true", help=_("List installed frameworks"))
     list_group.add_argument('--list-available', action="store_true", help=_("List installable frameworks"))
 
+    cache_group = parser.add_argument_group("Artifact cache").add_mutually_exclusive_group()
+    cache_group.add_argument('--cache-stats', action="store_true",
+                             help=_("Print downloaded artifacts cache usage, the cache being disabled by default"))
+    cache_group.add_argument('--cache-prune', action="store_true",
+                             help=_("Remove all downloaded artifacts and pages from cache"))
+
+    parser.add_argument('--trace-downloads', metavar="FILE",
+                        help=_("Append the timings of each download to FILE, as JSON lines"))
     parser.add_argument('--version', action="store_true", help=_("Print version and exit"))
 
     # set logging ignoring unknown options
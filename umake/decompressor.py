@@ -19,15 +19,26 @@
 
 from collections import namedtuple
 from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import suppress
+import copy
+import fcntl
 from glob import glob
+import io
 import logging
+import multiprocessing
 import os
 import shutil
 import stat
 import subprocess
 import tarfile
 import tempfile
+from threading import Thread
+import time
 import zipfile
+from umake.extraction_backends import ExtractionError, extract_tar, first_root, is_selected, list_content, \
+    relative_to_root, remove_new_content, split_root
+from umake.tools import get_cache_path
 
 
 logger = logging.getLogger(__name__)
@@ -36,21 +47,109 @@ logger = logging.getLogger(__name__)
 class Decompressor:
     """Handle decompression of various file in separate threads"""
 
-    DecompressOrder = namedtuple("DecompressOrder", ["dir", "dest"])
+    class DecompressOrder(namedtuple("DecompressOrder", ["dir", "dest", "include", "exclude"])):
+        """Extract dir content of an archive to dest.
+
+        include and exclude are optional lists of globs, relative to dir, filtering extracted members. A glob matches
+        a member if it matches its path, or one of its parent directories, component by component."""
+        def __new__(cls, dir, dest, include=None, exclude=None):
+            return super().__new__(cls, dir, dest, include, exclude)
+
     DecompressResult = namedtuple("DecompressResult", ["error"])
 
     # override _extract_member to preserve file permissions:
     # http://bugs.python.org/issue15795
     class ZipFileWithPerm(zipfile.ZipFile):
+        """Zip archives members are independent from each other: big archives are extracted by a pool of processes,
+        each of them inflating its share of the members"""
+
+        # archives smaller than that (uncompressed) aren't worth starting processes for
+        PARALLEL_MIN_SIZE = 1024 * 1024 * 64
+        MAX_WORKERS = 16
+
         def _extract_member(self, member, targetpath, pwd):
             if not isinstance(member, zipfile.ZipInfo):
                 member = self.getinfo(member)
 
-            targetpath = super()._extract_member(member, targetpath, pwd)
+            try:
+                targetpath = super()._extract_member(member, targetpath, pwd)
+            except FileExistsError:
+                # another process extracting the same archive created a parent directory meanwhile
+                targetpath = super()._extract_member(member, targetpath, pwd)
             mode = member.external_attr >> 16 & 0x1FF
             os.chmod(targetpath, mode)
             return targetpath
 
+        def _extract_as(self, member, name, path, pwd):
+            """Extract member to name in path"""
+            if member.is_dir():
+                name += "/"
+            if name != member.filename:
+                member = copy.copy(member)
+                member.filename = name
+            return self._extract_member(member, path, pwd)
+
+        def extractall(self, path=None, members=None, pwd=None, root=(), include=None, exclude=None):
+            """Extract all members, or only the content of root directories (a list of glob path components) with
+            root stripped from their path, filtered by include and exclude glob lists"""
+            if members is not None:
+                return super().extractall(path, members, pwd)
+            path = os.fspath(path) if path is not None else os.getcwd()
+            infolist = self.infolist()
+            # only extract the first directory matching root
+            root = first_root(((member.filename, member.is_dir()) for member in infolist), root)
+            # index of members by their path relative to root. A member appearing more than once is extracted from
+            # its last occurrence, as getinfo() does
+            files = {}
+            dirs = {}
+            found = False
+            for index, member in enumerate(infolist):
+                name = relative_to_root(member.filename, root)
+                if name is None:
+                    continue
+                found = True
+                if name and is_selected(name, include or (), exclude or ()):
+                    (dirs if member.is_dir() else files)[name] = index
+            if not found:
+                raise ExtractionError("Couldn't find {} in archive".format("/".join(root)))
+
+            workers = min(len(os.sched_getaffinity(0)), self.MAX_WORKERS)
+            files = sorted(files.items(), key=lambda item: infolist[item[1]].file_size, reverse=True)
+            size = sum(infolist[index].file_size for name, index in files)
+            if not self.filename or workers < 2 or size < self.PARALLEL_MIN_SIZE or \
+                    not self._extract_in_processes(files, workers, path, pwd):
+                for name, index in files:
+                    self._extract_as(infolist[index], name, path, pwd)
+            # directories last, their permissions could prevent writing their content
+            for name, index in dirs.items():
+                self._extract_as(infolist[index], name, path, pwd)
+
+        def _extract_in_processes(self, files, workers, path, pwd):
+            """Extract files, as (name to extract it to, index) pairs, in a pool of processes. Return False if the pool
+            couldn't run, so that they are extracted here"""
+            infolist = self.infolist()
+            # balance shards on uncompressed size, biggest members first
+            shards = [[] for i in range(min(workers, len(files)))]
+            shard_sizes = [0] * len(shards)
+            for name, index in files:
+                smallest = shard_sizes.index(min(shard_sizes))
+                shards[smallest].append((index, name))
+                shard_sizes[smallest] += infolist[index].file_size
+            logger.debug("Extracting {} with {} processes".format(self.filename, len(shards)))
+            try:
+                # forking a process running other threads isn't safe
+                with futures.ProcessPoolExecutor(max_workers=len(shards),
+                                                 mp_context=multiprocessing.get_context("forkserver")) as executor:
+                    for future in [executor.submit(_extract_zip_members, self.filename, shard, path, pwd)
+                                   for shard in shards]:
+                        future.result()
+            except (BrokenProcessPool, OSError) as e:
+                # workers import __main__ again, which isn't possible when it's not a file (python3 -c, stdin,
+                # embedded interpreters…)
+                logger.info("Couldn't extract {} with processes, extracting it here: {}".format(self.filename, e))
+                return False
+            return True
+
     def __init__(self, orders, on_done):
         """Decompress all fds in threads and send on_done callback once finished
 
@@ -59,7 +158,9 @@ class Decompressor:
         {
             "fd":
                 DecompressOrder(dir=directory to decompress (this will become the new root)
-                                dest=destination directory to use for decompressing)
+                                dest=destination directory to use for decompressing
+                                include=optional globs of the only members to decompress
+                                exclude=optional globs of members not to decompress)
                                 )
         }
 
@@ -76,25 +177,51 @@ class Decompressor:
         executor = futures.ThreadPoolExecutor(max_workers=3)
         for fd in orders:
             logger.info("Requesting decompression to {}".format(orders[fd].dest))
-            future = executor.submit(self._decompress, fd, orders[fd].dir, orders[fd].dest)
+            future = executor.submit(self._decompress, fd, orders[fd].dir, orders[fd].dest, orders[fd].include,
+                                     orders[fd].exclude)
             future.tag_fd = fd
             future.tag_dest = orders[fd].dest
             future.add_done_callback(self._one_done)
 
-    def _decompress(self, fd, dir, dest):
+    def _decompress(self, fd, dir, dest, include=None, exclude=None):
         """decompress one entry
 
         dir can be a regexp"""
-        logger.debug("Extracting to {}".format(dest))
-        # we temporarily extract to this destination the archive content
-        tempdest = tempfile.mktemp(dir=dest)
+        if isinstance(fd, StreamDecompressor):
+            # the archive was already extracted while being downloaded
+            logger.debug("Moving extracted content to {}".format(dest))
+            self._move_content(fd.name, dir, dest, include, exclude)
+        else:
+            logger.debug("Extracting to {}".format(dest))
+            self._extract(fd, dir, dest, include, exclude)
+
+    @staticmethod
+    def _move_content(tempdest, dir, dest, include=None, exclude=None):
+        """Move dir content from tempdest, where a whole archive was extracted, to dest"""
+        try:
+            dir_path = glob(os.path.join(tempdest, dir))[0]
+        except IndexError:
+            raise BaseException("Couldn't find {} in tarball".format(dir))
+        if include or exclude:
+            _remove_unselected(dir_path, include or (), exclude or ())
+        for filename in os.listdir(dir_path):
+            _merge_move(os.path.join(dir_path, filename), os.path.join(dest, filename))
+        shutil.rmtree(tempdest)
+
+    def _extract(self, fd, dir, dest, include=None, exclude=None):
+        """Extract dir content of the fd archive to dest.
+
+        tar and zip archives members are directly written to dest with their path rewritten, other formats are
+        extracted whole to a temporary directory first"""
         # We don't use shutil to automatically select the right codec as we need to ensure that zipfile
         # will keep the original perms.
         archive = None
         is_archive = False
         try:
+            # the fd isn't forcibly at position 0 (like in Unity3D where we offset the script part)
+            position = fd.tell()
+            previous = list_content(dest)
             try:
-                # the fd isn't forcibly at position 0 (like in Unity3D where we offset the script part)
                 archive = tarfile.open(fileobj=fd, mode='r|*')
                 logger.debug("tar file")
             except tarfile.ReadError:
@@ -105,14 +232,23 @@ class Decompressor:
             # exec tar xf and hope for the best (tar binary seems to be more acceptive of slightly misformed
             # archives)
             try:
-                archive.extractall(tempdest)
+                if isinstance(archive, tarfile.TarFile):
+                    # tar archives are extracted by the fastest backend for their compression
+                    archive.close()
+                    fd.seek(position)
+                    extract_tar(fd, dest, dir, include, exclude)
+                else:
+                    archive.extractall(dest, root=split_root(dir), include=include, exclude=exclude)
             except tarfile.ReadError:
                 logger.debug("Trigger fallback direct tar execution")
-                shutil.rmtree(tempdest)
+                # don't leave what the failed extraction wrote behind
+                remove_new_content(dest, previous)
+                tempdest = tempfile.mktemp(dir=dest)
                 os.makedirs(tempdest)
                 archive = subprocess.Popen(["tar", "xf", fd.name, "-C", tempdest])
                 archive.communicate()
                 fd.close()
+                self._move_content(tempdest, dir, dest, include, exclude)
         except:
             # try to treat it as self-extractable, some format don't like being opened at the same time though, so link
             # it.
@@ -124,18 +260,12 @@ class Decompressor:
             fd.close()
             st = os.stat(name)
             os.chmod(name, st.st_mode | stat.S_IEXEC)
+            tempdest = tempfile.mktemp(dir=dest)
             archive = subprocess.Popen([name, "-o{}".format(tempdest)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
             archive.communicate()
             logger.debug("executable file")
             os.remove(name)
-
-        try:
-            dir_path = glob(os.path.join(tempdest, dir))[0]
-        except IndexError:
-            raise BaseException("Couldn't find {} in tarball".format(dir))
-        for filename in os.listdir(dir_path):
-            shutil.move(os.path.join(dir_path, filename), os.path.join(dest, filename))
-        shutil.rmtree(tempdest)
+            self._move_content(tempdest, dir, dest, include, exclude)
 
     def _one_done(self, future):
         """Callback that will be called once one decompress finishes.
@@ -161,3 +291,160 @@ class Decompressor:
         """
         logger.info("All pending decompression done to {} done.".format([self._orders[fd].dest for fd in self._orders]))
         self._done_callback(self._decompressed)
+
+
+def _remove_unselected(path, include, exclude):
+    """Remove path content not selected by include and exclude glob lists"""
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+        for name in filenames + dirnames:
+            member_path = os.path.join(dirpath, name)
+            if is_selected(os.path.relpath(member_path, path), include, exclude):
+                continue
+            if os.path.isdir(member_path) and not os.path.islink(member_path):
+                # parent directories of selected content aren't empty
+                with suppress(OSError):
+                    os.rmdir(member_path)
+            else:
+                os.remove(member_path)
+
+
+def _merge_move(src, dst):
+    """Move src to dst, merging the content of src into dst if both are directories"""
+    if os.path.isdir(src) and not os.path.islink(src) and os.path.isdir(dst) and not os.path.islink(dst):
+        for name in os.listdir(src):
+            _merge_move(os.path.join(src, name), os.path.join(dst, name))
+        shutil.copymode(src, dst)
+        return
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        shutil.rmtree(dst)
+    elif os.path.lexists(dst):
+        os.remove(dst)
+    shutil.move(src, dst)
+
+
+def _extract_zip_members(filename, members, path, pwd):
+    """Extract members, as (index, name to extract it to) pairs, of filename zip archive to path, in a worker
+    process"""
+    with Decompressor.ZipFileWithPerm(filename) as archive:
+        infolist = archive.infolist()
+        for index, name in members:
+            archive._extract_as(infolist[index], name, path, pwd)
+
+
+class StreamDecompressor(io.RawIOBase):
+    """Writable file extracting the tar archive written to it in a separate thread, as it arrives.
+
+    Content is staged in the name directory, created in staging_dir (the user cache directory by default). Once the
+    whole archive is written, finish() waits for its extraction to complete and it can then be handed over to
+    Decompressor like any other archive, which only moves the staged content in place. Closing it removes the staged
+    content, and what runs interrupted before doing it left in staging_dir is removed by the next one."""
+
+    # archives which can be extracted as a stream
+    EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.xz", ".txz", ".tar.bz2", ".tbz2", ".tbz")
+    # prefix of the staging directories, which are locked as long as they are used
+    PREFIX = ".umake-extracting-"
+    # unlocked staging directories younger than that (in seconds) may not have been locked yet
+    LEFTOVER_MIN_AGE = 60
+
+    def __init__(self, staging_dir=None):
+        super().__init__()
+        staging_dir = staging_dir or get_cache_path("extracting")
+        os.makedirs(staging_dir, exist_ok=True)
+        self.clean_staging_dir(staging_dir)
+        self.name = tempfile.mkdtemp(prefix=self.PREFIX, dir=staging_dir)
+        self._lock = os.open(self.name, os.O_RDONLY)
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        self._start()
+
+    @classmethod
+    def clean_staging_dir(cls, staging_dir):
+        """Remove content staged in staging_dir by runs which were interrupted before moving it in place"""
+        for entry in os.scandir(staging_dir):
+            if not entry.name.startswith(cls.PREFIX):
+                continue
+            with suppress(FileNotFoundError):
+                if (not entry.is_dir(follow_symlinks=False) or
+                        entry.stat(follow_symlinks=False).st_mtime > time.time() - cls.LEFTOVER_MIN_AGE):
+                    continue
+                fd = os.open(entry.path, os.O_RDONLY)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # still used by another run
+                    continue
+                else:
+                    logger.debug("Removing leftover extracted content {}".format(entry.path))
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                finally:
+                    os.close(fd)
+
+    def _start(self):
+        read_fd, write_fd = os.pipe()
+        self._reader = open(read_fd, 'rb')
+        self._writer = open(write_fd, 'wb')
+        self._written = 0
+        self._error = None
+        self._extractor = Thread(target=self._extract, daemon=True)
+        self._extractor.start()
+
+    @classmethod
+    def can_extract(cls, url):
+        """Return True if url looks like an archive we can extract while downloading it"""
+        return url.lower().endswith(cls.EXTENSIONS)
+
+    def _extract(self):
+        try:
+            with tarfile.open(fileobj=self._reader, mode='r|*') as archive:
+                archive.extractall(self.name)
+            # consume any trailing padding so that the writer doesn't block on it
+            while self._reader.read(io.DEFAULT_BUFFER_SIZE):
+                pass
+        except Exception as e:
+            self._error = e
+        finally:
+            self._reader.close()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        try:
+            self._writer.write(data)
+        except BrokenPipeError:
+            # extraction stopped, tell why
+            self._extractor.join()
+            raise BaseException("Couldn't extract archive: {}".format(self._error))
+        self._written += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._written
+
+    def restart(self):
+        """Discard what was extracted so far, so that the archive can be written again from its start"""
+        self._stop()
+        # the staging directory itself is kept, along with its lock
+        for entry in os.scandir(self.name):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+        self._start()
+
+    def _stop(self):
+        with suppress(BrokenPipeError):
+            self._writer.close()
+        self._extractor.join()
+
+    def finish(self):
+        """Wait for the archive to be completely extracted. Raise if it couldn't be"""
+        self._stop()
+        if self._error:
+            raise BaseException("Couldn't extract archive: {}".format(self._error))
+
+    def close(self):
+        if not self.closed:
+            self._stop()
+            shutil.rmtree(self.name, ignore_errors=True)
+            os.close(self._lock)
+        super().close()
@@ -27,6 +27,7 @@ import logging
 from progressbar import ProgressBar
 import os
 import shutil
+from threading import Event
 import umake.frameworks
 from umake.decompressor import Decompressor
 from umake.interactions import InputText, YesNo, LicenseAgreement, DisplayMessage, UnknownProgress
@@ -34,11 +35,79 @@ from umake.network.download_center import DownloadCenter, DownloadItem
 from umake.network.requirements_handler import RequirementsHandler
 from umake.ui import UI
 from umake.tools import MainLoop, strip_tags, launcher_exists, get_icon_path, get_launcher_path, \
-    Checksum, remove_framework_envs_from_user, add_exec_link
+    Checksum, remove_framework_envs_from_user, add_exec_link, ConfigHandler
 
 logger = logging.getLogger(__name__)
 
 
+class _DownloadPageParser:
+    """Parse a download page line by line with the installer parse_license() and parse_download_link()"""
+
+    def __init__(self, installer):
+        self.installer = installer
+        self._reset()
+
+    def _reset(self):
+        self.url = None
+        self.checksum = None
+        self.license_txt = StringIO()
+        self.in_license = False
+        self.in_download = False
+        # set from the main loop, read from the download thread
+        self._found = Event()
+
+    @property
+    def done(self):
+        """Return True once everything we look for is found, and the rest of the page can be ignored"""
+        installer = self.installer
+        if installer.match_last_link or self.url is None or (installer.checksum_type and not self.checksum):
+            return False
+        if installer.expect_license and not installer.auto_accept_license:
+            return self.license_txt.getvalue() != "" and not self.in_license
+        return True
+
+    def parse_line(self, line_content):
+        installer = self.installer
+        if installer.expect_license and not installer.auto_accept_license:
+            self.in_license = installer.parse_license(line_content, self.license_txt, self.in_license)
+
+        # always take the first valid (url, checksum) if not match_last_link is set to True:
+        download = None
+        if self.url is None or (installer.checksum_type and not self.checksum) or installer.match_last_link:
+            (download, self.in_download) = installer.parse_download_link(line_content, self.in_download)
+        if download is not None:
+            (newurl, new_checksum) = download
+            self.url = newurl if newurl is not None else self.url
+            self.checksum = new_checksum if new_checksum is not None else self.checksum
+            if self.url is not None:
+                if installer.checksum_type and self.checksum:
+                    logger.debug("Found download link for {}, checksum: {}".format(self.url, self.checksum))
+                elif not installer.checksum_type:
+                    logger.debug("Found download link for {}".format(self.url))
+
+    def feed(self, url, lines):
+        """DownloadCenter parse_lines callback, return True once we don't need more lines.
+
+        Lines are parsed in the main loop, like installers always did, in the order they arrive, each received block
+        of lines at once. The download thread thus gets a few more blocks once everything is found"""
+        self._feed_in_mainloop(lines)
+        return self._found.is_set()
+
+    @MainLoop.in_mainloop_thread
+    def _feed_in_mainloop(self, lines):
+        if lines is None:
+            # the download restarted from the beginning
+            self._reset()
+            return
+        for line in lines:
+            # lines arriving once everything is found aren't parsed, as if the download had stopped right then
+            if self.done:
+                break
+            self.parse_line(line.decode())
+        if self.done:
+            self._found.set()
+
+
 class BaseInstaller(umake.frameworks.BaseFramework):
 
     DIRECT_COPY_EXT = ['.svg', '.png', '.ico', '.jpg', '.jpeg']
@@ -61,11 +130,15 @@ class BaseInstaller(umake.frameworks.BaseFramework):
         self.download_page = kwargs["download_page"]
         self.checksum_type = kwargs.get("checksum_type", None)
         self.dir_to_decompress_in_tarball = kwargs.get("dir_to_decompress_in_tarball", "")
+        # globs, relative to dir_to_decompress_in_tarball, of the only members to decompress and of those to skip
+        self.include_in_tarball = kwargs.get("include_in_tarball", None)
+        self.exclude_from_tarball = kwargs.get("exclude_from_tarball", None)
         self.required_files_path = kwargs.get("required_files_path", [])
         self.desktop_filename = kwargs.get("desktop_filename", None)
         self.icon_filename = kwargs.get("icon_filename", None)
         self.match_last_link = kwargs.get("match_last_link", False)
         for extra_arg in ["download_page", "checksum_type", "dir_to_decompress_in_tarball",
+                          "include_in_tarball", "exclude_from_tarball",
                           "desktop_filename", "icon_filename", "required_files_path",
                           "match_last_link"]:
             with suppress(KeyError):
@@ -76,6 +149,8 @@ class BaseInstaller(umake.frameworks.BaseFramework):
         self._paths_to_clean = set()
         self._arg_install_path = None
         self.download_requests = []
+        # download page parser, when the page is parsed while being downloaded
+        self._page_parser = None
 
     @property
     def exec_link_name(self):
@@ -176,7 +251,15 @@ class BaseInstaller(umake.frameworks.BaseFramework):
 
     def download_provider_page(self):
         logger.debug("Download application provider page")
-        DownloadCenter([DownloadItem(self.download_page)], self.get_metadata_and_check_license, download=False)
+        self._page_parser = None
+        parse_lines = None
+        # frameworks parsing the page on their own, or looking for the last link, need the whole page
+        if (not self.match_last_link and
+                type(self).get_metadata_and_check_license is BaseInstaller.get_metadata_and_check_license):
+            self._page_parser = _DownloadPageParser(self)
+            parse_lines = self._page_parser.feed
+        DownloadCenter([DownloadItem(self.download_page)], self.get_metadata_and_check_license, download=False,
+                       parse_lines=parse_lines)
 
     def parse_license(self, line, license_txt, in_license):
         """Parse license per line, eventually write to license_txt if it's in the license part.
@@ -202,30 +285,14 @@ class BaseInstaller(umake.frameworks.BaseFramework):
             logger.error("An error occurred while downloading {}: {}".format(self.download_page, error_msg))
             UI.return_main_screen(status_code=1)
 
-        url, checksum = (None, None)
-        with StringIO() as license_txt:
-            in_license = False
-            in_download = False
+        # the page may already have been parsed while being downloaded
+        parser = self._page_parser
+        if parser is None:
+            parser = _DownloadPageParser(self)
             for line in result[self.download_page].buffer:
-                line_content = line.decode()
-
-                if self.expect_license and not self.auto_accept_license:
-                    in_license = self.parse_license(line_content, license_txt, in_license)
-
-                # always take the first valid (url, checksum) if not match_last_link is set to True:
-                download = None
-                if url is None or (self.checksum_type and not checksum) or self.match_last_link:
-                    (download, in_download) = self.parse_download_link(line_content, in_download)
-                if download is not None:
-                    (newurl, new_checksum) = download
-                    url = newurl if newurl is not None else url
-                    checksum = new_checksum if new_checksum is not None else checksum
-                    if url is not None:
-                        if self.checksum_type and checksum:
-                            logger.debug("Found download link for {}, checksum: {}".format(url, checksum))
-                        elif not self.checksum_type:
-                            logger.debug("Found download link for {}".format(url))
-
+                parser.parse_line(line.decode())
+        url, checksum = (parser.url, parser.checksum)
+        with parser.license_txt as license_txt:
             if url is None:
                 logger.error("Download page changed its syntax or is not parsable (url missing)")
                 UI.return_main_screen(status_code=1)
@@ -259,7 +326,14 @@ class BaseInstaller(umake.frameworks.BaseFramework):
         self.pkg_to_install = RequirementsHandler().install_bucket(self.packages_requirements,
                                                                    self.get_progress_requirement,
                                                                    self.requirement_done)
-        DownloadCenter(urls=self.download_requests, on_done=self.download_done, report=self.get_progress_download)
+        # tar archives can be extracted while they download, instead of once written to disk, with:
+        # download:
+        #   extract_while_downloading: true
+        # They are staged next to the install path, so that they are moved in place with a rename.
+        download_config = (ConfigHandler().config or {}).get("download") or {}
+        DownloadCenter(urls=self.download_requests, on_done=self.download_done, report=self.get_progress_download,
+                       extract=bool(download_config.get("extract_while_downloading", False)),
+                       extract_dir=os.path.dirname(os.path.normpath(self.install_path)))
 
     @MainLoop.in_mainloop_thread
     def get_progress(self, progress_download, progress_requirement):
@@ -395,7 +469,9 @@ class BaseInstaller(umake.frameworks.BaseFramework):
                 shutil.copy2(fd.name, os.path.join(self.install_path, os.path.basename(fd.name)))
             else:
                 decompress_fds[fd] = Decompressor.DecompressOrder(dir=self.dir_to_decompress_in_tarball,
-                                                                  dest=self.install_path)
+                                                                  dest=self.install_path,
+                                                                  include=self.include_in_tarball,
+                                                                  exclude=self.exclude_from_tarball)
         Decompressor(decompress_fds, self.decompress_and_install_done)
         UI.display(UnknownProgress(self.iterate_until_install_done))
 
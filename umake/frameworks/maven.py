@@ -54,10 +54,15 @@ class MavenLang(umake.frameworks.baseinstaller.BaseInstaller):
                          required_files_path=[os.path.join("bin", "mvn")],
                          **kwargs)
         self.checksum_url = None
+        self.mirror_url = None
 
     def parse_download_link(self, line, in_download):
         """Parse Maven download link, expect to find a url"""
         url_found = False
+        # the download page suggests a close apache mirror
+        p = re.search(r'href="([^"]*-bin\.tar\.gz)"', line)
+        if p:
+            self.mirror_url = p.group(1)
         if '-bin.tar.gz.md5' in line:
             in_download = True
         else:
@@ -106,7 +111,10 @@ class MavenLang(umake.frameworks.baseinstaller.BaseInstaller):
             logger.error("Download page changed its syntax or is not parsable (missing sha512)")
             UI.return_main_screen(status_code=1)
         logger.debug("Found download link for {}, checksum: {}".format(url, checksum))
-        self.download_requests.append(DownloadItem(url, Checksum(self.checksum_type, checksum)))
+        mirrors = None
+        if self.mirror_url and os.path.basename(self.mirror_url) == os.path.basename(url):
+            mirrors = [self.mirror_url]
+        self.download_requests.append(DownloadItem(url, Checksum(self.checksum_type, checksum), mirrors=mirrors))
         self.start_download_and_install()
 
     def post_install(self):
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module delivering a local cache of downloaded artifacts, addressed by their content"""
+
+from contextlib import suppress
+import hashlib
+import io
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+
+from umake import settings
+from umake.tools import ConfigHandler, get_cache_path, root_lock
+
+logger = logging.getLogger(__name__)
+
+
+class _CachedArtifactFile(io.BufferedReader):
+    """A private link to a cached artifact, removed from disk once closed"""
+
+    def __init__(self, path):
+        super().__init__(io.FileIO(path, 'rb'))
+
+    def close(self):
+        super().close()
+        with suppress(FileNotFoundError):
+            os.remove(self.name)
+
+
+class ArtifactCache:
+    """Keep downloaded artifacts to avoid downloading them again.
+
+    Artifacts are keyed by their checksum, or by their url and ETag if they don't have any. The least recently
+    used artifacts are evicted once the cache is bigger than its max_size quota. The url they were downloaded from
+    is kept along, for older versions of an artifact to be found back as delta download seeds.
+    The cache is disabled by default. It is enabled, and configured, with a cache section in the configuration
+    file ($XDG_CONFIG_HOME/umake):
+    cache:
+      path: /var/cache/umake (default is $XDG_CACHE_HOME/umake/artifacts)
+      max_size: maximum cache size in bytes, 0 (the default) disabling the cache
+    """
+
+    # directory where private links to cached artifacts in use are created
+    OPEN_DIR = "open"
+    # links older than that (in seconds) are leftovers from an interrupted run
+    OPEN_MAX_AGE = 24 * 3600
+    # directory where the url of each artifact is kept
+    INDEX_DIR = "index"
+
+    def __init__(self):
+        config = (ConfigHandler().config or {}).get("cache") or {}
+        self.path = config.get("path", get_cache_path("artifacts"))
+        self.max_size = int(config.get("max_size", settings.DEFAULT_ARTIFACT_CACHE_MAX_SIZE))
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    @staticmethod
+    def key_for(url, checksum=None, etag=None):
+        """Return the cache key for this artifact, None if it can't be identified"""
+        if checksum and checksum.checksum_value:
+            return "{}-{}".format(checksum.checksum_type.value, checksum.checksum_value.lower())
+        # weak etags don't guarantee byte to byte identical content
+        if etag and not etag.startswith("W/"):
+            return "url-{}".format(hashlib.sha256("{}\n{}".format(url, etag).encode()).hexdigest())
+        return None
+
+    def _entries(self):
+        """Return cached artifacts DirEntry, least recently used first"""
+        entries = []
+        with suppress(FileNotFoundError):
+            for entry in os.scandir(self.path):
+                with suppress(FileNotFoundError):
+                    if entry.is_file(follow_symlinks=False) and not entry.name.endswith(".tmp"):
+                        entries.append((entry.stat().st_mtime, entry))
+        return [entry for (mtime, entry) in sorted(entries, key=lambda e: e[0])]
+
+    def open(self, key, suffix=""):
+        """Return a file object on the cached artifact for key, None if it isn't cached.
+
+        The file object is private to the caller, it can be freely closed even if the artifact is evicted meanwhile"""
+        if not key or not self.enabled:
+            return None
+        cached_path = os.path.join(self.path, key)
+        link_path = os.path.join(self.path, self.OPEN_DIR, uuid.uuid4().hex + suffix)
+        # We want to ensure that we don't create files as root
+        with root_lock:
+            try:
+                os.makedirs(os.path.dirname(link_path), exist_ok=True)
+                os.link(cached_path, link_path)
+            except FileNotFoundError:
+                return None
+            except OSError:
+                shutil.copyfile(cached_path, link_path)
+        # mark as recently used
+        with suppress(FileNotFoundError):
+            os.utime(cached_path)
+        logger.info("Using cached artifact {}".format(key))
+        return _CachedArtifactFile(link_path)
+
+    def add(self, key, path, url=None):
+        """Store file at path under key, downloaded from url, evicting least recently used artifacts if needed"""
+        if not key or not self.enabled:
+            return
+        if os.path.getsize(path) > self.max_size:
+            logger.debug("{} is bigger than the whole artifact cache, don't store it".format(path))
+            return
+        cached_path = os.path.join(self.path, key)
+        tmp_path = "{}.{}.tmp".format(cached_path, uuid.uuid4().hex)
+        with root_lock:
+            os.makedirs(self.path, exist_ok=True)
+            try:
+                os.link(path, tmp_path)
+            except OSError:
+                shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, cached_path)
+            os.utime(cached_path)
+            if url:
+                os.makedirs(os.path.join(self.path, self.INDEX_DIR), exist_ok=True)
+                with open(os.path.join(self.path, self.INDEX_DIR, key), 'w') as f:
+                    f.write(url)
+        logger.debug("Stored {} in artifact cache as {}".format(path, key))
+        self.evict()
+
+    def evict(self, max_size=None):
+        """Remove least recently used artifacts until the cache fits in max_size (default to the cache quota)"""
+        if max_size is None:
+            max_size = self.max_size
+        entries = self._entries()
+        total_size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total_size <= max_size:
+                break
+            logger.info("Evicting {} from artifact cache".format(entry.name))
+            with suppress(FileNotFoundError):
+                total_size -= entry.stat().st_size
+                os.remove(entry.path)
+            with suppress(FileNotFoundError):
+                os.remove(os.path.join(self.path, self.INDEX_DIR, entry.name))
+
+    def prune(self):
+        """Remove every cached artifact"""
+        self.evict(max_size=0)
+        with suppress(FileNotFoundError):
+            for entry in os.scandir(os.path.join(self.path, self.OPEN_DIR)):
+                # recent links may still be used by a running Ubuntu Make instance
+                with suppress(FileNotFoundError):
+                    if entry.stat().st_mtime < time.time() - self.OPEN_MAX_AGE:
+                        os.remove(entry.path)
+
+    @staticmethod
+    def _release_pattern(url):
+        """Return url with its numbers masked, shared by all releases of the same artifact"""
+        return re.sub(r'\d+', '#', url)
+
+    def find_seed(self, url, suffix=""):
+        """Return a file object on the most recently used artifact downloaded from another release of url, None
+        if there is none"""
+        if not self.enabled:
+            return None
+        release_pattern = self._release_pattern(url)
+        for entry in reversed(self._entries()):
+            try:
+                with open(os.path.join(self.path, self.INDEX_DIR, entry.name)) as f:
+                    artifact_url = f.read()
+            except OSError:
+                continue
+            if self._release_pattern(artifact_url) == release_pattern:
+                seed = self.open(entry.name, suffix)
+                if seed:
+                    return seed
+        return None
+
+    def stats(self):
+        """Return a tuple of (number of cached artifacts, total size in bytes)"""
+        entries = self._entries()
+        return len(entries), sum(entry.stat().st_size for entry in entries)
@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module delivering an asyncio download engine, multiplexing every transfer on a single event loop"""
+
+import asyncio
+from collections import defaultdict
+from concurrent import futures
+import contextvars
+import http.client
+from io import BytesIO
+import logging
+import os
+import signal
+import socket
+import ssl
+from threading import Lock, Thread, current_thread, main_thread
+import time
+from urllib.parse import urljoin, urlsplit
+import zlib
+
+import requests
+import requests.certs
+from requests.cookies import MockRequest, MockResponse, RequestsCookieJar, cookiejar_from_dict, get_cookie_header
+import requests.exceptions
+from requests.packages.urllib3.exceptions import ProtocolError
+from requests.structures import CaseInsensitiveDict
+import requests.utils
+from umake.network.request_trace import RequestTrace
+from umake.tools import ConfigHandler, Singleton
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncResponse:
+    """Response to a GET request sent by AsyncDownloadEngine, its content being read on demand.
+
+    Closing it once its content is completely read hands its connection back for next requests to the same host."""
+
+    def __init__(self, engine, key, reader, writer, url, status_code, reason, message, keep_alive):
+        self._engine = engine
+        self._key = key
+        self._reader = reader
+        self._writer = writer
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = CaseInsensitiveDict(message.items())
+        self.message = message
+        self.cookies = None
+        # redirected responses leading to this one
+        self.history = []
+        self._keep_alive = keep_alive
+        self._position = 0
+        self._chunked = 'chunked' in self.headers.get('transfer-encoding', '').lower()
+        self._remaining = None
+        if status_code in (204, 304) or status_code < 200:
+            self._remaining = 0
+        elif not self._chunked and 'content-length' in self.headers:
+            self._remaining = int(self.headers['content-length'])
+        elif not self._chunked:
+            # content ends with the connection
+            self._keep_alive = False
+        # remaining bytes in the current chunk of chunked content
+        self._chunk_remaining = 0
+        self._complete = self._remaining == 0
+        self._closed = False
+        encoding = self.headers.get('content-encoding', 'identity').lower()
+        self._decoder = None
+        if encoding == 'gzip':
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._decoder = zlib.decompressobj()
+
+    @property
+    def closed(self):
+        return self._closed or self._complete
+
+    def tell(self):
+        """Return how many bytes of content were received, before decoding"""
+        return self._position
+
+    def raise_for_status(self):
+        """Raise an HTTPError for error status codes, like requests does"""
+        if 400 <= self.status_code < 600:
+            kind = "Client" if self.status_code < 500 else "Server"
+            raise requests.exceptions.HTTPError("{} {} Error: {} for url: {}".format(
+                self.status_code, kind, self.reason, self.url), response=self)
+
+    async def read(self, amt, decode_content=True):
+        """Return up to amt bytes of content as soon as some are available, b'' once it's completely read"""
+        while True:
+            data = await self._read_raw(amt)
+            if not decode_content or not self._decoder:
+                return data
+            if not data:
+                data, self._decoder = self._decoder.flush(), None
+                return data
+            data = self._decoder.decompress(data)
+            # a compressed chunk may not be enough to decode anything
+            if data:
+                return data
+
+    async def _read_raw(self, amt):
+        if self._complete or self._closed:
+            return b''
+        if self._chunked:
+            if not self._chunk_remaining:
+                size_line = await self._engine.wait(self._reader.readline())
+                try:
+                    self._chunk_remaining = int(size_line.split(b';')[0], 16)
+                except ValueError:
+                    raise ProtocolError("Invalid chunk size: {}".format(size_line))
+                if not self._chunk_remaining:
+                    # skip trailers
+                    while (await self._engine.wait(self._reader.readline())).strip():
+                        pass
+                    return self._finish()
+            data = await self._engine.wait(self._reader.read(min(amt, self._chunk_remaining)))
+            if not data:
+                raise ProtocolError("Connection broken after {} bytes".format(self._position))
+            self._chunk_remaining -= len(data)
+            if not self._chunk_remaining:
+                await self._engine.wait(self._reader.readline())
+        elif self._remaining is not None:
+            data = await self._engine.wait(self._reader.read(min(amt, self._remaining)))
+            if not data:
+                raise ProtocolError("Connection broken: {} bytes read, {} more expected".format(
+                    self._position, self._remaining))
+            self._remaining -= len(data)
+            if not self._remaining:
+                self._finish()
+        else:
+            data = await self._engine.wait(self._reader.read(amt))
+            if not data:
+                return self._finish()
+        self._position += len(data)
+        return data
+
+    def _finish(self):
+        self._complete = True
+        self.close()
+        return b''
+
+    async def discard(self):
+        """Read and forget the remaining content, if small enough to keep the connection, then close it"""
+        if self._remaining is not None and self._remaining <= AsyncDownloadEngine.READ_SIZE:
+            while await self._read_raw(AsyncDownloadEngine.READ_SIZE):
+                pass
+        self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._engine.release_connection(self._key, self._reader, self._writer,
+                                        reusable=self._complete and self._keep_alive)
+
+
+class AsyncDownloadEngine(metaclass=Singleton):
+    """Run http(s) transfers as tasks of one asyncio event loop, living in its own thread.
+
+    It's an alternative to DownloadScheduler threads for DownloadCenter, enabled with:
+    download:
+      engine: asyncio
+    Connections are kept alive and limited per host (max_per_host). Content is only read once the previous block
+    was handled: the socket is paused meanwhile, so that slow disks throttle transfers instead of filling memory.
+    Disk writes and hashing run in worker threads (run_blocking), so that they never hold up other transfers.
+
+    Ctrl-C cancels every transfer, closing its connection and destination, before terminating as usual."""
+
+    SCHEMES = ("http", "https")
+    MAX_PER_HOST = 4
+    MAX_REDIRECTS = 30
+    # in seconds
+    CONNECT_TIMEOUT = 30
+    STALL_TIMEOUT = 60
+    READ_SIZE = 1024 * 256
+    # received content buffered before the socket is paused
+    BUFFER_LIMIT = 1024 * 1024
+    # in seconds, time given to cancelled transfers to clean up on Ctrl-C
+    CANCEL_TIMEOUT = 5
+
+    def __init__(self):
+        config = (ConfigHandler().config or {}).get("download") or {}
+        self.max_per_host = max(int(config.get("max_per_host", self.MAX_PER_HOST)), 1)
+        self._ssl_context = ssl.create_default_context(cafile=os.environ.get('REQUESTS_CA_BUNDLE') or
+                                                       requests.certs.where())
+        # (scheme, host, port): [(reader, writer)]
+        self._idle_connections = defaultdict(list)
+        # (scheme, host, port): semaphore limiting simultaneous transfers
+        self._host_slots = {}
+        # future: coroutine
+        self._futures = {}
+        self._futures_lock = Lock()
+        self._loop = asyncio.new_event_loop()
+        Thread(target=self._loop.run_forever, name="AsyncDownloadEngine", daemon=True).start()
+        # signal handlers can only be set from the main thread
+        self._sigint_handler = signal.SIG_DFL
+        if current_thread() is main_thread() and signal.getsignal(signal.SIGINT) != signal.SIG_IGN:
+            # None when it wasn't set from python
+            self._sigint_handler = signal.signal(signal.SIGINT, self._interrupt) or signal.SIG_DFL
+
+    @staticmethod
+    def is_enabled():
+        """Return True if the configuration selects this engine"""
+        return ((ConfigHandler().config or {}).get("download") or {}).get("engine") == "asyncio"
+
+    @classmethod
+    def can_fetch(cls, url):
+        """Return True if url can be fetched by this engine"""
+        # proxies are left to requests
+        return urlsplit(url).scheme in cls.SCHEMES and not requests.utils.get_environ_proxies(url)
+
+    def submit(self, coroutine):
+        """Run coroutine on the event loop. Return a concurrent.futures.Future of its result"""
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+        with self._futures_lock:
+            self._futures[future] = coroutine
+        future.add_done_callback(self._forget)
+        return future
+
+    def _forget(self, future):
+        with self._futures_lock:
+            self._futures.pop(future, None)
+
+    def cancel(self, transfers=None):
+        """Cancel pending transfers, given as futures returned by submit (every one by default), closing their
+        connections.
+
+        Return their futures, only done once the transfers cleaned up after themselves"""
+        with self._futures_lock:
+            pending = [future for future in (self._futures if transfers is None else transfers)
+                       if future in self._futures]
+            coroutines = {self._futures[future] for future in pending}
+        # cancelling the futures directly would report them as done while their tasks are still running
+        self._loop.call_soon_threadsafe(self._cancel_tasks, coroutines)
+        return pending
+
+    def _cancel_tasks(self, coroutines):
+        for task in asyncio.all_tasks(self._loop):
+            if task.get_coro() in coroutines:
+                task.cancel()
+
+    def _interrupt(self, signum, frame):
+        """Cancel transfers on Ctrl-C, then hand over to the previous SIGINT handler"""
+        logger.info("Interrupted, cancelling pending downloads")
+        futures.wait(self.cancel(), timeout=self.CANCEL_TIMEOUT)
+        signal.signal(signal.SIGINT, self._sigint_handler)
+        if callable(self._sigint_handler):
+            self._sigint_handler(signum, frame)
+        else:
+            # terminate like SIG_DFL would have
+            os.kill(os.getpid(), signal.SIGINT)
+
+    async def run_blocking(self, function, *args):
+        """Return function(*args), run in a worker thread so that the event loop keeps serving other transfers.
+
+        function sees the context of the calling task, like its RequestTrace. If the task is cancelled, wait for
+        function to return before raising, so that nothing still uses what the task cleans up"""
+        future = self._loop.run_in_executor(None, contextvars.copy_context().run, function, *args)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            await asyncio.wait([future])
+            raise
+
+    async def wait(self, awaitable, timeout=None):
+        """Await awaitable, raising a ReadTimeout if nothing happened after timeout (STALL_TIMEOUT by default)"""
+        try:
+            return await asyncio.wait_for(awaitable, timeout or self.STALL_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise requests.exceptions.ReadTimeout("Nothing received for {} seconds".format(
+                timeout or self.STALL_TIMEOUT))
+
+    async def get(self, url, headers=None, cookies=None):
+        """Send a GET request to url, following redirections. Return an AsyncResponse once its headers arrived.
+
+        cookies can be a dictionary or a cookie jar, updated with the ones we get back"""
+        if not isinstance(cookies, RequestsCookieJar):
+            cookies = cookiejar_from_dict(cookies or {})
+        request_headers = requests.utils.default_headers()
+        request_headers.update(headers or {})
+        history = []
+        for redirect in range(self.MAX_REDIRECTS + 1):
+            request = requests.Request('GET', url, headers=request_headers).prepare()
+            response = await self._send(request, get_cookie_header(cookies, request))
+            # like requests, responses only carry the cookies they set, the jar keeps them for next redirections
+            response.cookies = RequestsCookieJar()
+            response.cookies.extract_cookies(MockResponse(response.message), MockRequest(request))
+            cookies.update(response.cookies)
+            location = response.headers.get('location')
+            if response.status_code not in (301, 302, 303, 307, 308) or not location:
+                response.history = history
+                return response
+            history.append(response)
+            await response.discard()
+            url = urljoin(response.url, location)
+            logger.debug("Redirected to {}".format(url))
+        raise requests.exceptions.TooManyRedirects("Exceeded {} redirects.".format(self.MAX_REDIRECTS))
+
+    async def _send(self, request, cookie_header):
+        parsed_url = urlsplit(request.url)
+        default_port = 443 if parsed_url.scheme == "https" else 80
+        key = (parsed_url.scheme, parsed_url.hostname, parsed_url.port or default_port)
+        slot = self._host_slots.setdefault(key, asyncio.Semaphore(self.max_per_host))
+        await slot.acquire()
+        try:
+            target = parsed_url.path or "/"
+            if parsed_url.query:
+                target += "?" + parsed_url.query
+            lines = ["GET {} HTTP/1.1".format(target), "Host: {}".format(parsed_url.netloc.rpartition('@')[2])]
+            lines.extend("{}: {}".format(name, value) for name, value in request.headers.items())
+            if cookie_header:
+                lines.append("Cookie: {}".format(cookie_header))
+            head = ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+
+            while True:
+                reader, writer, reused = await self._acquire_connection(key)
+                try:
+                    writer.write(head)
+                    await self.wait(writer.drain())
+                    status_line = await self.wait(reader.readline())
+                    if not status_line:
+                        raise ConnectionResetError("Connection closed by {}".format(parsed_url.hostname))
+                    break
+                except BaseException as e:
+                    writer.close()
+                    # the server may have closed an idle connection meanwhile
+                    if not isinstance(e, ConnectionError):
+                        raise
+                    if not reused:
+                        raise requests.exceptions.ConnectionError("Connection to {} lost".format(
+                            parsed_url.hostname))
+
+            try:
+                # skip informational responses
+                while True:
+                    version, status_code, reason = self._parse_status_line(status_line)
+                    header_lines = []
+                    while True:
+                        line = await self.wait(reader.readline())
+                        if not line.strip():
+                            break
+                        header_lines.append(line)
+                    if status_code >= 200:
+                        break
+                    status_line = await self.wait(reader.readline())
+                message = http.client.parse_headers(BytesIO(b"".join(header_lines) + b"\r\n"))
+            except BaseException:
+                writer.close()
+                raise
+        except BaseException:
+            slot.release()
+            raise
+        keep_alive = version == "HTTP/1.1" and message.get('connection', '').lower() != 'close'
+        return AsyncResponse(self, key, reader, writer, request.url, status_code, reason, message, keep_alive)
+
+    @staticmethod
+    def _parse_status_line(line):
+        parts = line.decode('latin-1').rstrip("\r\n").split(" ", 2)
+        try:
+            return parts[0], int(parts[1]), parts[2] if len(parts) > 2 else ""
+        except (IndexError, ValueError):
+            raise ProtocolError("Invalid status line: {}".format(line))
+
+    async def _acquire_connection(self, key):
+        """Return (reader, writer, reused) for a connection to key host, reusing an idle one if any"""
+        while self._idle_connections[key]:
+            reader, writer = self._idle_connections[key].pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        try:
+            reader, writer = await asyncio.wait_for(self._open_connection(*key), self.CONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise requests.exceptions.ConnectTimeout("Couldn't connect to {} in {} seconds".format(
+                key[1], self.CONNECT_TIMEOUT))
+        except ssl.SSLError as e:
+            raise requests.exceptions.SSLError(e)
+        except OSError as e:
+            raise requests.exceptions.ConnectionError(e)
+        return reader, writer, False
+
+    async def _open_connection(self, scheme, host, port):
+        """Return (reader, writer) for a new connection to host, timing each step in the current trace"""
+        loop = asyncio.get_running_loop()
+        trace = RequestTrace.current()
+        start = time.monotonic()
+        addresses = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        resolved = time.monotonic()
+        # like socket.create_connection, try every address in turn
+        for family, socktype, proto, canonname, address in addresses:
+            sock = socket.socket(family, socktype, proto)
+            sock.setblocking(False)
+            try:
+                await loop.sock_connect(sock, address)
+                break
+            except BaseException as e:
+                sock.close()
+                if not isinstance(e, OSError):
+                    raise
+                error = e
+        else:
+            raise error
+        connected = time.monotonic()
+        try:
+            reader, writer = await asyncio.open_connection(
+                sock=sock, ssl=self._ssl_context if scheme == "https" else None,
+                server_hostname=host if scheme == "https" else None, limit=self.BUFFER_LIMIT)
+        except BaseException:
+            sock.close()
+            raise
+        if trace:
+            trace.add("dns", resolved - start)
+            trace.add("connect", connected - resolved)
+            trace.add("tls" if scheme == "https" else "connect", time.monotonic() - connected)
+            trace.add_connection()
+        return reader, writer
+
+    def release_connection(self, key, reader, writer, reusable):
+        """Give back a connection once its response is done with, keeping it for next requests if reusable"""
+        if reusable:
+            self._idle_connections[key].append((reader, writer))
+        else:
+            writer.close()
+        self._host_slots[key].release()
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module downloading new releases of an artifact as a delta from a previous one.
+
+Servers publish a block manifest next to each artifact, <url>.blocks, that can be generated with:
+python3 -m umake.network.delta FILE...
+Blocks of the new release found in the previous one (the seed), at any 512 bytes offset, are copied from it, and only
+the other ones are fetched with range requests. This only pays off with uncompressed or stored archives: any change to
+a compressed stream changes all of what follows, so that compressed artifacts are always downloaded in full.
+
+None of the upstreams of the supported frameworks publish those manifests: this is only of use with a mirror
+(see url_rewriter) serving them along with the artifacts, and is thus off unless opted in, see DeltaDownload."""
+
+from contextlib import closing
+import hashlib
+import json
+import logging
+import mmap
+import os
+import sys
+
+import requests.exceptions
+from requests.packages.urllib3.exceptions import HTTPError as TransferError
+
+from umake.tools import ConfigHandler
+
+logger = logging.getLogger(__name__)
+
+
+class DeltaError(Exception):
+    """Raised when a delta download can't be completed, the artifact having to be downloaded in full"""
+
+
+class BlockManifest:
+    """Checksums of the consecutive blocks of a file, stored as json:
+    {"version": 1, "size": file size, "block_size": 4096, "hash": "sha256", "hash_length": 16,
+     "file_hash": checksum of the whole file, "blocks": [truncated checksum of each block as hex]}
+
+    Blocks are only checksummed at multiples of the block size in the new release, but looked up at every 512 bytes
+    in the previous one: tar archives align their members on 512 bytes, so that unchanged members shifted by members
+    added, removed or resized before them are still found."""
+
+    VERSION = 1
+    BLOCK_SIZE = 4096
+    HASH = "sha256"
+    HASH_LENGTH = 16
+
+    def __init__(self, size, block_size, hash_name, hash_length, file_hash, blocks):
+        self.size = size
+        self.block_size = block_size
+        self.hash_name = hash_name
+        self.hash_length = hash_length
+        self.file_hash = file_hash
+        self.blocks = blocks
+
+    def block_hash(self, block):
+        return hashlib.new(self.hash_name, block).digest()[:self.hash_length]
+
+    @classmethod
+    def from_file(cls, path, block_size=BLOCK_SIZE, hash_name=HASH, hash_length=HASH_LENGTH):
+        """Compute the manifest of file at path"""
+        manifest = cls(os.path.getsize(path), block_size, hash_name, hash_length, None, [])
+        file_hasher = hashlib.new(hash_name)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                file_hasher.update(block)
+                manifest.blocks.append(manifest.block_hash(block))
+        manifest.file_hash = file_hasher.hexdigest()
+        return manifest
+
+    @classmethod
+    def loads(cls, content):
+        """Return the manifest serialized in content, raise a DeltaError if it's invalid"""
+        try:
+            data = json.loads(content.decode())
+            if data["version"] != cls.VERSION:
+                raise DeltaError("Unsupported block manifest version {}".format(data["version"]))
+            manifest = cls(int(data["size"]), int(data["block_size"]), data["hash"], int(data["hash_length"]),
+                           data["file_hash"], [bytes.fromhex(block) for block in data["blocks"]])
+            hashlib.new(manifest.hash_name)
+        except (UnicodeDecodeError, ValueError, KeyError, TypeError) as e:
+            raise DeltaError("Invalid block manifest: {}".format(e))
+        if manifest.block_size <= 0 or len(manifest.blocks) != -(-manifest.size // manifest.block_size):
+            raise DeltaError("Block manifest doesn't match its file size")
+        return manifest
+
+    def dumps(self):
+        return json.dumps({"version": self.VERSION, "size": self.size, "block_size": self.block_size,
+                           "hash": self.hash_name, "hash_length": self.hash_length, "file_hash": self.file_hash,
+                           "blocks": [block.hex() for block in self.blocks]}).encode()
+
+
+class DeltaDownload:
+    """Fetch url into dest, reusing the blocks it shares with seed, a previous release of it.
+
+    Off by default, as it needs a server publishing block manifests. Enabled in the configuration file with:
+    download:
+      delta: true"""
+
+    MANIFEST_SUFFIX = ".blocks"
+    # missing blocks separated by less than that many blocks are fetched in a single range, the few blocks we
+    # already have being cheaper to fetch again than another request
+    MERGE_GAP = 4
+    # offsets the seed is looked up at, the alignment of tar archive members
+    SEED_ALIGNMENT = 512
+    # gzip, bzip2, xz and zstd streams, whose blocks never match those of another release
+    COMPRESSED_MAGICS = (b"\x1f\x8b", b"BZh", b"\xfd7zXZ\x00", b"\x28\xb5\x2f\xfd")
+
+    def __init__(self, session, url, seed, dest, headers=None, cookies=None, timeout=None, report=lambda *args: None):
+        self._session = session
+        self._url = url
+        self._seed = seed
+        self._dest = dest
+        self._headers = headers or {}
+        self._cookies = cookies
+        self._timeout = timeout
+        self._report = report
+        # ETag of the url content, as sent along with ranges
+        self.etag = None
+
+    @staticmethod
+    def is_enabled():
+        return bool(((ConfigHandler().config or {}).get("download") or {}).get("delta", False))
+
+    def _get(self, url, headers=None):
+        return self._session.get(url, stream=True, headers=dict(self._headers, **(headers or {})),
+                                 cookies=self._cookies, timeout=self._timeout)
+
+    def get_manifest(self):
+        """Return the block manifest published for url, None if there is none"""
+        try:
+            with closing(self._get(self._url + self.MANIFEST_SUFFIX)) as r:
+                if r.status_code == 404:
+                    return None
+                r.raise_for_status()
+                return BlockManifest.loads(r.content)
+        except requests.exceptions.RequestException as e:
+            raise DeltaError("Couldn't fetch block manifest of {}: {}".format(self._url, e))
+
+    def _is_compressed(self):
+        header = os.pread(self._seed.fileno(), max(len(magic) for magic in self.COMPRESSED_MAGICS), 0)
+        return header.startswith(self.COMPRESSED_MAGICS)
+
+    def _index_seed(self, manifest):
+        """Return a dict of the manifest block checksums found in the seed, at any SEED_ALIGNMENT offset, to their
+        offsets there"""
+        wanted = set(manifest.blocks)
+        # the last block of the manifest may be shorter than the others
+        lengths = {manifest.block_size, manifest.size % manifest.block_size or manifest.block_size}
+        index = {}
+        size = os.fstat(self._seed.fileno()).st_size
+        if not size:
+            return index
+        with mmap.mmap(self._seed.fileno(), 0, access=mmap.ACCESS_READ) as seed:
+            for offset in range(0, size, self.SEED_ALIGNMENT):
+                for length in lengths:
+                    if offset + length > size:
+                        continue
+                    block_hash = manifest.block_hash(seed[offset:offset + length])
+                    if block_hash in wanted:
+                        index.setdefault(block_hash, offset)
+        return index
+
+    def _missing_ranges(self, manifest, missing_blocks):
+        """Return (start, end) byte ranges covering missing_blocks, merging close ones"""
+        ranges = []
+        for block in missing_blocks:
+            start = block * manifest.block_size
+            end = min(start + manifest.block_size, manifest.size) - 1
+            if ranges and block - ranges[-1][1] // manifest.block_size <= self.MERGE_GAP:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return ranges
+
+    def fetch(self):
+        """Fetch url into dest. Return False if there is no manifest to do it as a delta, raise a DeltaError if it
+        failed along the way"""
+        if self._is_compressed():
+            logger.debug("{} is compressed, it can't be downloaded as a delta".format(self._url))
+            return False
+        manifest = self.get_manifest()
+        if not manifest:
+            logger.debug("No block manifest for {}, can't download it as a delta".format(self._url))
+            return False
+        seed_index = self._index_seed(manifest)
+
+        fd = self._dest.fileno()
+        os.ftruncate(fd, manifest.size)
+        reused = 0
+        missing_blocks = []
+        for block, block_hash in enumerate(manifest.blocks):
+            seed_offset = seed_index.get(block_hash)
+            length = min(manifest.block_size, manifest.size - block * manifest.block_size)
+            data = os.pread(self._seed.fileno(), length, seed_offset) if seed_offset is not None else b''
+            if len(data) != length:
+                missing_blocks.append(block)
+                continue
+            os.pwrite(fd, data, block * manifest.block_size)
+            reused += length
+        self._report(reused, manifest.size)
+
+        fetched = 0
+        for start, end in self._missing_ranges(manifest, missing_blocks):
+            try:
+                with closing(self._get(self._url, {"Range": "bytes={}-{}".format(start, end)})) as r:
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        raise DeltaError("{} didn't honour range request".format(self._url))
+                    self.etag = r.headers.get("etag")
+                    position = start
+                    for data in r.iter_content(1024 * 64):
+                        data = data[:end + 1 - position]
+                        os.pwrite(fd, data, position)
+                        position += len(data)
+                        fetched += len(data)
+                        # merged ranges fetch again some blocks we had
+                        self._report(min(reused + fetched, manifest.size), manifest.size)
+                    if position != end + 1:
+                        raise DeltaError("Range {}-{} of {} is incomplete".format(start, end, self._url))
+            except (TransferError, requests.exceptions.RequestException) as e:
+                raise DeltaError("Couldn't fetch range {}-{} of {}: {}".format(start, end, self._url, e))
+
+        file_hasher = hashlib.new(manifest.hash_name)
+        self._dest.seek(0)
+        for data in iter(lambda: self._dest.read(1024 * 1024), b''):
+            file_hasher.update(data)
+        if file_hasher.hexdigest() != manifest.file_hash:
+            raise DeltaError("{} rebuilt from its delta doesn't match its manifest".format(self._url))
+        logger.info("Downloaded {} as a delta: fetched {} of {} bytes, the rest coming from a previous release".format(
+            self._url, fetched, manifest.size))
+        return True
+
+
+def main(paths):
+    """Write the block manifest of each file next to it"""
+    for path in paths:
+        with open(path + DeltaDownload.MANIFEST_SUFFIX, 'wb') as f:
+            f.write(BlockManifest.from_file(path).dumps())
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -19,70 +19,253 @@
 
 """Module delivering a DownloadCenter to download in parallel multiple requests"""
 
+import asyncio
 from collections import namedtuple
 from concurrent import futures
-from contextlib import closing
+from contextlib import closing, suppress
+import contextvars
+import fcntl
 import hashlib
-from io import BytesIO
+import io
+import json
 import logging
 import os
+import shutil
 import tempfile
+from threading import Event, Lock
+import time
 
 import requests
+import requests.adapters
 import requests.exceptions
+from requests.packages.urllib3.exceptions import HTTPError as TransferError
+from umake.decompressor import StreamDecompressor
+from umake.network.artifact_cache import ArtifactCache
+from umake.network.async_engine import AsyncDownloadEngine
+from umake.network.delta import DeltaDownload, DeltaError
+from umake.network.download_progress import DownloadProgress
+from umake.network.download_scheduler import DownloadScheduler
+from umake.network.file_adapter import FileAdapter
 from umake.network.ftp_adapter import FTPAdapter
-from umake.tools import ChecksumType, root_lock
+from umake.network.page_cache import PageCache
+from umake.network.request_trace import RequestTrace, TimedHasher, TraceWriter, TracingHTTPAdapter, record_bytes, \
+    timed_request
+from umake.network.retry_policy import CircuitBreaker, RetryPolicy
+from umake.network.url_rewriter import UrlRewriter
+from umake import settings
+from umake.tools import ChecksumType, ConfigHandler, Singleton, get_cache_path, root_lock
 
 logger = logging.getLogger(__name__)
 
 
-class DownloadItem(namedtuple('DownloadItem', ['url', 'checksum', 'headers', 'ignore_encoding', 'cookies'])):
+class DownloadItem(namedtuple('DownloadItem', ['url', 'checksum', 'headers', 'ignore_encoding', 'cookies',
+                                               'mirrors'])):
     """An individual item to be downloaded and checked.
 
     Checksum should be an instance of tools.Checksum, if provided.
     Headers should be a dictionary of HTTP headers, if provided.
-    Cookies should be a cookie dictionary, if provided."""
-    def __new__(cls, url, checksum=None, headers=None, ignore_encoding=False, cookies=None):
-        return super().__new__(cls, url, checksum, headers, ignore_encoding, cookies)
+    Cookies should be a cookie dictionary, if provided.
+    Mirrors should be a list of other urls serving the same content, if provided. The fastest of url and mirrors
+    is used, others taking over if it fails. Results are still keyed by url.
+    Urls and mirrors are rewritten following UrlRewriter configured rules."""
+    def __new__(cls, url, checksum=None, headers=None, ignore_encoding=False, cookies=None, mirrors=None):
+        return super().__new__(cls, url, checksum, headers, ignore_encoding, cookies, mirrors)
+
+
+class SessionPool(metaclass=Singleton):
+    """Process-wide pool of HTTP(S) connections, kept alive and shared by every download.
+
+    Each download still gets its own session, so that cookies don't leak from one download to another, but they
+    all go through the same connection pools: we only pay DNS, TCP and TLS handshakes once per host."""
+
+    # number of hosts we keep connections to
+    POOL_CONNECTIONS = 16
+
+    def __init__(self):
+        # DownloadScheduler already limits downloads per host, so we never wait for a free connection, which one
+        # download holding several could never release. The pools are big enough to keep every connection the
+        # scheduler lets downloads open to one host: their segments and a failover connection
+        pool_maxsize = DownloadScheduler().max_workers * (DownloadCenter.SEGMENTS + 1)
+        self._http_adapter = TracingHTTPAdapter(pool_connections=self.POOL_CONNECTIONS, pool_maxsize=pool_maxsize)
+        self._ftp_adapter = FTPAdapter()
+
+    def new_session(self):
+        """Return a new session using the shared connection pools"""
+        session = requests.Session()
+        session.mount('http://', self._http_adapter)
+        session.mount('https://', self._http_adapter)
+        session.mount('ftp://', self._ftp_adapter)
+        session.mount('file://', FileAdapter())
+        return session
+
+
+class PartialDownload(io.BufferedRandom):
+    """A download target living under a stable path in the staging area, so that it can be resumed later on.
+
+    The remote content validator (ETag or Last-Modified) is saved next to it. Closing it removes it from disk
+    unless it's marked as resumable, like the temporary files we use otherwise."""
+
+    # staged downloads which weren't touched for that long (in seconds) are considered abandoned
+    MAX_AGE = 7 * 24 * 3600
+
+    def __init__(self, url, suffix=""):
+        """Open (or create) the partial download for url.
+
+        Raise BlockingIOError if another process is currently downloading it"""
+        staging_dir = self.get_staging_dir()
+        os.makedirs(staging_dir, exist_ok=True)
+        path = os.path.join(staging_dir, hashlib.sha256(url.encode()).hexdigest() + suffix)
+        # don't truncate any previous partial download
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o644))
+        super().__init__(io.FileIO(path, 'r+b'))
+        try:
+            fcntl.flock(self.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            super().close()
+            raise
+        self.meta_path = path + ".json"
+        self.resumable = False
+
+    @staticmethod
+    def get_staging_dir():
+        return get_cache_path("downloads")
+
+    @classmethod
+    def clean_staging_dir(cls):
+        """Remove abandoned partial downloads"""
+        with suppress(FileNotFoundError):
+            for entry in os.scandir(cls.get_staging_dir()):
+                with suppress(FileNotFoundError):
+                    if entry.stat().st_mtime < time.time() - cls.MAX_AGE:
+                        logger.debug("Removing abandoned partial download {}".format(entry.path))
+                        os.remove(entry.path)
+
+    @property
+    def validator(self):
+        """Return the validator of the already downloaded content, None if we can't resume it"""
+        try:
+            with open(self.meta_path) as f:
+                return json.load(f).get("validator")
+        except (OSError, ValueError):
+            return None
+
+    def save_validator(self, response):
+        """Save remote content validator from response headers. Return True if there is any"""
+        validator = response.headers.get("etag") or response.headers.get("last-modified")
+        # weak etags can't be used with If-Range
+        if validator and validator.startswith("W/"):
+            validator = None
+        with open(self.meta_path, 'w') as f:
+            json.dump({"url": response.url, "validator": validator}, f)
+        return validator is not None
+
+    def close(self):
+        super().close()
+        if not self.resumable:
+            for path in (self.name, self.meta_path):
+                with suppress(FileNotFoundError):
+                    os.remove(path)
+
+
+class SpooledBuffer(tempfile.SpooledTemporaryFile):
+    """In memory download target, moving its content to a temporary file once bigger than max_size bytes, so that
+    large pages don't pile up in memory. Like BytesIO, getvalue() returns the whole content.
+
+    max_size is configured in the configuration file with:
+    download:
+      max_buffer_size: 8388608"""
+
+    def __init__(self, max_size=None):
+        if max_size is None:
+            config = (ConfigHandler().config or {}).get("download") or {}
+            max_size = int(config.get("max_buffer_size", settings.DEFAULT_MAX_BUFFER_SIZE))
+        super().__init__(max_size=max_size)
+
+    def getvalue(self):
+        if not self._rolled:
+            return self._file.getvalue()
+        position = self.tell()
+        self.seek(0)
+        content = self.read()
+        self.seek(position)
+        return content
 
 
 class DownloadCenter:
-    """Read or download requested urls in separate threads."""
+    """Read or download requested urls on the shared download scheduler threads."""
 
+    # streamed reads start with BLOCK_SIZE chunks, growing up to MAX_BLOCK_SIZE on fast links to save per read
+    # overhead, while a read shouldn't take much longer than BLOCK_TARGET_TIME seconds to keep progress flowing
     BLOCK_SIZE = 1024 * 8  # from urlretrieve code
-    DownloadResult = namedtuple("DownloadResult", ["buffer", "error", "fd", "final_url", "cookies"])
+    MAX_BLOCK_SIZE = 1024 * 1024 * 4
+    BLOCK_TARGET_TIME = 0.05
+    CHECKSUM_ALGORITHMS = {ChecksumType.md5: hashlib.md5,
+                           ChecksumType.sha1: hashlib.sha1,
+                           ChecksumType.sha256: hashlib.sha256,
+                           ChecksumType.sha512: hashlib.sha512}
+    # files bigger than this are fetched in SEGMENTS parallel byte ranges, if the server supports it
+    SEGMENT_MIN_SIZE = 1024 * 1024 * 16
+    SEGMENTS = 4
+    # mirrors are ranked on the time they take to send their first MIRROR_PROBE_SIZE bytes. A mirror not sending
+    # anything for MIRROR_STALL_TIMEOUT seconds is given up for the next one
+    MIRROR_PROBE_SIZE = 1024 * 256
+    MIRROR_CONNECT_TIMEOUT = 10
+    MIRROR_STALL_TIMEOUT = 30
+    DownloadResult = namedtuple("DownloadResult", ["buffer", "error", "fd", "final_url", "cookies", "trace"])
 
-    def __init__(self, urls, on_done, download=True, report=lambda x: None):
+    def __init__(self, urls, on_done, download=True, report=lambda x: None, parse_lines=None, extract=False,
+                 extract_dir=None):
         """Generate a threaded download machine.
 
         urls is a list of DownloadItems to download or read from.
         on_done is the callback that will be called once all those urls are downloaded.
         report, if not None, will be called once any download is in progress, reporting
-        a dict of current download with current/size parameters
+        a dict of current download with current/size/speed/eta parameters. Reports are throttled to
+        DownloadProgress.MIN_INTERVAL, see DownloadProgress for details
+        parse_lines, if not None and download is set to False, will be called from the download thread with the url
+        and the list of lines of content (as bytes) completed by each received block, as soon as it arrives. Once it
+        returns True, lines aren't parsed anymore and the transfer is stopped early (unless there is a checksum to
+        verify): the buffer then only has the content received so far. If the transfer has to restart from the
+        beginning, like when failing over to a mirror which can't resume it, it is called with None as lines: the
+        lines it got so far have to be forgotten.
+        extract, if set to True, extracts tar archives as they download instead of writing them to a temporary
+        file first. The checksum is still verified, the extracted content being discarded if it doesn't match. Their
+        fd is then a StreamDecompressor, which Decompressor only moves in place.
+        extract_dir, if not None, is the directory where extracted content is staged instead of the user cache
+        directory. On the filesystem of the final destination, moving it in place is then only a rename.
 
         The callback will get a dictionary parameter like:
         {
             "url":
-                DownloadResult(buffer=page content as bytes if download is set to False. close() will clean it from
-                                      memory,
+                DownloadResult(buffer=file object on the page content if download is set to False, in memory
+                                      unless it's too big (see SpooledBuffer). close() will clean it,
                                error=string detailing the error which occurred (path and content would be empty),
                                fd=temporary file descriptor. close() will delete it from disk,
                                final_url=the final url, which may be different from the start if there were redirects,
-                               cookies=a dictionary of cookies after the request
+                               cookies=a dictionary of cookies after the request,
+                               trace=RequestTrace with the timings of the download phases, bytes and redirects
                 )
         }
         """
 
         self._done_callback = on_done
-        self._wired_report = report
         self._download_to_file = download
+        self._parse_lines = parse_lines
 
         self._urls = urls
         self._downloaded_content = {}
+        # DownloadScheduler and AsyncDownloadEngine futures of the downloads
+        self._futures = []
+        self._async_futures = []
+
+        self._progress = DownloadProgress(report)
 
-        self._download_progress = {}
+        if download:
+            PartialDownload.clean_staging_dir()
 
-        executor = futures.ThreadPoolExecutor(max_workers=len(urls))
+        # pages and checksums are small and needed first, don't make them wait behind bulk artifacts
+        priority = DownloadScheduler.BULK if download else DownloadScheduler.METADATA
+        use_async_engine = AsyncDownloadEngine.is_enabled()
         for url_request in self._urls:
             # grab the md5sum if any
             # switch between inline memory and temp file
@@ -93,22 +276,59 @@ class DownloadCenter:
                 path, ext = os.path.splitext(url_request.url)
                 # We want to ensure that we don't create files as root
                 root_lock.acquire()
-                dest = tempfile.NamedTemporaryFile(suffix=ext)
-                root_lock.release()
-                logger.info("Start downloading {} to a temp file".format(url_request))
+                try:
+                    if extract and StreamDecompressor.can_extract(url_request.url):
+                        dest = StreamDecompressor(extract_dir)
+                    else:
+                        # stage it so that an interrupted download can be resumed on next run
+                        dest = PartialDownload(url_request.url, suffix=ext)
+                except OSError as e:
+                    logger.info("Can't stage {} download, it won't be resumable: {}".format(url_request.url, e))
+                    dest = tempfile.NamedTemporaryFile(suffix=ext)
+                finally:
+                    root_lock.release()
+                if isinstance(dest, StreamDecompressor):
+                    logger.info("Start downloading and extracting {}".format(url_request))
+                else:
+                    logger.info("Start downloading {} to a temp file".format(url_request))
             else:
-                dest = BytesIO()
+                dest = SpooledBuffer()
                 logger.info("Start downloading {} in memory".format(url_request))
-            future = executor.submit(self._fetch, url_request, dest)
+            trace = RequestTrace(url_request.url)
+            if use_async_engine and self._can_fetch_async(url_request, dest):
+                future = AsyncDownloadEngine().submit(self._traced_async(trace, self._fetch_async(url_request, dest)))
+                self._async_futures.append(future)
+            else:
+                fetch = self._fetch_and_extract if isinstance(dest, StreamDecompressor) else self._fetch
+                future = DownloadScheduler().submit(priority, url_request.url, self._traced, trace, fetch,
+                                                    url_request, dest)
+                self._futures.append(future)
             future.tag_url = url_request.url
+            future.tag_trace = trace
             future.tag_download = download
             future.tag_dest = dest
             future.add_done_callback(self._one_done)
 
+    @staticmethod
+    def _traced(trace, fetch, *args):
+        """Run fetch(*args), recording its timings in trace"""
+        with trace.activate():
+            result = fetch(*args)
+            trace.final_url = result[1]
+            return result
+
+    @staticmethod
+    async def _traced_async(trace, fetch):
+        """Await fetch coroutine, recording its timings in trace"""
+        with trace.activate():
+            result = await fetch
+            trace.final_url = result[1]
+            return result
+
     def _fetch(self, download_item, dest):
         """Get an url content and close the connexion.
 
-        This will write the content to dest and check for md5sum.
+        This will write the content to dest and check for its checksum, computed while downloading.
         Return a tuple of (dest, final_url, cookies)
         """
         url = download_item.url
@@ -116,82 +336,739 @@ class DownloadCenter:
         headers = download_item.headers or {}
         cookies = download_item.cookies
 
-        def _report(block_no, block_size, total_size):
-            current_size = int(block_no * block_size)
-            if total_size != -1:
-                current_size = min(current_size, total_size)
-            self._download_progress[url] = {"current": current_size, "size": total_size}
-            logger.debug("Deliver download update: {} of {}".format(self._download_progress, total_size))
-            self._wired_report(self._download_progress)
+        hasher = self._new_hasher(checksum)
+
+        def _report(current_size, total_size):
+            self._progress.update(url, current_size, total_size)
+
+        parse_lines = self._parse_lines if isinstance(dest, SpooledBuffer) else None
+        # content after the last line break, waiting for the rest of its line
+        pending_line = [b'']
+
+        def _parse_block(data, last=False):
+            """Feed the lines data completes to parse_lines, all at once. Return True once it doesn't want more"""
+            content = pending_line[0] + data
+            lines = []
+            start = 0
+            end = content.find(b'\n')
+            while end != -1:
+                lines.append(content[start:end + 1])
+                start = end + 1
+                end = content.find(b'\n', start)
+            pending_line[0] = content[start:]
+            if last and pending_line[0]:
+                lines.append(pending_line[0])
+            return bool(lines) and parse_lines(url, lines)
+
+        # serve artifacts we already downloaded once from the cache, without any network access
+        cache = None
+        if not isinstance(dest, SpooledBuffer):
+            cache = ArtifactCache()
+            cached = self._open_cached(cache, cache.key_for(url, checksum), url, dest)
+            if cached:
+                return cached, url, requests.cookies.cookiejar_from_dict(cookies or {})
+
+        offset, request_headers = self._resume_headers(url, dest, headers)
 
         # Requests support redirection out of the box.
-        # Create a session so we can mount our own FTP adapter.
-        session = requests.Session()
-        session.mount('ftp://', FTPAdapter())
+        # Sessions share pooled connections and have our own FTP and file adapters mounted.
+        session = SessionPool().new_session()
+        # urls to fetch from, in order, the next ones taking over if one fails: from the fastest to the slowest
+        # mirror, then upstream ones if they were rewritten
+        upstream_urls = [url] + list(download_item.mirrors or [])
+        rewriter = UrlRewriter()
+        mirrors = [rewriter.rewrite(upstream_url) for upstream_url in upstream_urls]
+        fallbacks = []
+        if rewriter.fallback:
+            fallbacks = [upstream_url for upstream_url in upstream_urls if upstream_url not in mirrors]
+        timeout = None
+        if len(mirrors) + len(fallbacks) > 1:
+            timeout = (self.MIRROR_CONNECT_TIMEOUT, self.MIRROR_STALL_TIMEOUT)
+        if len(mirrors) > 1:
+            mirrors = self._rank_mirrors(session, mirrors, headers, cookies, timeout)
+        mirrors += fallbacks
+        fetch_url = mirrors.pop(0)
+        # transient failures of the last url left are retried
+        retry = RetryPolicy()
+
+        def _failover(failed_url, error):
+            """Return (url, response) for the remaining content, from the next mirror or failed_url again if it's worth
+            retrying. Raise error if there is none"""
+            while True:
+                if mirrors:
+                    next_url = mirrors.pop(0)
+                elif retry.retry(failed_url, error):
+                    next_url = failed_url
+                else:
+                    raise error
+                position = dest.tell()
+                logger.warning("Download of {} failed ({}), resuming from {} at byte {}".format(
+                    url, error, next_url, position))
+                try:
+                    response = self._get(session, next_url, stream=True, cookies=cookies, timeout=timeout,
+                                         headers=dict(headers, Range="bytes={}-".format(position)))
+                    response.raise_for_status()
+                    return next_url, response
+                except requests.exceptions.RequestException as e:
+                    failed_url, error = next_url, e
+
+        # upgrades only fetch what changed since the release we downloaded previously
+        if cache and not offset and isinstance(dest, PartialDownload) and DeltaDownload.is_enabled():
+            delta = self._fetch_delta(session, download_item, fetch_url, dest, cache, timeout, _report)
+            if delta:
+                return delta
+
+        # revalidate pages we already fetched once instead of downloading them again
+        page_cache = None
+        cached_page = None
+        stopped_early = False
+        if isinstance(dest, SpooledBuffer):
+            page_cache = PageCache()
+            cached_page = page_cache.get(url, headers, download_item.ignore_encoding)
+            if cached_page:
+                request_headers = dict(headers, **cached_page.validators)
+
         try:
-            with closing(session.get(url, stream=True, headers=headers, cookies=cookies)) as r:
-                r.raise_for_status()
-                content_size = int(r.headers.get('content-length', -1))
+            while True:
+                r = None
+                try:
+                    r = self._get(session, fetch_url, stream=True, headers=request_headers, cookies=cookies,
+                                  timeout=timeout)
+                    if r.status_code == 416 and offset:
+                        # the partial download doesn't match anymore the remote content, restart from scratch
+                        r.close()
+                        offset = 0
+                        request_headers = headers
+                        r = self._get(session, fetch_url, stream=True, headers=headers, cookies=cookies,
+                                      timeout=timeout)
+                    r.raise_for_status()
+                    break
+                except requests.exceptions.RequestException as e:
+                    if r is not None:
+                        r.close()
+                    if isinstance(e, requests.exceptions.InvalidSchema):
+                        raise
+                    if mirrors:
+                        logger.warning("Download of {} from {} failed ({}), trying {}".format(
+                            url, fetch_url, e, mirrors[0]))
+                        fetch_url = mirrors.pop(0)
+                    elif not retry.retry(fetch_url, e):
+                        raise
+            with closing(r):
+                if r.status_code == 304 and cached_page:
+                    logger.info("{} didn't change since last fetch, using cached page".format(url))
+                    for data in iter(lambda: cached_page.file.read(self.MAX_BLOCK_SIZE), b''):
+                        dest.write(data)
+                        if parse_lines and _parse_block(data):
+                            parse_lines = None
+                    if parse_lines:
+                        _parse_block(b'', last=True)
+                    _report(dest.tell(), dest.tell())
+                    return dest, cached_page.final_url, session.cookies
+                etag = r.headers.get('etag')
+                if cache and not (checksum and checksum.checksum_value):
+                    cached = self._open_cached(cache, cache.key_for(url, etag=etag), url, dest)
+                    if cached:
+                        return cached, r.url, session.cookies
+                offset, content_size, hasher = self._prepare_dest(download_item, dest, r, offset, hasher)
 
                 # read in chunk and send report updates
-                block_num = 0
-                _report(block_num, self.BLOCK_SIZE, content_size)
-                for data in r.raw.stream(amt=self.BLOCK_SIZE, decode_content=not download_item.ignore_encoding):
-                    dest.write(data)
-                    block_num += 1
-                    _report(block_num, self.BLOCK_SIZE, content_size)
+                _report(offset, content_size)
+                segmented = self._can_fetch_segments(r, dest, content_size)
+                error = None
+                if segmented:
+                    # segments are written out of order and can't be resumed
+                    if isinstance(dest, PartialDownload):
+                        dest.resumable = False
+                    try:
+                        self._fetch_segments(session, r, dest, headers, cookies, timeout, content_size, _report,
+                                             retry)
+                    except (TransferError, requests.exceptions.RequestException) as e:
+                        # carry on after the content received in order, like any interrupted download
+                        logger.warning("Segmented download of {} failed ({}), falling back to a single stream".format(
+                            url, e))
+                        error = e
+                    # segments arrive out of order, we can only hash the content once in order
+                    if hasher:
+                        position = dest.tell()
+                        dest.seek(0)
+                        hasher = self._update_checksum_from_fd(self._new_hasher(checksum), dest,
+                                                               position if error else -1)
+                if not segmented or error:
+                    response = r
+                    response_url = fetch_url
+                    try:
+                        while True:
+                            if error:
+                                if response is not r:
+                                    response.close()
+                                response_url, response = _failover(response_url, error)
+                                error = None
+                                offset = dest.tell()
+                                if response.status_code != 206:
+                                    logger.info("{} doesn't support resuming, restarting download".format(
+                                        response.url))
+                                    offset = 0
+                                    if isinstance(dest, StreamDecompressor):
+                                        # what was extracted so far is coming again
+                                        dest.restart()
+                                    else:
+                                        dest.seek(0)
+                                        dest.truncate()
+                                    if hasher:
+                                        hasher = self._new_hasher(checksum)
+                                    if parse_lines:
+                                        # the lines fed so far are coming again
+                                        pending_line[0] = b''
+                                        parse_lines(url, None)
+                            received = 0
+                            try:
+                                for data in self._iter_blocks(response.raw,
+                                                              decode_content=not download_item.ignore_encoding):
+                                    dest.write(data)
+                                    if hasher:
+                                        hasher.update(data)
+                                    # progress is compared to content-length, which counts bytes before decoding
+                                    received = (response.raw.tell() if hasattr(response.raw, 'tell')
+                                                else received + len(data))
+                                    _report(offset + received, content_size)
+                                    if parse_lines and _parse_block(data):
+                                        parse_lines = None
+                                        if not hasher:
+                                            logger.debug("Found what we needed in {}, stop fetching it".format(url))
+                                            stopped_early = True
+                                            break
+                                else:
+                                    if parse_lines:
+                                        _parse_block(b'', last=True)
+                                break
+                            except (TransferError, requests.exceptions.RequestException) as e:
+                                if RetryPolicy.classify(e):
+                                    CircuitBreaker().record_failure(response_url)
+                                # only content as sent by the server can be resumed at a byte position
+                                if r.headers.get('content-encoding', 'identity').lower() != 'identity':
+                                    raise
+                                error = e
+                    finally:
+                        if response is not r:
+                            response.close()
+                    # last blocks may have been throttled
+                    self._progress.flush()
+                    r = response
                 final_url = r.url
                 cookies = session.cookies
         except requests.exceptions.InvalidSchema as exc:
             # Wrap this for a nicer error message.
             raise BaseException("Protocol not supported.") from exc
+        finally:
+            if cached_page:
+                cached_page.file.close()
 
-        if checksum and checksum.checksum_value:
-            checksum_type = checksum.checksum_type
-            checksum_value = checksum.checksum_value
-            logger.debug("Checking checksum ({}).".format(checksum_type.name))
+        self._verify_checksum(url, checksum, hasher, dest)
+        # we can't revalidate later partial content
+        self._store(download_item, dest, cache, etag, None if stopped_early else page_cache, r)
+        return dest, final_url, cookies
+
+    def _fetch_delta(self, session, download_item, fetch_url, dest, cache, timeout, report):
+        """Fetch download_item from fetch_url into dest as a delta from a previous release in cache.
+
+        Return a tuple of (dest, final_url, cookies), None if it has to be downloaded in full"""
+        url = download_item.url
+        seed = cache.find_seed(url, suffix=os.path.splitext(url)[1])
+        if not seed:
+            return None
+        delta = DeltaDownload(session, fetch_url, seed, dest, headers=download_item.headers,
+                              cookies=download_item.cookies, timeout=timeout, report=report)
+        with closing(seed):
+            try:
+                if not delta.fetch():
+                    return None
+            except DeltaError as e:
+                logger.warning("Couldn't download {} as a delta, downloading it in full: {}".format(url, e))
+                dest.seek(0)
+                dest.truncate()
+                return None
+        hasher = self._new_hasher(download_item.checksum)
+        if hasher:
             dest.seek(0)
+            hasher = self._update_checksum_from_fd(hasher, dest)
+        self._progress.flush()
+        self._verify_checksum(url, download_item.checksum, hasher, dest)
+        self._store(download_item, dest, cache, delta.etag, None, None)
+        return dest, fetch_url, session.cookies
 
-            if checksum_type is ChecksumType.sha1:
-                actual_checksum = self.sha1_for_fd(dest)
-            elif checksum_type is ChecksumType.md5:
-                actual_checksum = self.md5_for_fd(dest)
-            elif checksum_type is ChecksumType.sha256:
-                actual_checksum = self.sha256_for_fd(dest)
-            elif checksum_type is ChecksumType.sha512:
-                actual_checksum = self.sha512_for_fd(dest)
-            else:
-                msg = "Unsupported checksum type: {}.".format(checksum_type)
-                raise BaseException(msg)
+    def _can_fetch_async(self, download_item, dest):
+        """Return True if download_item can be fetched into dest by the asyncio engine.
 
+        Mirrors, rewritten urls, extraction, line parsing and proxies are left to the threaded engine"""
+        return (AsyncDownloadEngine.can_fetch(download_item.url) and
+                not download_item.mirrors and
+                UrlRewriter().rewrite(download_item.url) == download_item.url and
+                not isinstance(dest, StreamDecompressor) and
+                not (self._parse_lines and isinstance(dest, SpooledBuffer)))
+
+    async def _fetch_async(self, download_item, dest):
+        """Asyncio engine counterpart of _fetch, sharing the same caches, resuming and checksum checks.
+
+        Return a tuple of (dest, final_url, cookies)"""
+        try:
+            return await self._fetch_async_content(download_item, dest)
+        except asyncio.CancelledError:
+            # close it before Ctrl-C terminates the process: like with download threads, staged downloads are kept
+            # to be resumed next time and temporary files are removed
+            dest.close()
+            raise
+
+    async def _fetch_async_content(self, download_item, dest):
+        """Fetch download_item into dest on the event loop, leaving disk accesses and hashing to worker threads"""
+        url = download_item.url
+        checksum = download_item.checksum
+        headers = download_item.headers or {}
+        engine = AsyncDownloadEngine()
+
+        hasher = self._new_hasher(checksum)
+
+        cache = None
+        if not isinstance(dest, SpooledBuffer):
+            cache = ArtifactCache()
+            cached = await engine.run_blocking(self._open_cached, cache, cache.key_for(url, checksum), url, dest)
+            if cached:
+                return cached, url, requests.cookies.cookiejar_from_dict(download_item.cookies or {})
+
+        offset, request_headers = await engine.run_blocking(self._resume_headers, url, dest, headers)
+
+        page_cache = None
+        cached_page = None
+        if isinstance(dest, SpooledBuffer):
+            page_cache = PageCache()
+            cached_page = await engine.run_blocking(page_cache.get, url, headers, download_item.ignore_encoding)
+            if cached_page:
+                request_headers = dict(headers, **cached_page.validators)
+
+        breaker = CircuitBreaker()
+        retry = RetryPolicy()
+        r = None
+        try:
+            while True:
+                r = None
+                try:
+                    breaker.check(url)
+                    r = await self._get_async(url, request_headers, download_item.cookies)
+                    if r.status_code == 416 and offset:
+                        # the partial download doesn't match anymore the remote content, restart from scratch
+                        r.close()
+                        offset = 0
+                        request_headers = headers
+                        r = await self._get_async(url, headers, download_item.cookies)
+                    r.raise_for_status()
+                    breaker.record_success(url)
+                    break
+                except requests.exceptions.RequestException as e:
+                    if r is not None:
+                        r.close()
+                    if RetryPolicy.classify(e):
+                        breaker.record_failure(url)
+                    delay = retry.next_delay(url, e)
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+            if r.status_code == 304 and cached_page:
+                logger.info("{} didn't change since last fetch, using cached page".format(url))
+                await engine.run_blocking(shutil.copyfileobj, cached_page.file, dest, self.MAX_BLOCK_SIZE)
+                self._progress.update(url, dest.tell(), dest.tell())
+                return dest, cached_page.final_url, r.cookies
+            etag = r.headers.get('etag')
+            if cache and not hasher:
+                cached = await engine.run_blocking(self._open_cached, cache, cache.key_for(url, etag=etag), url, dest)
+                if cached:
+                    return cached, r.url, r.cookies
+            offset, content_size, hasher = await engine.run_blocking(self._prepare_dest, download_item, dest, r,
+                                                                     offset, hasher)
+
+            self._progress.update(url, offset, content_size)
+            block_size = self.BLOCK_SIZE
+            while True:
+                start = time.monotonic()
+                try:
+                    data = await r.read(block_size, decode_content=not download_item.ignore_encoding)
+                except (TransferError, requests.exceptions.RequestException) as e:
+                    breaker.record_failure(url)
+                    # only content as sent by the server can be resumed at a byte position
+                    if r.headers.get('content-encoding', 'identity').lower() != 'identity':
+                        raise
+                    r.close()
+                    r = await self._resume_async(url, download_item, dest, e, retry)
+                    offset = dest.tell()
+                    if r.status_code != 206:
+                        logger.info("{} doesn't support resuming, restarting download".format(r.url))
+                        offset = 0
+                        await engine.run_blocking(dest.seek, 0)
+                        await engine.run_blocking(dest.truncate)
+                        hasher = self._new_hasher(checksum)
+                    continue
+                if not data:
+                    break
+                block_size = self._next_block_size(block_size, block_size, len(data), time.monotonic() - start)
+                await engine.run_blocking(self._write_block, dest, hasher, data)
+                record_bytes(len(data))
+                # progress is compared to content-length, which counts bytes before decoding
+                self._progress.update(url, offset + r.tell(), content_size)
+            # last blocks may have been throttled
+            self._progress.flush()
+        finally:
+            if r is not None:
+                r.close()
+            if cached_page:
+                cached_page.file.close()
+
+        self._verify_checksum(url, checksum, hasher, dest)
+        await engine.run_blocking(self._store, download_item, dest, cache, etag, page_cache, r)
+        return dest, r.url, r.cookies
+
+    @staticmethod
+    def _write_block(dest, hasher, data):
+        """Write data to dest, updating hasher, if any, with it"""
+        dest.write(data)
+        if hasher:
+            hasher.update(data)
+
+    async def _resume_async(self, url, download_item, dest, error, retry):
+        """Return a response for the content of url after what dest already has, once retry allows it. Raise error if
+        it's not worth retrying"""
+        while True:
+            delay = retry.next_delay(url, error)
+            if delay is None:
+                raise error
+            await asyncio.sleep(delay)
+            position = dest.tell()
+            logger.warning("Download of {} failed ({}), resuming at byte {}".format(url, error, position))
+            r = None
+            try:
+                CircuitBreaker().check(url)
+                r = await self._get_async(url, dict(download_item.headers or {}, Range="bytes={}-".format(position)),
+                                          download_item.cookies)
+                r.raise_for_status()
+                return r
+            except requests.exceptions.RequestException as e:
+                if r is not None:
+                    r.close()
+                if RetryPolicy.classify(e):
+                    CircuitBreaker().record_failure(url)
+                error = e
+
+    @staticmethod
+    def _get(session, url, **kwargs):
+        """Send a GET request to url with session, unless its host is considered down. Keep the circuit breaker
+        informed of the outcome"""
+        breaker = CircuitBreaker()
+        breaker.check(url)
+        try:
+            with timed_request() as response:
+                r = session.get(url, **kwargs)
+                response.append(r)
+        except requests.exceptions.RequestException as e:
+            if RetryPolicy.classify(e):
+                breaker.record_failure(url)
+            raise
+        if r.status_code >= 500 or r.status_code == 429:
+            breaker.record_failure(url)
+        else:
+            breaker.record_success(url)
+        return r
+
+    @staticmethod
+    async def _get_async(url, headers, cookies):
+        """Send a GET request to url with the asyncio engine. Return the response once its headers arrived"""
+        with timed_request() as response:
+            r = await AsyncDownloadEngine().get(url, headers, cookies)
+            response.append(r)
+        return r
+
+    def _new_hasher(self, checksum):
+        """Return the hash object computing checksum while downloading, None if there is nothing to check"""
+        if not checksum or not checksum.checksum_value:
+            return None
+        try:
+            return TimedHasher(self.CHECKSUM_ALGORITHMS[checksum.checksum_type]())
+        except KeyError:
+            raise BaseException("Unsupported checksum type: {}.".format(checksum.checksum_type))
+
+    def _open_cached(self, cache, key, url, dest):
+        """Return cached artifact for key in place of dest, reporting it as downloaded. None if not cached"""
+        cached = cache.open(key, suffix=os.path.splitext(url)[1])
+        # extracting downloads are fed with it by _fetch_and_extract
+        if cached and not isinstance(dest, StreamDecompressor):
+            dest.close()
+            size = os.fstat(cached.fileno()).st_size
+            self._progress.update(url, size, size)
+        return cached
+
+    @staticmethod
+    def _resume_headers(url, dest, headers):
+        """Return (offset, request headers) to resume any previously interrupted download into dest, if the remote
+        content didn't change since then. offset is 0 if there is nothing to resume"""
+        if isinstance(dest, PartialDownload):
+            offset = dest.seek(0, os.SEEK_END)
+            validator = dest.validator
+            if offset and validator:
+                logger.info("Resuming download of {} from byte {}".format(url, offset))
+                return offset, dict(headers, **{"Range": "bytes={}-".format(offset), "If-Range": validator})
+        return 0, headers
+
+    def _prepare_dest(self, download_item, dest, response, offset, hasher):
+        """Position dest to receive response content, which starts at offset if it was resumed.
+
+        Return (offset, total content size or -1 if unknown, hasher updated with content before offset)"""
+        content_size = int(response.headers.get('content-length', -1))
+        if response.status_code == 206 and offset:
+            if content_size != -1:
+                content_size += offset
+        else:
+            offset = 0
+        if isinstance(dest, PartialDownload):
+            if hasher and offset:
+                dest.seek(0)
+                hasher = self._update_checksum_from_fd(hasher, dest, offset)
+            dest.seek(offset)
+            dest.truncate()
+            # we can only resume content we store as sent by the server
+            encoding = response.headers.get('content-encoding', 'identity').lower()
+            if encoding == 'identity' or download_item.ignore_encoding:
+                dest.resumable = dest.save_validator(response)
+        return offset, content_size, hasher
+
+    @staticmethod
+    def _verify_checksum(url, checksum, hasher, dest):
+        """Raise if the content hashed by hasher doesn't match checksum"""
+        # from now on, we either hand the complete download over or discard it
+        if isinstance(dest, PartialDownload):
+            dest.resumable = False
+
+        if hasher:
+            checksum_value = checksum.checksum_value
+            actual_checksum = hasher.hexdigest()
+            logger.debug("Checking checksum ({}).".format(checksum.checksum_type.name))
             logger.debug("Expected: {}, actual: {}.".format(checksum_value,
                                                             actual_checksum))
             if checksum_value != actual_checksum:
                 msg = ("The checksum of {} doesn't match. Corrupted download? "
                        "Aborting.").format(url)
                 raise BaseException(msg)
+
+    @staticmethod
+    def _store(download_item, dest, cache, etag, page_cache, response):
+        """Keep the complete dest content in the artifact or page cache, if any"""
+        url = download_item.url
+        # extracting downloads aren't kept anywhere to be cached
+        if cache and not isinstance(dest, StreamDecompressor):
+            dest.flush()
+            try:
+                cache.add(cache.key_for(url, download_item.checksum, etag), dest.name, url=url)
+            except OSError as e:
+                logger.warning("Couldn't store {} in artifact cache: {}".format(url, e))
+        if page_cache:
+            try:
+                page_cache.add(url, download_item.headers or {}, download_item.ignore_encoding, response, dest)
+            except OSError as e:
+                logger.warning("Couldn't store {} in page cache: {}".format(url, e))
+
+    def _fetch_and_extract(self, download_item, dest):
+        """Fetch download_item into dest, a StreamDecompressor, and wait for its content to be extracted.
+
+        Return a tuple of (dest, final_url, cookies)"""
+        fd, final_url, cookies = self._fetch(download_item, dest)
+        if fd is not dest:
+            # served from the artifact cache
+            with closing(fd):
+                shutil.copyfileobj(fd, dest, 2 ** 20)
+        dest.finish()
         return dest, final_url, cookies
 
+    def _rank_mirrors(self, session, urls, headers, cookies, timeout):
+        """Return urls sorted from the fastest to the slowest mirror, failing ones last.
+
+        Mirrors are all probed in parallel, the time to get their first MIRROR_PROBE_SIZE bytes accounting for both
+        their latency and early throughput."""
+        def _probe(url):
+            start = time.monotonic()
+            probe_headers = dict(headers, Range="bytes=0-{}".format(self.MIRROR_PROBE_SIZE - 1))
+            try:
+                with closing(self._get(session, url, stream=True, headers=probe_headers, cookies=cookies,
+                                       timeout=timeout)) as r:
+                    r.raise_for_status()
+                    time_to_first_byte = time.monotonic() - start
+                    for data in self._iter_blocks(r.raw, decode_content=False, limit=self.MIRROR_PROBE_SIZE):
+                        pass
+            except (TransferError, requests.exceptions.RequestException) as e:
+                logger.info("Mirror {} is unavailable: {}".format(url, e))
+                return float('inf')
+            elapsed = time.monotonic() - start
+            logger.debug("Mirror {} answered in {:.3f}s, sent first bytes in {:.3f}s".format(
+                url, time_to_first_byte, elapsed))
+            return elapsed
+
+        with futures.ThreadPoolExecutor(max_workers=len(urls)) as executor:
+            timings = list(executor.map(_probe, urls))
+        return [url for (timing, index, url) in sorted(zip(timings, range(len(urls)), urls))]
+
+    @classmethod
+    def _iter_blocks(cls, raw, decode_content, limit=None):
+        """Yield raw content in chunks, sized to the observed throughput. Stop after limit bytes if provided"""
+        if not hasattr(raw, 'read'):
+            # streaming only raw, stick to fixed chunks
+            for data in raw.stream(amt=cls.BLOCK_SIZE, decode_content=decode_content):
+                record_bytes(len(data))
+                yield data
+            return
+        block_size = cls.BLOCK_SIZE
+        while limit is None or limit > 0:
+            amt = block_size if limit is None else min(block_size, limit)
+            start = time.monotonic()
+            data = raw.read(amt=amt, decode_content=decode_content)
+            elapsed = time.monotonic() - start
+            if not data:
+                # a compressed chunk may not be enough to decode anything
+                if raw.closed:
+                    return
+                continue
+            record_bytes(len(data))
+            yield data
+            if limit is not None:
+                limit -= len(data)
+            block_size = cls._next_block_size(block_size, amt, len(data), elapsed)
+
+    @classmethod
+    def _next_block_size(cls, block_size, amt, received, elapsed):
+        """Return the block size to read next, received bytes out of amt having taken elapsed seconds"""
+        if received >= amt and elapsed < cls.BLOCK_TARGET_TIME / 2:
+            return min(block_size * 2, cls.MAX_BLOCK_SIZE)
+        if elapsed > cls.BLOCK_TARGET_TIME * 2:
+            return max(block_size // 2, cls.BLOCK_SIZE)
+        return block_size
+
+    def _can_fetch_segments(self, response, dest, content_size):
+        """Return True if response content can be fetched in multiple parallel byte ranges into dest"""
+        return (not isinstance(dest, (SpooledBuffer, StreamDecompressor)) and
+                content_size >= self.SEGMENT_MIN_SIZE and
+                response.status_code == 200 and
+                response.headers.get('accept-ranges', '').lower() == 'bytes' and
+                response.headers.get('content-encoding', 'identity').lower() == 'identity')
+
+    def _fetch_segments(self, session, response, dest, headers, cookies, timeout, content_size, report, retry):
+        """Fetch content_size bytes in SEGMENTS ranges, written at their offset into dest.
+
+        The first range is read from the already opened response, the others are requested in parallel
+        against the final url, with the same cookies and timeout. A failing range is resumed where it stopped, as long
+        as retry allows it. Otherwise, the other ranges are stopped, dest is left after the content received in order
+        and the error is raised."""
+        segment_size = -(-content_size // self.SEGMENTS)
+        segments = [(start, min(start + segment_size, content_size) - 1)
+                    for start in range(0, content_size, segment_size)]
+        logger.debug("Fetching {} in {} segments".format(response.url, len(segments)))
+        # reserve the whole file so that each segment can write at its own offset
+        os.posix_fallocate(dest.fileno(), 0, content_size)
+        # a stalled segment would hold up the whole download
+        timeout = timeout or (self.MIRROR_CONNECT_TIMEOUT, self.MIRROR_STALL_TIMEOUT)
+
+        progress_lock = Lock()
+        fetched = [0]
+        stopped = Event()
+        # where each segment is at, keyed by its start
+        positions = {start: [start] for (start, end) in segments}
+
+        def _write(chunks, position, end):
+            """Write chunks from position[0] to end, keeping position[0] up to date"""
+            for data in chunks:
+                if stopped.is_set():
+                    return
+                data = data[:end + 1 - position[0]]
+                os.pwrite(dest.fileno(), data, position[0])
+                position[0] += len(data)
+                with progress_lock:
+                    fetched[0] += len(data)
+                    report(fetched[0], content_size)
+                if position[0] > end:
+                    break
+
+        def _fetch_range(start, end, r=None):
+            position = positions[start]
+            try:
+                while not stopped.is_set():
+                    try:
+                        if r is None:
+                            range_headers = dict(headers, Range="bytes={}-{}".format(position[0], end))
+                            r = self._get(session, response.url, stream=True, headers=range_headers, cookies=cookies,
+                                          timeout=timeout)
+                            r.raise_for_status()
+                            if r.status_code != 206:
+                                r.close()
+                                raise requests.exceptions.RequestException(
+                                    "{} didn't honour range request.".format(response.url), response=r)
+                        with closing(r):
+                            _write(self._iter_blocks(r.raw, decode_content=False, limit=end + 1 - position[0]),
+                                   position, end)
+                        if position[0] == end + 1 or stopped.is_set():
+                            return
+                        raise TransferError("Segment {}-{} of {} is incomplete.".format(start, end, response.url))
+                    except (TransferError, requests.exceptions.RequestException) as e:
+                        if isinstance(e, TransferError):
+                            CircuitBreaker().record_failure(response.url)
+                        if not retry.retry(response.url, e):
+                            raise
+                        r = None
+            except BaseException:
+                stopped.set()
+                raise
+
+        error = None
+        with futures.ThreadPoolExecutor(max_workers=len(segments) - 1) as executor:
+            # segments are part of the current download trace
+            segment_futures = [executor.submit(contextvars.copy_context().run, _fetch_range, start, end)
+                               for (start, end) in segments[1:]]
+            try:
+                _fetch_range(*segments[0], r=response)
+            except (TransferError, requests.exceptions.RequestException) as e:
+                error = e
+            for future in segment_futures:
+                try:
+                    future.result()
+                except (TransferError, requests.exceptions.RequestException) as e:
+                    error = error or e
+        if error:
+            contiguous = 0
+            for (start, end) in segments:
+                contiguous = positions[start][0]
+                if contiguous <= end:
+                    break
+            dest.seek(contiguous)
+            dest.truncate()
+            raise error
+
     def _one_done(self, future):
         """Callback that will be called once the download finishes.
 
         (will be wired on the constructor)
         """
 
-        if future.exception():
-            logger.error("{} couldn't finish download: {}".format(future.tag_url, future.exception()))
-            result = self.DownloadResult(buffer=None, error=str(future.exception()), fd=None, final_url=None,
-                                         cookies=None)
+        if future.cancelled() or future.exception():
+            error = "Download cancelled" if future.cancelled() else str(future.exception())
+            logger.error("{} couldn't finish download: {}".format(future.tag_url, error))
+            result = self.DownloadResult(buffer=None, error=error, fd=None, final_url=None, cookies=None,
+                                         trace=future.tag_trace)
             # cleaned unusable temp file as something bad happened
             future.tag_dest.close()
         else:
             logger.info("{} download finished".format(future.tag_url))
             fd, final_url, cookies = future.result()
-            fd.seek(0)
+            if fd.seekable():
+                fd.seek(0)
             if future.tag_download:
-                result = self.DownloadResult(buffer=None, error=None, fd=fd, final_url=final_url, cookies=cookies)
+                result = self.DownloadResult(buffer=None, error=None, fd=fd, final_url=final_url, cookies=cookies,
+                                             trace=future.tag_trace)
             else:
-                result = self.DownloadResult(buffer=fd, error=None, fd=None, final_url=final_url, cookies=cookies)
+                result = self.DownloadResult(buffer=fd, error=None, fd=None, final_url=final_url, cookies=cookies,
+                                             trace=future.tag_trace)
+        TraceWriter().write(future.tag_trace)
         self._downloaded_content[future.tag_url] = result
         if len(self._urls) == len(self._downloaded_content):
             self._done()
@@ -202,17 +1079,35 @@ class DownloadCenter:
         uris of the temporary files will be passed on the wired callback
         """
         logger.info("All pending downloads for {} done".format(self._urls))
+        # don't keep download workers around once no other DownloadCenter needs them
+        DownloadScheduler().shutdown(wait=False, only_if_idle=True)
         self._done_callback(self._downloaded_content)
 
+    def cancel(self):
+        """Cancel downloads which aren't done yet. They are reported like failed ones, with a "Download cancelled"
+        error.
+
+        Downloads already running in download threads can't be interrupted and finish first."""
+        for future in self._futures:
+            future.cancel()
+        if self._async_futures:
+            AsyncDownloadEngine().cancel(self._async_futures)
+
     @classmethod
-    def _checksum_for_fd(cls, algorithm, f, block_size=2 ** 20):
-        checksum = algorithm()
-        while True:
-            data = f.read(block_size)
+    def _update_checksum_from_fd(cls, checksum, f, size=-1, block_size=2 ** 20):
+        """Update checksum object with size bytes (everything if -1) read from f. Return checksum"""
+        while size:
+            data = f.read(block_size if size < 0 else min(block_size, size))
             if not data:
                 break
             checksum.update(data)
-        return checksum.hexdigest()
+            if size > 0:
+                size -= len(data)
+        return checksum
+
+    @classmethod
+    def _checksum_for_fd(cls, algorithm, f, block_size=2 ** 20):
+        return cls._update_checksum_from_fd(algorithm(), f, block_size=block_size).hexdigest()
 
     @classmethod
     def md5_for_fd(cls, f, block_size=2 ** 20):
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module aggregating download progress before reporting it"""
+
+import logging
+from threading import Lock
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ProgressReport(dict):
+    """Snapshot of every download progress, keyed by url.
+
+    Each value is a dict with current and size (-1 if unknown) in bytes, speed in bytes/sec and eta in seconds
+    (None if unknown). speed and eta attributes are the same for all downloads together."""
+
+    def __init__(self, *args, speed=0, eta=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.speed = speed
+        self.eta = eta
+
+
+class DownloadProgress:
+    """Collect progress of multiple downloads and report them at most every MIN_INTERVAL seconds.
+
+    New and finished downloads are always reported."""
+
+    # in seconds
+    MIN_INTERVAL = 0.1
+
+    def __init__(self, report):
+        self._report = report
+        self._lock = Lock()
+        # url: [current, size, first report time, current at first report]
+        self._items = {}
+        self._last_emit = 0
+        self._dirty = False
+
+    def update(self, url, current, size):
+        """Record current progress for url, reporting it if needed"""
+        if size != -1:
+            current = min(current, size)
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(url)
+            if item is None:
+                self._items[url] = [current, size, now, current]
+                force = True
+            else:
+                item[0] = current
+                item[1] = size
+                force = current == size
+            self._dirty = True
+            if force or now - self._last_emit >= self.MIN_INTERVAL:
+                self._emit(now)
+
+    def flush(self):
+        """Report latest progress if it wasn't yet"""
+        with self._lock:
+            if self._dirty:
+                self._emit(time.monotonic())
+
+    def _emit(self, now):
+        """Build and deliver the progress report. Must be called with the lock held, to keep reports ordered"""
+        report = ProgressReport()
+        total_remaining = 0
+        for url, (current, size, start, start_current) in self._items.items():
+            elapsed = now - start
+            # resumed bytes weren't downloaded now, don't count them
+            speed = (current - start_current) / elapsed if elapsed > 0 else 0
+            eta = None
+            if size != -1:
+                if current == size:
+                    eta = 0
+                elif speed:
+                    eta = (size - current) / speed
+            if total_remaining is not None:
+                total_remaining = None if size == -1 else total_remaining + size - current
+            report[url] = {"current": current, "size": size, "speed": speed, "eta": eta}
+            report.speed += speed
+        if total_remaining == 0:
+            report.eta = 0
+        elif total_remaining is not None and report.speed:
+            report.eta = total_remaining / report.speed
+        self._last_emit = now
+        self._dirty = False
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Deliver download update: {}".format(report))
+        self._report(report)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module delivering a process-wide bounded scheduler for downloads"""
+
+from collections import Counter
+from concurrent import futures
+from itertools import count
+import logging
+from threading import Condition, Thread, current_thread
+import urllib.parse
+
+from umake.tools import ConfigHandler, Singleton
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadScheduler(metaclass=Singleton):
+    """Run download jobs on a bounded set of threads shared by every DownloadCenter.
+
+    Metadata jobs (provider pages, checksums…) are always picked first and have some workers reserved for them,
+    so that they never wait behind bulk artifact transfers. Bulk transfers are limited per host.
+    Workers are stopped once every DownloadCenter is done with them (shutdown), new ones start with next downloads.
+    Limits can be configured with a download section in the configuration file:
+    download:
+      max_workers: total number of simultaneous downloads
+      max_per_host: maximum number of simultaneous bulk downloads from the same host
+    """
+
+    # priorities, lower first
+    METADATA = 0
+    BULK = 1
+
+    MAX_WORKERS = 8
+    MAX_PER_HOST = 4
+    # workers bulk transfers can't use
+    RESERVED_METADATA_WORKERS = 2
+
+    def __init__(self):
+        config = (ConfigHandler().config or {}).get("download") or {}
+        self.max_workers = max(int(config.get("max_workers", self.MAX_WORKERS)), 1)
+        self.max_per_host = max(int(config.get("max_per_host", self.MAX_PER_HOST)), 1)
+        self.max_bulk_workers = max(self.max_workers - self.RESERVED_METADATA_WORKERS, 1)
+
+        self._condition = Condition()
+        self._pending = []
+        self._sequence = count()
+        self._running = 0
+        self._running_bulk = 0
+        self._running_per_host = Counter()
+        self._idle_workers = 0
+        self._workers = []
+        # workers stop once it changes, on shutdown
+        self._generation = 0
+
+    def submit(self, priority, url, fn, *args, **kwargs):
+        """Schedule fn(*args, **kwargs), fetching url with priority. Return a concurrent.futures.Future"""
+        future = futures.Future()
+        host = urllib.parse.urlparse(url).netloc
+        with self._condition:
+            self._pending.append((priority, next(self._sequence), host, future, fn, args, kwargs))
+            self._pending.sort(key=lambda job: job[:2])
+            if len(self._pending) > self._idle_workers and len(self._workers) < self.max_workers:
+                worker = Thread(target=self._work, args=(self._generation,),
+                                name="download-{}".format(len(self._workers)), daemon=True)
+                self._workers.append(worker)
+                worker.start()
+            self._condition.notify()
+        return future
+
+    def shutdown(self, wait=True, only_if_idle=False):
+        """Stop workers once their current job is done. Pending jobs are cancelled.
+
+        Jobs submitted afterwards start new workers. With only_if_idle, nothing is done if any job is pending or
+        running. Return True if workers were stopped"""
+        with self._condition:
+            # cancelled jobs are only dropped once a worker picks them
+            if only_if_idle and (self._running or not all(job[3].cancelled() for job in self._pending)):
+                return False
+            for job in self._pending:
+                job[3].cancel()
+            self._pending = []
+            workers = self._workers
+            self._workers = []
+            self._idle_workers = 0
+            self._generation += 1
+            self._condition.notify_all()
+        if wait:
+            for worker in workers:
+                if worker is not current_thread():
+                    worker.join()
+        return True
+
+    def _next_job(self):
+        """Return the first pending job we can run, None if none. Must be called with the condition held"""
+        for job in self._pending:
+            priority, sequence, host = job[:3]
+            if priority == self.METADATA:
+                break
+            if self._running_bulk < self.max_bulk_workers and self._running_per_host[host] < self.max_per_host:
+                break
+        else:
+            return None
+        self._pending.remove(job)
+        return job
+
+    def _work(self, generation):
+        while True:
+            with self._condition:
+                if generation != self._generation:
+                    return
+                self._idle_workers += 1
+                job = self._next_job()
+                while job is None:
+                    self._condition.wait()
+                    # stopped workers aren't counted anymore
+                    if generation != self._generation:
+                        return
+                    job = self._next_job()
+                self._idle_workers -= 1
+                priority, sequence, host, future, fn, args, kwargs = job
+                self._running += 1
+                if priority != self.METADATA:
+                    self._running_bulk += 1
+                    self._running_per_host[host] += 1
+
+            result = error = None
+            running = future.set_running_or_notify_cancel()
+            if running:
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    error = e
+
+            with self._condition:
+                self._running -= 1
+                if priority != self.METADATA:
+                    self._running_bulk -= 1
+                    self._running_per_host[host] -= 1
+                # a bulk slot may have been freed for a pending job
+                self._condition.notify_all()
+
+            # the job is over by then: future callbacks can shut the scheduler down once it's idle
+            if running:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
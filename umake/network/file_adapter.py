@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+from email.utils import formatdate
+import io
+import os
+import re
+import urllib.parse
+import urllib.request
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.packages.urllib3.response import HTTPResponse
+from requests.structures import CaseInsensitiveDict
+
+
+class _FileRange(io.RawIOBase):
+    """Read at most length bytes of f, from its current position"""
+
+    def __init__(self, f, length):
+        super().__init__()
+        self._file = f
+        self._remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        size = min(len(b), self._remaining)
+        if size <= 0:
+            return 0
+        size = self._file.readinto(memoryview(b)[:size])
+        self._remaining -= size
+        return size
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+class FileAdapter(BaseAdapter):
+    """A file adapter for requests, serving local files like a web server would: supports GETs, byte ranges and
+    Last-Modified revalidation."""
+
+    def send(self, request, stream=False, timeout=None, **kwargs):
+        if request.method not in ("GET", "HEAD"):
+            return self._build_response(request, 405, "Method Not Allowed")
+        path = urllib.request.url2pathname(urllib.parse.urlparse(request.url).path)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return self._build_response(request, 404, "Not Found")
+        except OSError as e:
+            return self._build_response(request, 403, e.strerror)
+
+        stat = os.fstat(f.fileno())
+        size = stat.st_size
+        last_modified = formatdate(stat.st_mtime, usegmt=True)
+        headers = {"Last-Modified": last_modified, "Accept-Ranges": "bytes"}
+        if request.headers.get("If-Modified-Since") == last_modified:
+            f.close()
+            return self._build_response(request, 304, "Not Modified", headers)
+
+        start, end = 0, size - 1
+        status, reason = 200, "OK"
+        requested_range = re.match(r'bytes=(\d+)-(\d*)$', request.headers.get("Range", ""))
+        # like If-Range, ignore the range if the content changed since
+        if requested_range and request.headers.get("If-Range", last_modified) == last_modified:
+            start = int(requested_range.group(1))
+            if requested_range.group(2):
+                end = min(int(requested_range.group(2)), size - 1)
+            if start >= size or start > end:
+                f.close()
+                headers["Content-Range"] = "bytes */{}".format(size)
+                return self._build_response(request, 416, "Requested Range Not Satisfiable", headers)
+            status, reason = 206, "Partial Content"
+            headers["Content-Range"] = "bytes {}-{}/{}".format(start, end, size)
+        headers["Content-Length"] = str(end + 1 - start)
+
+        if request.method == "HEAD":
+            f.close()
+            return self._build_response(request, status, reason, headers)
+        f.seek(start)
+        return self._build_response(request, status, reason, headers, _FileRange(f, end + 1 - start))
+
+    def _build_response(self, request, status, reason, headers=None, body=None):
+        headers = CaseInsensitiveDict(headers or {})
+        resp = Response()
+        resp.url = request.url
+        resp.request = request
+        resp.connection = self
+        resp.status_code = status
+        resp.reason = reason
+        resp.headers = headers
+        resp.raw = HTTPResponse(body=body or io.BytesIO(), headers=headers, status=status, reason=reason,
+                                preload_content=False, decode_content=False)
+        return resp
+
+    def close(self):
+        pass
@@ -17,92 +17,239 @@
 # this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
-from collections import namedtuple
+import calendar
+from collections import defaultdict
+from contextlib import suppress
+from email.utils import formatdate
+import ftplib
 from ftplib import FTP, error_perm
-from queue import Queue
-from threading import Thread
+from io import BytesIO
+import logging
+import re
+from threading import Lock
+import time
 import urllib.parse
 from requests import Response
 from requests.adapters import BaseAdapter
 import requests.exceptions
+from requests.packages.urllib3.exceptions import ProtocolError
+
+logger = logging.getLogger(__name__)
+
+
+class FTPTransfer:
+    """Raw content of an FTP transfer, read straight from its data connection like an urllib3 response.
+
+    Once the whole content is read, the control connection is handed back to the adapter for the next transfers.
+    Closing it before cancels the transfer."""
+
+    def __init__(self, adapter, hostname, port, conn, data_socket, length):
+        self._adapter = adapter
+        self._hostname = hostname
+        self._port = port
+        self._conn = conn
+        self._data_socket = data_socket
+        self._remaining = length
+        self._position = 0
+
+    @property
+    def closed(self):
+        return self._data_socket is None
+
+    def tell(self):
+        return self._position
+
+    def read(self, amt=None, decode_content=False):
+        """Read up to amt bytes, everything left if None"""
+        if self.closed:
+            return b''
+        amt = self._remaining if amt is None else min(amt, self._remaining)
+        data = bytearray(amt)
+        # receive in place, without any intermediate copy
+        with memoryview(data) as view:
+            received = 0
+            while received < amt:
+                size = self._data_socket.recv_into(view[received:])
+                if not size:
+                    break
+                received += size
+        del data[received:]
+        self._position += received
+        self._remaining -= received
+        if not self._remaining:
+            self._finish()
+        elif received < amt:
+            self.close()
+            raise ProtocolError("Connection closed after {} bytes, {} more expected".format(
+                self._position, self._remaining))
+        return data
+
+    def stream(self, amt=8192, decode_content=False):
+        """Yield content in chunks of amt bytes"""
+        while True:
+            data = self.read(amt)
+            if not data:
+                return
+            yield data
+
+    def _finish(self):
+        """Close the completed transfer and keep its connection for the next one"""
+        self._data_socket.close()
+        self._data_socket = None
+        try:
+            self._conn.voidresp()
+        except ftplib.all_errors as e:
+            logger.debug("Dropping FTP connection to {}: {}".format(self._hostname, e))
+            self._adapter.discard_connection(self._conn)
+        else:
+            self._adapter.release_connection(self._hostname, self._conn, self._port)
+
+    def close(self):
+        if not self.closed:
+            # the server is still sending, don't reuse that connection
+            self._data_socket.close()
+            self._data_socket = None
+            self._adapter.discard_connection(self._conn)
 
 
 class FTPAdapter(BaseAdapter):
-    """An FTP adapter for requests. Supports streaming GETs and not much else."""
+    """An FTP adapter for requests. Supports streaming GETs, starting at any offset with a Range header, and not
+    much else.
+
+    Logged in connections are kept per host and reused by next transfers."""
+
+    # idle connections kept per host
+    MAX_IDLE_CONNECTIONS = 4
+
+    def __init__(self):
+        super().__init__()
+        self._idle_connections = defaultdict(list)
+        self._lock = Lock()
+
+    @staticmethod
+    def get_connection(hostname, timeout=None, port=0):
+        conn = FTP(timeout=timeout)
+        conn.connect(hostname, port)
+        conn.login()
+        return conn
+
+    def acquire_connection(self, hostname, timeout=None, port=0):
+        """Return a logged in connection to hostname, reusing an idle one if it's still alive"""
+        key = (hostname, port)
+        while True:
+            with self._lock:
+                if not self._idle_connections[key]:
+                    break
+                conn = self._idle_connections[key].pop()
+            try:
+                conn.voidcmd('NOOP')
+                return conn
+            except ftplib.all_errors:
+                self.discard_connection(conn)
+        return self.get_connection(hostname, timeout, port)
+
+    def release_connection(self, hostname, conn, port=0):
+        """Keep conn to hostname for next transfers"""
+        key = (hostname, port)
+        with self._lock:
+            if len(self._idle_connections[key]) < self.MAX_IDLE_CONNECTIONS:
+                self._idle_connections[key].append(conn)
+                return
+        self.discard_connection(conn)
 
     @staticmethod
-    def get_connection(hostname, timeout=None):
-        return FTP(host=hostname, timeout=timeout, user='anonymous')
+    def discard_connection(conn):
+        with suppress(*ftplib.all_errors):
+            conn.close()
 
     def send(self, request, stream=False, timeout=None, **kwargs):
 
         parsed_url = urllib.parse.urlparse(request.url)
-        file_path = parsed_url.path
+        file_path = urllib.parse.unquote(parsed_url.path)
 
         # Strip the leading slash, if present.
         if file_path.startswith('/'):
             file_path = file_path[1:]
 
+        if not stream:
+            # Not relevant for Ubuntu Make.
+            raise NotImplementedError
+
+        # sockets only have one timeout for both connecting and reading
+        if isinstance(timeout, tuple):
+            timeout = max(filter(None, timeout), default=None)
+        hostname = parsed_url.hostname
+        port = parsed_url.port or 0
         try:
-            self.conn = self.get_connection(parsed_url.netloc, timeout)
-        except ConnectionRefusedError as exc:
+            conn = self.acquire_connection(hostname, timeout, port)
+        except ftplib.all_errors as exc:
             # Wrap this in a requests exception.
             # in requests 2.2.1, ConnectionError does not take keyword args
             raise requests.exceptions.ConnectionError() from exc
 
         resp = Response()
         resp.url = request.url
+        resp.request = request
+        resp.raw = BytesIO()
 
         try:
-            size = self.conn.size(file_path)
+            conn.voidcmd('TYPE I')
+            size = conn.size(file_path)
         except error_perm:
+            self.release_connection(hostname, conn, port)
             resp.status_code = 404
             return resp
+        except ftplib.all_errors as exc:
+            self.discard_connection(conn)
+            raise requests.exceptions.ConnectionError() from exc
 
-        if stream:
-            # We have to do this in a background thread, since ftplib's and requests' approaches are the opposite:
-            # ftplib is callback based, and requests needs to expose an iterable. (Push vs pull)
-
-            # When the queue size is reached, puts will block. This provides some backpressure.
-            queue = Queue(maxsize=100)
-            done_sentinel = object()
-
-            def handle_transfer():
-                # Download all the chunks into a queue, then place a sentinel object into it to signal completion.
-                self.conn.retrbinary('RETR ' + file_path, queue.put)
-                queue.put(done_sentinel)
-
-            Thread(target=handle_transfer).start()
-
-            def stream(amt=8192, decode_content=False):
-                """A generator, yielding chunks from the queue."""
-                # We maintain a buffer so the consumer gets exactly the number of bytes requested.
-                buffer = bytearray()
-                while True:
-                    data = queue.get()
-
-                    if data is not done_sentinel:
-                        buffer.extend(data)
-                        if len(buffer) >= amt:
-                            result = buffer[:amt]
-                            buffer = buffer[amt:]
-
-                            yield result
-                    else:
-                        if buffer:
-                            yield buffer
-                        return
-
-            Raw = namedtuple('raw', 'stream')
-
-            raw = Raw(stream)
+        with suppress(ftplib.Error, IndexError, ValueError):
+            modified = time.strptime(conn.sendcmd('MDTM ' + file_path).split()[1][:14], "%Y%m%d%H%M%S")
+            resp.headers['last-modified'] = formatdate(calendar.timegm(modified), usegmt=True)
+        last_modified = resp.headers.get('last-modified')
+
+        start, end = 0, size - 1
+        requested_range = re.match(r'bytes=(\d+)-(\d*)$', request.headers.get('Range', ''))
+        # like If-Range, ignore the range if the content changed since
+        if requested_range and request.headers.get('If-Range', last_modified) == last_modified:
+            start = int(requested_range.group(1))
+            if requested_range.group(2):
+                end = min(int(requested_range.group(2)), size - 1)
+            if start >= size or start > end:
+                self.release_connection(hostname, conn, port)
+                resp.status_code = 416
+                return resp
 
-            resp.status_code = 200
-            resp.raw = raw
-            resp.headers['content-length'] = size
-            resp.close = lambda: self.conn.close()
+        try:
+            # resume with REST, starting over if the server doesn't support it
+            try:
+                data_socket = conn.transfercmd('RETR ' + file_path, rest=start or None)
+            except ftplib.Error:
+                if not start:
+                    raise
+                logger.debug("{} doesn't support resuming transfers".format(hostname))
+                start, end = 0, size - 1
+                data_socket = conn.transfercmd('RETR ' + file_path)
+        except error_perm:
+            self.release_connection(hostname, conn, port)
+            resp.status_code = 404
             return resp
+        except ftplib.all_errors as exc:
+            self.discard_connection(conn)
+            raise requests.exceptions.ConnectionError() from exc
 
+        if requested_range and (start, end) != (0, size - 1):
+            resp.status_code = 206
+            resp.headers['content-range'] = 'bytes {}-{}/{}'.format(start, end, size)
         else:
-            # Not relevant for Ubuntu Make.
-            raise NotImplementedError
+            resp.status_code = 200
+        resp.headers['content-length'] = str(end + 1 - start)
+        resp.raw = FTPTransfer(self, hostname, port, conn, data_socket, end + 1 - start)
+        return resp
+
+    def close(self):
+        with self._lock:
+            connections = [conn for conns in self._idle_connections.values() for conn in conns]
+            self._idle_connections.clear()
+        for conn in connections:
+            self.discard_connection(conn)
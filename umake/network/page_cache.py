@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module delivering a local cache of metadata pages, revalidated with conditional requests"""
+
+from collections import namedtuple
+from contextlib import suppress
+import hashlib
+import json
+import logging
+import os
+import shutil
+import uuid
+
+from umake.tools import ConfigHandler, get_cache_path, root_lock
+
+logger = logging.getLogger(__name__)
+
+
+class CachedPage(namedtuple('CachedPage', ['file', 'final_url', 'validators'])):
+    """A cached page, opened as a binary file to be closed by the caller, with the final url it was fetched from and
+    the conditional request headers revalidating it"""
+
+
+class PageCache:
+    """Keep provider pages along with their ETag and Last-Modified headers.
+
+    Next fetches send them back as If-None-Match and If-Modified-Since, and reuse the stored content if the
+    server answers 304 Not Modified. Pages are stored in $XDG_CACHE_HOME/umake/pages. They can be disabled with:
+    cache:
+      pages: false
+    """
+
+    def __init__(self):
+        config = (ConfigHandler().config or {}).get("cache") or {}
+        self.path = get_cache_path("pages")
+        self.enabled = bool(config.get("pages", True))
+
+    @staticmethod
+    def key_for(url, headers=None, ignore_encoding=False):
+        """Return the cache key for url fetched with those request headers, decoded or not"""
+        key = "{}\n{}\n{}".format(url, json.dumps(headers or {}, sort_keys=True), ignore_encoding)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, url, headers=None, ignore_encoding=False):
+        """Return the CachedPage for url, None if it isn't cached.
+
+        Its content isn't read: big pages stay on disk until they are copied where they are needed"""
+        if not self.enabled:
+            return None
+        path = os.path.join(self.path, self.key_for(url, headers, ignore_encoding))
+        try:
+            with open(path + ".json") as f:
+                meta = json.load(f)
+            content = open(path, 'rb')
+        except (OSError, ValueError):
+            return None
+        validators = {}
+        if meta.get("etag"):
+            validators["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            validators["If-Modified-Since"] = meta["last_modified"]
+        return CachedPage(content, meta["final_url"], validators)
+
+    def add(self, url, headers, ignore_encoding, response, content):
+        """Store page content, a binary file read from its start, fetched from url as response, if the server gave us
+        a way to revalidate it"""
+        if not self.enabled or 'no-store' in response.headers.get('cache-control', '').lower():
+            return
+        etag = response.headers.get('etag')
+        last_modified = response.headers.get('last-modified')
+        if not etag and not last_modified:
+            return
+        path = os.path.join(self.path, self.key_for(url, headers, ignore_encoding))
+        tmp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        # We want to ensure that we don't create files as root
+        with root_lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                content.seek(0)
+                shutil.copyfileobj(content, f)
+            os.replace(tmp_path, path)
+            with open(tmp_path, 'w') as f:
+                json.dump({"url": url, "final_url": response.url, "etag": etag, "last_modified": last_modified}, f)
+            os.replace(tmp_path, path + ".json")
+        logger.debug("Stored {} in page cache".format(url))
+
+    def prune(self):
+        """Remove every cached page"""
+        with suppress(FileNotFoundError):
+            shutil.rmtree(self.path)
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module timing the network phases of each download, to find out what makes one slow"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import json
+import logging
+import socket
+from threading import Lock
+import time
+import requests.adapters
+from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from requests.packages.urllib3.exceptions import ConnectTimeoutError
+from requests.packages.urllib3.util.connection import allowed_gai_family
+
+from umake.tools import Singleton
+
+logger = logging.getLogger(__name__)
+
+# trace of the download being fetched by the current thread or asyncio task
+_current_trace = ContextVar("request_trace", default=None)
+
+
+class RequestTrace:
+    """Timings of one download, in seconds per phase:
+    - dns, connect and tls: setting up new connections, 0 when reusing pooled ones
+    - ttfb: waiting for response headers once requests are sent
+    - checksum: hashing the content
+    - transfer: everything else, mostly receiving the content
+    Phases add up to total. Retried or resumed requests add to the same phases."""
+
+    PHASES = ("dns", "connect", "tls", "ttfb", "transfer", "checksum")
+
+    def __init__(self, url):
+        self.url = url
+        self.final_url = None
+        self.redirects = []
+        self.status = None
+        self.connections = 0
+        # content bytes received
+        self.bytes = 0
+        self.error = None
+        self.start_time = None
+        self.total = None
+        self.timings = dict.fromkeys(self.PHASES, 0.0)
+        self._start = None
+        self._lock = Lock()
+
+    @staticmethod
+    def current():
+        """Return the trace of the download in progress in this thread or task, None if there is none"""
+        return _current_trace.get()
+
+    @contextmanager
+    def activate(self):
+        """Make it the current trace while fetching, finishing it once done"""
+        self.start_time = time.time()
+        self._start = time.monotonic()
+        token = _current_trace.set(self)
+        try:
+            yield self
+        except BaseException as e:
+            self.error = str(e) or type(e).__name__
+            raise
+        finally:
+            _current_trace.reset(token)
+            self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self.total = time.monotonic() - self._start
+            others = sum(duration for phase, duration in self.timings.items() if phase != "transfer")
+            self.timings["transfer"] = max(self.total - others, 0.0)
+
+    def add(self, phase, duration):
+        with self._lock:
+            self.timings[phase] += duration
+
+    def add_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    def add_bytes(self, count):
+        with self._lock:
+            self.bytes += count
+
+    def add_response(self, response):
+        """Record status, url and redirections of response"""
+        with self._lock:
+            self.status = response.status_code
+            self.final_url = response.url
+            self.redirects.extend(previous.url for previous in getattr(response, "history", None) or [])
+
+    def setup_time(self):
+        """Return the time spent setting up connections so far"""
+        with self._lock:
+            return self.timings["dns"] + self.timings["connect"] + self.timings["tls"]
+
+    def to_dict(self):
+        with self._lock:
+            return {"url": self.url, "final_url": self.final_url, "redirects": list(self.redirects),
+                    "status": self.status, "error": self.error, "start": self.start_time, "total": self.total,
+                    "bytes": self.bytes, "connections": self.connections, "timings": dict(self.timings)}
+
+
+def record(phase, duration):
+    """Add duration to phase of the current trace, if any"""
+    trace = _current_trace.get()
+    if trace:
+        trace.add(phase, duration)
+
+
+def record_bytes(count):
+    trace = _current_trace.get()
+    if trace:
+        trace.add_bytes(count)
+
+
+@contextmanager
+def timed_request():
+    """Time until a response is received as ttfb, less any connection set up meanwhile. Yield a list where to put
+    that response, to record it in the current trace"""
+    trace = _current_trace.get()
+    response = []
+    if not trace:
+        yield response
+        return
+    setup_time = trace.setup_time()
+    start = time.monotonic()
+    try:
+        yield response
+    finally:
+        trace.add("ttfb", max(time.monotonic() - start - (trace.setup_time() - setup_time), 0.0))
+        if response:
+            trace.add_response(response[0])
+
+
+class TimedHasher:
+    """Hash object accounting the time spent hashing to the checksum phase of the current trace"""
+
+    def __init__(self, hasher):
+        self._hasher = hasher
+
+    def update(self, data):
+        start = time.monotonic()
+        self._hasher.update(data)
+        record("checksum", time.monotonic() - start)
+
+    def hexdigest(self):
+        return self._hasher.hexdigest()
+
+
+class TraceWriter(metaclass=Singleton):
+    """Append finished traces as JSON lines to path, if set"""
+
+    def __init__(self):
+        self.path = None
+        self._lock = Lock()
+
+    def write(self, trace):
+        if not self.path:
+            return
+        try:
+            with self._lock, open(self.path, 'a') as f:
+                f.write(json.dumps(trace.to_dict()) + "\n")
+        except OSError as e:
+            logger.warning("Couldn't write download trace to {}: {}".format(self.path, e))
+
+
+class _TracedConnectionMixin:
+    """Time name resolution and connection of new connections, when tracing"""
+
+    _setup_time = 0
+
+    def _new_conn(self):
+        trace = _current_trace.get()
+        if not trace:
+            return super()._new_conn()
+        start = time.monotonic()
+        try:
+            addresses = socket.getaddrinfo(self._dns_host, self.port, allowed_gai_family(), socket.SOCK_STREAM)
+        except OSError:
+            # let the connection report resolution errors
+            return super()._new_conn()
+        resolved = time.monotonic()
+        trace.add("dns", resolved - start)
+        dns_host = self._dns_host
+        try:
+            # like socket.create_connection, try every address in turn
+            for family, socktype, proto, canonname, address in addresses:
+                self._dns_host = address[0]
+                try:
+                    sock = super()._new_conn()
+                    break
+                except ConnectTimeoutError as e:
+                    error = e
+            else:
+                raise error
+        finally:
+            self._dns_host = dns_host
+            trace.add("connect", time.monotonic() - resolved)
+        trace.add_connection()
+        self._setup_time = time.monotonic() - start
+        return sock
+
+
+class TracedHTTPConnection(_TracedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TracedHTTPSConnection(_TracedConnectionMixin, HTTPSConnection):
+
+    def connect(self):
+        trace = _current_trace.get()
+        if not trace:
+            return super().connect()
+        self._setup_time = 0
+        start = time.monotonic()
+        try:
+            super().connect()
+        finally:
+            if self._setup_time:
+                trace.add("tls", max(time.monotonic() - start - self._setup_time, 0.0))
+
+
+class TracedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TracedHTTPConnection
+
+
+class TracedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TracedHTTPSConnection
+
+
+class TracingHTTPAdapter(requests.adapters.HTTPAdapter):
+    """HTTP adapter timing connection set up phases in the current trace"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TracedHTTPConnectionPool,
+                                                   "https": TracedHTTPSConnectionPool}
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module retrying failed transfers and keeping away from hosts which are down"""
+
+import logging
+import random
+from threading import Lock
+import time
+from urllib.parse import urlsplit
+import requests.exceptions
+from requests.packages.urllib3.exceptions import HTTPError as TransferError
+
+from umake.tools import ConfigHandler, Singleton
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of sending requests to a host considered down"""
+
+
+class CircuitBreaker(metaclass=Singleton):
+    """Count consecutive failures per host. Once there are too many of them, requests to that host fail right away
+    for a while, before letting them through again to check if it's back. Configured with:
+    download:
+      circuit_breaker:
+        failures: 5
+        reset_after: 60"""
+
+    FAILURES = 5
+    # in seconds
+    RESET_AFTER = 60
+
+    def __init__(self):
+        config = ((ConfigHandler().config or {}).get("download") or {}).get("circuit_breaker") or {}
+        self.failures = max(int(config.get("failures", self.FAILURES)), 1)
+        self.reset_after = float(config.get("reset_after", self.RESET_AFTER))
+        # host: (consecutive failures, time until which it's considered down)
+        self._hosts = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def _host(url):
+        return urlsplit(url).netloc
+
+    def is_open(self, url):
+        """Return True if the host of url is considered down"""
+        with self._lock:
+            failures, open_until = self._hosts.get(self._host(url), (0, 0))
+        return open_until > time.monotonic()
+
+    def check(self, url):
+        """Raise a CircuitOpenError if the host of url is considered down"""
+        if self.is_open(url):
+            raise CircuitOpenError("{} failed too many times, not trying it again for now".format(self._host(url)))
+
+    def record_failure(self, url):
+        host = self._host(url)
+        with self._lock:
+            failures = self._hosts.get(host, (0, 0))[0] + 1
+            open_until = 0
+            if failures >= self.failures:
+                # a host coming back has to succeed once to be trusted again
+                open_until = time.monotonic() + self.reset_after
+                logger.warning("{} failed {} times in a row, considering it down for {}s".format(
+                    host, failures, self.reset_after))
+            self._hosts[host] = (failures, open_until)
+
+    def record_success(self, url):
+        with self._lock:
+            self._hosts.pop(self._host(url), None)
+
+
+class RetryPolicy:
+    """Decide if failed transfers are retried, following the configuration file:
+    download:
+      retry:
+        server_error:  # 5xx and 429 answers
+          attempts: 3
+          backoff: 1
+        connection:  # connection failures and transfers cut in the middle
+          attempts: 3
+          backoff: 1
+        timeout:
+          attempts: 2
+          backoff: 2
+        max_backoff: 30
+
+    Retry n of an error class waits a random delay up to backoff * 2^(n-1) seconds, capped to max_backoff, so that
+    clients hit by the same failure don't come back all at once, or after the Retry-After delay the server asked for.
+    One instance counts retries of one download."""
+
+    ERROR_CLASSES = ("server_error", "connection", "timeout")
+    ATTEMPTS = {"server_error": 3, "connection": 3, "timeout": 2}
+    # in seconds
+    BACKOFF = {"server_error": 1, "connection": 1, "timeout": 2}
+    MAX_BACKOFF = 30
+
+    def __init__(self):
+        config = ((ConfigHandler().config or {}).get("download") or {}).get("retry") or {}
+        self.max_backoff = float(config.get("max_backoff", self.MAX_BACKOFF))
+        self._policies = {}
+        for error_class in self.ERROR_CLASSES:
+            policy = config.get(error_class) or {}
+            self._policies[error_class] = (int(policy.get("attempts", self.ATTEMPTS[error_class])),
+                                           float(policy.get("backoff", self.BACKOFF[error_class])))
+        self._retries = {error_class: 0 for error_class in self.ERROR_CLASSES}
+        self._lock = Lock()
+
+    @staticmethod
+    def classify(error):
+        """Return the error class of error, None if retrying wouldn't help"""
+        # certificates won't get any better
+        if isinstance(error, (CircuitOpenError, requests.exceptions.SSLError)):
+            return None
+        if isinstance(error, requests.exceptions.HTTPError):
+            status_code = error.response.status_code if error.response is not None else None
+            if status_code is not None and (status_code >= 500 or status_code == 429):
+                return "server_error"
+            return None
+        if isinstance(error, requests.exceptions.Timeout):
+            return "timeout"
+        if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                              TransferError)):
+            return "connection"
+        return None
+
+    def delay(self, error_class, retry):
+        """Return how long to wait before retry (starting at 1) of error_class"""
+        backoff = self._policies[error_class][1]
+        return random.uniform(0, min(backoff * 2 ** (retry - 1), self.max_backoff))
+
+    def next_delay(self, url, error):
+        """Return how long to wait before fetching url again after error, None if it's not worth it"""
+        error_class = self.classify(error)
+        if not error_class or CircuitBreaker().is_open(url):
+            return None
+        with self._lock:
+            attempts = self._policies[error_class][0]
+            self._retries[error_class] += 1
+            retry = self._retries[error_class]
+        # attempts include the first try
+        if retry >= attempts:
+            return None
+        delay = self.delay(error_class, retry)
+        # servers asking for some time before coming back know better
+        retry_after = getattr(getattr(error, 'response', None), 'headers', {}).get('retry-after', '')
+        if retry_after.isdigit():
+            delay = max(delay, min(int(retry_after), self.max_backoff))
+        logger.warning("Fetching {} failed ({}), retrying in {:.1f}s ({}/{})".format(url, error, delay, retry,
+                                                                                     attempts - 1))
+        return delay
+
+    def retry(self, url, error):
+        """Return True, once it's time to, if url is worth fetching again after error"""
+        delay = self.next_delay(url, error)
+        if delay is None:
+            return False
+        time.sleep(delay)
+        return True
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2014 Canonical
+#
+# Authors:
+#  Didier Roche
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Module rewriting upstream urls to local mirrors"""
+
+import logging
+import re
+
+from umake.tools import ConfigHandler
+
+logger = logging.getLogger(__name__)
+
+
+class UrlRewriter:
+    """Redirect upstream urls to mirrors, following rules of the configuration file:
+    download:
+      rewrite:
+        - prefix: https://golang.org/
+          to: http://mirror.lan/golang/
+        - regex: ^https://download\\.jetbrains\\.com/(\\w+)/
+          to: file:///srv/mirror/jetbrains/\\1/
+      rewrite_fallback: true
+
+    The first matching rule applies, prefix rules replacing the url start and regex ones substituting their match.
+    Upstream urls are tried once the mirror failed, unless rewrite_fallback is false."""
+
+    def __init__(self):
+        config = (ConfigHandler().config or {}).get("download") or {}
+        self.fallback = bool(config.get("rewrite_fallback", True))
+        self._rules = []
+        for rule in config.get("rewrite") or []:
+            try:
+                if "prefix" in rule:
+                    self._rules.append((None, rule["prefix"], rule["to"]))
+                else:
+                    self._rules.append((re.compile(rule["regex"]), None, rule["to"]))
+            except (KeyError, TypeError, re.error) as e:
+                logger.error("Ignoring invalid url rewrite rule {}: {}".format(rule, e))
+
+    def rewrite(self, url):
+        """Return url as rewritten by the first matching rule, url itself if none matches"""
+        for regex, prefix, replacement in self._rules:
+            if regex:
+                new_url, count = regex.subn(replacement, url, count=1)
+                if count:
+                    break
+            elif url.startswith(prefix):
+                new_url = replacement + url[len(prefix):]
+                break
+        else:
+            return url
+        logger.debug("Rewrote {} to {}".format(url, new_url))
+        return new_url
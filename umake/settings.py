@@ -28,6 +28,10 @@ OLD_CONFIG_FILENAME = "udtc"
 CONFIG_FILENAME = "umake"
 LSB_RELEASE_FILE = "/etc/lsb-release"
 UMAKE_FRAMEWORKS_ENVIRON_VARIABLE = "UMAKE_FRAMEWORKS"
+# the artifact cache keeps whole SDKs under the user cache directory, it has to be enabled with a quota, see
+# ArtifactCache
+DEFAULT_ARTIFACT_CACHE_MAX_SIZE = 0
+DEFAULT_MAX_BUFFER_SIZE = 8 * 1024 * 1024
 
 from_dev = False
 
@@ -34,7 +34,7 @@ from textwrap import dedent
 from time import sleep
 from threading import Lock
 from umake import settings
-from xdg.BaseDirectory import load_first_config, xdg_config_home, xdg_data_home
+from xdg.BaseDirectory import load_first_config, xdg_cache_home, xdg_config_home, xdg_data_home
 import yaml
 import yaml.scanner
 import yaml.parser
@@ -264,6 +264,11 @@ def get_icon_path(icon_filename):
     return os.path.join(xdg_data_home, "icons", icon_filename)
 
 
+def get_cache_path(*paths):
+    """Return Ubuntu Make cache path, paths being optional sub-paths inside it"""
+    return os.path.join(xdg_cache_home, settings.CONFIG_FILENAME, *paths)
+
+
 def get_launcher_path(desktop_filename):
     """Return launcher path"""
     return os.path.join(xdg_data_home, "applications", desktop_filename)
@@ -28,6 +28,9 @@ from progressbar import ProgressBar, BouncingBar
 import readline
 import sys
 from umake.interactions import InputText, TextWithChoices, LicenseAgreement, DisplayMessage, UnknownProgress
+from umake.network.artifact_cache import ArtifactCache
+from umake.network.page_cache import PageCache
+from umake.network.request_trace import TraceWriter
 from umake.ui import UI
 from umake.frameworks import BaseCategory, list_frameworks
 from umake.tools import InputError, MainLoop
@@ -220,6 +223,18 @@ def get_frameworks_list_output(args):
     return print_result
 
 
+def get_cache_stats_output():
+    """Return a string ready to be printed with the artifact cache usage"""
+    cache = ArtifactCache()
+    count, size = cache.stats()
+    mib = 1024 * 1024
+    if not cache.enabled:
+        return _("Artifact cache is disabled. Enable it with a \"cache: max_size:\" quota in bytes in the "
+                 "configuration file")
+    return _("Artifact cache in {}: {} artifacts, {:.1f} MiB used out of {:.1f} MiB").format(
+        cache.path, count, size / mib, cache.max_size / mib)
+
+
 def main(parser):
     """Main entry point of the cli command"""
     categories_parser = parser.add_subparsers(help='Developer environment', dest="category")
@@ -243,9 +258,22 @@ def main(parser):
         print(get_version())
         sys.exit(0)
 
+    if args.cache_stats:
+        print(get_cache_stats_output())
+        sys.exit(0)
+
+    if args.cache_prune:
+        ArtifactCache().prune()
+        PageCache().prune()
+        print(_("Artifact cache pruned"))
+        sys.exit(0)
+
     if not args.category:
         parser.print_help()
         sys.exit(0)
 
+    if args.trace_downloads:
+        TraceWriter().path = os.path.abspath(args.trace_downloads)
+
     CliUI()
     run_command_for_args(args)